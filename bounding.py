@@ -0,0 +1,145 @@
+"""
+Placement of rotated rasters around model domains.
+"""
+# system modules
+import math
+
+# 3rd party modules
+import numpy as np
+
+
+# maximum number of (angle, vertex) projections computed at once
+MAX_PROJECTIONS = 1 << 22
+
+
+def fit_raster(xs, ys, dc, dr, angles):
+    """Returns the raster of dc by dr cells with the fewest cells covering the points xs, ys among the rotations in
+    angles.
+
+    The raster is centred on the points, its extents are rounded up to whole cells. Of equally small rasters the
+    one listed first in angles is returned.
+
+    Parameters
+    ----------
+    xs: numpy.ndarray
+    ys: numpy.ndarray
+    dc: float
+        column width
+    dr: float
+        row height
+    angles: sequence of float
+        counter-clockwise rotations of the raster in radians
+
+    Returns
+    -------
+    dict
+        'xll', 'yll', 'nc', 'nr' and 'angle' (radians) like a RasterWriter
+    """
+    xs = np.asarray(xs, dtype=np.float64).ravel()
+    ys = np.asarray(ys, dtype=np.float64).ravel()
+    angles = np.asarray(angles, dtype=np.float64).ravel()
+
+    # relative to their centre the coordinates keep their precision when projected
+    x0, y0 = xs.mean(), ys.mean()
+    px, py = xs - x0, ys - y0
+
+    best = None
+    step = max(1, MAX_PROJECTIONS // max(1, xs.size))
+    for start in range(0, angles.size, step):
+        part = angles[start:start + step, np.newaxis]
+        cosa, sina = np.cos(part), np.sin(part)
+        # coordinates along the columns (u) and the rows (v) of the rotated rasters
+        u = px * cosa + py * sina
+        v = py * cosa - px * sina
+        umin, umax = u.min(axis=1), u.max(axis=1)
+        vmin, vmax = v.min(axis=1), v.max(axis=1)
+        # a tolerance keeps exact fits from getting an extra cell
+        nc = np.maximum(np.ceil((umax - umin) / dc - 1e-9), 1.0)
+        nr = np.maximum(np.ceil((vmax - vmin) / dr - 1e-9), 1.0)
+
+        i = int(np.argmin(nc * nr))
+        if best is None or nc[i] * nr[i] < best['nc'] * best['nr']:
+            angle = float(angles[start + i])
+            u0 = umin[i] - 0.5 * (nc[i] * dc - (umax[i] - umin[i]))
+            v0 = vmin[i] - 0.5 * (nr[i] * dr - (vmax[i] - vmin[i]))
+            best = {
+                'xll': float(x0 + u0 * math.cos(angle) - v0 * math.sin(angle)),
+                'yll': float(y0 + u0 * math.sin(angle) + v0 * math.cos(angle)),
+                'nc': int(nc[i]),
+                'nr': int(nr[i]),
+                'angle': angle
+            }
+    return best
+
+
+def _cells(length, size):
+    # a tolerance keeps exact fits from getting an extra cell, as in fit_raster
+    return max(math.ceil(length / size - 1e-9), 1)
+
+
+def min_area_raster(xs, ys, dc, dr):
+    """Returns the rotated raster of dc by dr cells with the fewest cells covering the convex polygon xs, ys among
+    the rasters with their columns along or across one of its edges.
+
+    A minimum-area rectangle around a convex polygon has a side on one of its edges; rounding up to whole cells may
+    leave a rotation between the edges with slightly fewer cells, which is not searched for. The rotating calipers sweep
+    visits the edges in order and carries the vertices farthest ahead of, behind and across the current edge along
+    with it, so the extents of all edge rotations take a single pass over the vertices. Each edge is tried with the
+    columns along and across it (which matters for dc != dr); the axis-aligned rotations win ties. The polygon has
+    to be convex (e.g. QgsGeometry.convexHull), its orientation does not matter and a closing vertex is ignored.
+
+    Returns
+    -------
+    dict
+        see fit_raster; the angle lies in (-pi/2, pi/2]
+    """
+    xs = np.asarray(xs, dtype=np.float64).ravel()
+    ys = np.asarray(ys, dtype=np.float64).ravel()
+
+    # relative to their centre the coordinates keep their precision when projected
+    px, py = xs - xs.mean(), ys - ys.mean()
+    # repeated vertices, e.g. the closing one of a ring, have no edge
+    keep = (np.roll(px, -1) != px) | (np.roll(py, -1) != py)
+    px, py = px[keep], py[keep]
+
+    # candidates (cells, axis-aligned first, |angle|, angle), the smallest one wins
+    width, height = np.ptp(xs), np.ptp(ys)
+    best = min((_cells(width, dc) * _cells(height, dr), 0, 0.0, 0.0),
+               (_cells(height, dc) * _cells(width, dr), 0, 0.5 * math.pi, 0.5 * math.pi))
+    n = px.size
+    if n > 1:
+        # the calipers turn counter-clockwise, i.e. the polygon lies left of its edges
+        if np.sum(px * np.roll(py, -1) - np.roll(px, -1) * py) < 0.0:
+            px, py = px[::-1], py[::-1]
+        ex, ey = np.roll(px, -1) - px, np.roll(py, -1) - py
+        length = np.hypot(ex, ey)
+        cosa, sina = (ex / length).tolist(), (ey / length).tolist()
+        px, py = px.tolist(), py.tolist()
+
+        def along(k, i):
+            return px[k % n] * cosa[i] + py[k % n] * sina[i]
+
+        def across(k, i):
+            return py[k % n] * cosa[i] - px[k % n] * sina[i]
+
+        # the vertices farthest ahead of, across and behind the first edge only move forward with the edges
+        ahead = max(range(n), key=lambda k: along(k, 0))
+        top = max(range(n), key=lambda k: across(k, 0))
+        behind = min(range(n), key=lambda k: along(k, 0))
+        for i in range(n):
+            while along(ahead + 1, i) > along(ahead, i):
+                ahead += 1
+            while across(top + 1, i) > across(top, i):
+                top += 1
+            while along(behind + 1, i) < along(behind, i):
+                behind += 1
+            width = along(ahead, i) - along(behind, i)
+            height = across(top, i) - across(i, i)
+
+            angle = math.atan2(sina[i], cosa[i])
+            for rotation, nc, nr in ((angle, _cells(width, dc), _cells(height, dr)),
+                                     (angle + 0.5 * math.pi, _cells(height, dc), _cells(width, dr))):
+                # rotations by half a turn give the same raster
+                rotation = 0.5 * math.pi - (0.5 * math.pi - rotation) % math.pi
+                best = min(best, (nc * nr, 1, abs(rotation), rotation))
+    return fit_raster(xs, ys, dc, dr, [best[3]])
@@ -10,6 +10,7 @@ from qgis.PyQt import uic
 # promaides modules
 from .interpolate import RasterInterpolator
 from .environment import get_ui_path
+from .utils import PolygonIndex
 
 #general
 from datetime import datetime
@@ -134,19 +135,27 @@ class CINConnectorExportAuto(object):
 
         if polygonlayer:
 
-            for pol_feature in polygonlayer.getFeatures():
-                if pointlayer:
-                    for point_feature in pointlayer.getFeatures():
-                        if pol_feature.geometry().contains(point_feature.geometry()):
-                            connector_id.append(str(pair_index))
-                            source_id_write.append(str(pol_feature["polygon_id"]))
-                            source_name_write.append(str(pol_feature["polygon_na"]))
-                            sink_id_write.append(str(point_feature["point_id"]))
-                            sink_name_write.append(str(point_feature["point_name"]))
-
-                            print(str(source_id_write[pair_index]) + " " + str(source_name_write[pair_index]))
-
-                            pair_index = pair_index + 1
+            pol_features = list(polygonlayer.getFeatures())
+            polygon_index = PolygonIndex(pol_features)
+            # pairs of (polygon position, point position, point feature) in polygon order
+            pairs = []
+            if pointlayer:
+                for point_position, point_feature in enumerate(pointlayer.getFeatures()):
+                    for pol_position in polygon_index.containing(point_feature.geometry()):
+                        pairs.append((pol_position, point_position, point_feature))
+            pairs.sort(key=lambda pair: pair[:2])
+
+            for pol_position, point_position, point_feature in pairs:
+                pol_feature = pol_features[pol_position]
+                connector_id.append(str(pair_index))
+                source_id_write.append(str(pol_feature["polygon_id"]))
+                source_name_write.append(str(pol_feature["polygon_na"]))
+                sink_id_write.append(str(point_feature["point_id"]))
+                sink_name_write.append(str(point_feature["point_name"]))
+
+                print(str(source_id_write[pair_index]) + " " + str(source_name_write[pair_index]))
+
+                pair_index = pair_index + 1
 
             print(pair_index, "pair_index_end")
 
@@ -9,6 +9,7 @@ from qgis.PyQt import uic
 
 # promaides modules
 from .interpolate import RasterInterpolator
+from .tasks import ExportTask, output_file, push_outcome
 from .environment import get_ui_path
 
 # system modules
@@ -115,7 +116,6 @@ class CINPointExport(object):
     def __init__(self, iface):
         self.iface = iface
         self.dialog = None
-        self.cancel = False
         self.act = QAction('CIN Point Export', iface.mainWindow())
         self.act.triggered.connect(self.execDialog)
 
@@ -150,13 +150,9 @@ class CINPointExport(object):
         self.dialog.expression_field_actives.setFilters(QgsFieldProxyModel.Int | QgsFieldProxyModel.LongLong | QgsFieldProxyModel.Double | QgsFieldProxyModel.String)
         self.dialog.show()
 
-    def scheduleAbort(self):
-        self.cancel = True
-
     def quitDialog(self):
         self.dialog = None
         self.act.setEnabled(True)
-        self.cancel = False
 
     def execTool(self):
         filename = self.dialog.filename_edit.text()
@@ -172,12 +168,10 @@ class CINPointExport(object):
         if point_layer.selectedFeatureCount():
             only_selected = True
             features = point_layer.selectedFeatures()
-            feature_count = point_layer.selectedFeatureCount()
 
         else:
             only_selected = False
             features = point_layer.getFeatures()
-            feature_count = point_layer.featureCount()
 
         # labeling the input layer attributes to variables
         # the variable name is plural because all names are contained
@@ -207,13 +201,50 @@ class CINPointExport(object):
             self.quitDialog()
             return
 
-        progress = QProgressDialog('Exporting CIN point ...', 'Abort', 0, feature_count, self.iface.mainWindow())
-        progress.setWindowTitle('CIN Point Export')
-        progress.canceled.connect(self.scheduleAbort)
-        progress.show()
+        # the points are checked before anything is written
+        points = []
+        zipped_list = zip(ids, names, sectors, levels, thresholds, regulars, actives, recoverys, features)
+        sort_zip = sorted(zipped_list, key = lambda t: t[0]) #  sorts the list based on the ids
+
+        for id, name, sector, level, threshold, regular, active, recovery, feature in sort_zip:
+
+            try:
+                point = feature.geometry().asPoint()
+
+            except ValueError:
+                self.iface.messageBar().pushCritical(
+                    'CIN Point Export',
+                    'Point is not correctly defined. '
+                    'Check whether an x and y coordinate is present for every point.'
+                )
+                self.quitDialog()
+                return
+
+            if not name:
+                self.iface.messageBar().pushCritical(
+                    'CIN Point Export',
+                    'Point is missing an entry. Please make sure that all points have the attributes:<br>'
+                    ' name, id, sector, level, threshold, regular, active, recovery'
+                )
+                self.quitDialog()
+                return
+
+            points.append((id, point.x(), point.y(), name, sector, level, threshold, regular, active, recovery))
+
+        job = {
+            'filename': filename,
+            'source_name': point_layer.sourceName(),
+            'points': points
+        }
+
+        # the export runs in the background, the dialog is not needed anymore
+        ExportTask('CIN Point Export', self.exportPoints, job, len(points),
+                   lambda task: push_outcome(self.iface, 'CIN Point Export', task)).start()
+        self.quitDialog()
 
-        # iterate over polyline features
-        with open(filename, 'w') as cin_point_file:
+    def exportPoints(self, job, task):
+        """Writes the CIN point file of job on the worker thread of task."""
+        with output_file(job['filename'], task) as cin_point_file:
 
             cin_point_file.write('########################################################################\n')
             cin_point_file.write('# This file was automatically generated by "Point Export for ProMaiDes CIN Module"')
@@ -222,7 +253,7 @@ class CINPointExport(object):
             now = datetime.now()
             dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
             cin_point_file.write('# Generated at {dt_string_1} '.format(dt_string_1=dt_string))
-            cin_point_file.write('from layer {filename_1} \n'.format(filename_1=point_layer.sourceName()))
+            cin_point_file.write('from layer {filename_1} \n'.format(filename_1=job['source_name']))
             cin_point_file.write('# Comments are marked with #\n')
             cin_point_file.write('# There are three CI-elements:\n')
             cin_point_file.write('# 1. Points; as in this file)\n')
@@ -262,60 +293,18 @@ class CINPointExport(object):
             cin_point_file.write('########################################################################\n\n')
 
             cin_point_file.write('!BEGIN\n')
-            cin_point_file.write('{number} #Number of CI points \n'.format(number=feature_count))
-            index = 0
-
-            zipped_list = zip(ids, names, sectors, levels, thresholds, regulars, actives, recoverys, features)
-            sort_zip = sorted(zipped_list, key = lambda t: t[0]) #  sorts the list based on the ids
-
-            for id, name, sector, level, threshold, regular, active, recovery, feature in sort_zip:
-
-                points_x = []
-                points_y = []
-                attributes_str = [name]
-
-                try:
-                    points_x.append(feature.geometry().asPoint().x())
-                    points_y.append(feature.geometry().asPoint().y())
-
-                except ValueError:
-                    self.iface.messageBar().pushCritical(
-                        'CIN Point Export',
-                        'Point is not correctly defined. '
-                        'Check whether an x and y coordinate is present for every point.'
-                    )
-                    self.quitDialog()
-                    return
-
-                for i in attributes_str:
-                    if not i:
-                        self.iface.messageBar().pushCritical(
-                            'CIN Point Export',
-                            'Point is missing an entry. Please make sure that all points have the attributes:<br>'
-                            ' name, id, sector, level, threshold, regular, active, recovery'
-                        )
-                        self.quitDialog()
-                        return
-                    i.replace(' ', '_')  # loop this through all atts
+            cin_point_file.write('{number} #Number of CI points \n'.format(number=len(job['points'])))
+
+            for id, x, y, name, sector, level, threshold, regular, active, recovery in job['points']:
+
+                if task.isCanceled():
+                    break
 
                 cin_point_file.write('{a} {b} {c} {d} {e} {f} {g} {h} {i} {j}\n'.format
-                                              (a=str(id), b=points_x[0], c=points_y[0], d=str(name), e=int(sector),
+                                              (a=str(id), b=x, c=y, d=str(name), e=int(sector),
                                                f=int(level), g=float(threshold), h=float(recovery),
                                                i=str(regular), j=float(active)))
 
-                index += 1
-                progress.setValue(index)
-
-                if self.cancel:
-
-                    break
+                task.report()
 
             cin_point_file.write('!END\n\n')
-        progress.close()
-        #if not self.cancel:
-        self.iface.messageBar().pushInfo(
-            'CIN Point Export',
-            'Export finished successfully!'
-           )
-
-        self.quitDialog()
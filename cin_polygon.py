@@ -9,6 +9,7 @@ from qgis.PyQt import uic
 
 # promaides modules
 from .interpolate import RasterInterpolator
+from .tasks import ExportTask, output_file, push_outcome
 from .environment import get_ui_path
 
 #general
@@ -109,7 +110,6 @@ class CINPolygonExport(object):
     def __init__(self, iface):
         self.iface = iface
         self.dialog = None
-        self.cancel = False
         self.act = QAction('CIN Polygon Export', iface.mainWindow())
         self.act.triggered.connect(self.execDialog)
 
@@ -139,13 +139,9 @@ class CINPolygonExport(object):
         self.dialog.expression_field_endusers.setFilters(QgsFieldProxyModel.Int | QgsFieldProxyModel.LongLong | QgsFieldProxyModel.Double | QgsFieldProxyModel.String)
         self.dialog.show()
 
-    def scheduleAbort(self):
-        self.cancel = True
-
     def quitDialog(self):
         self.dialog = None
         self.act.setEnabled(True)
-        self.cancel = False
 
     def execTool(self):
         filename = self.dialog.filename_edit.text()
@@ -161,11 +157,9 @@ class CINPolygonExport(object):
         if polygon_layer.selectedFeatureCount():
             only_selected = True
             features = polygon_layer.selectedFeatures()
-            feature_count = polygon_layer.selectedFeatureCount()
         else:
             only_selected = False
             features = polygon_layer.getFeatures()
-            feature_count = polygon_layer.featureCount()
 
 
         # labeling the input layer attributes to variables
@@ -192,15 +186,37 @@ class CINPolygonExport(object):
              self.quitDialog()
              return
 
-        progress = QProgressDialog('Exporting Polygon ...', 'Abort', 0, feature_count, self.iface.mainWindow())
-        progress.setWindowTitle('Polygon Export')
-        progress.canceled.connect(self.scheduleAbort)
-        progress.show()
+        # the attributes are checked before anything is written
+        for i in attributes:
+            if not i:
+                self.iface.messageBar().pushCritical(
+                    'CIN Polygon Export',
+                    'Polygon is missing an entry. Please assign and fill out the attributes:<br>'
+                    ' name, id, sector, end users'
+                    )
+                self.quitDialog()
+                return
+
+        polygons = []
+        for feature, id, name, sector, enduser in zip(features, ids, names, sectors, endusers):
+            points = [(p.x(), p.y()) for p in feature.geometry().vertices()]
+            polygons.append((id, name, sector, enduser, points))
+
+        job = {
+            'filename': filename,
+            'source_name': polygon_layer.sourceName(),
+            'polygons': polygons
+        }
+
+        # the export runs in the background, the dialog is not needed anymore
+        ExportTask('CIN Polygon Export', self.exportPolygons, job, len(polygons),
+                   lambda task: push_outcome(self.iface, 'Polygon Export', task)).start()
+        self.quitDialog()
 
-        # iterate over polygon features
-        with open(filename, 'w') as polygon_file:
+    def exportPolygons(self, job, task):
+        """Writes the CIN polygon file of job on the worker thread of task."""
+        with output_file(job['filename'], task) as polygon_file:
 
-            index = 0
             polygon_file.write('########################################################################\n')
             polygon_file.write('# This file was automatically generated by "Polygon Export for ProMaiDes CIN Module"')
             polygon_file.write('Export-QGIS-Plugin Version {version_1} \n'.format(version_1=VERSION))
@@ -208,14 +224,14 @@ class CINPolygonExport(object):
             now = datetime.now()
             dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
             polygon_file.write('# Generated at {dt_string_1} '.format(dt_string_1=dt_string))
-            polygon_file.write('from layer {filename_1} \n'.format(filename_1=polygon_layer.sourceName()))
+            polygon_file.write('from layer {filename_1} \n'.format(filename_1=job['source_name']))
             polygon_file.write('# Comments are marked with #\n')
             polygon_file.write('# There are three CI-elements:\n')
             polygon_file.write('# 1. Points; as in this file)\n')
             polygon_file.write('# 2. Connectors; linking Points with each other, multiple connectors in ''several directions are possible) \n')
             polygon_file.write('# 3. Polygons; mostly final elements\n')
             polygon_file.write('#\n')
-            polygon_file.write('# Number of polygons in file: {}  \n'.format(feature_count))
+            polygon_file.write('# Number of polygons in file: {}  \n'.format(len(job['polygons'])))
             polygon_file.write('#\n')
             polygon_file.write('# These polygons are part of the critical infrastructure network (CIN); polygons are final elements that are no source for other elements\n')
             polygon_file.write('#\n')
@@ -238,50 +254,23 @@ class CINPolygonExport(object):
             polygon_file.write('# \n')
             polygon_file.write('########################################################################\n')
             polygon_file.write('#number of polygons\n')
-            polygon_file.write('{}\n\n'.format(feature_count))
-
-
-            for feature, id, name, sector, enduser in zip(features, ids, names,sectors, endusers):
-                points = []
-                buff = feature.geometry()
-                for p in buff.vertices():
-                    points.append(p)
-
-                for i in attributes:
-                    if not i:
-                        self.iface.messageBar().pushCritical(
-                            'CIN Polygon Export',
-                            'Polygon is missing an entry. Please assign and fill out the attributes:<br>'
-                            ' name, id, sector, end users'
-                            )
-                        self.quitDialog()
-                        return
-                    if self.cancel:
-                        break
+            polygon_file.write('{}\n\n'.format(len(job['polygons'])))
+
+
+            for id, name, sector, enduser, points in job['polygons']:
+
+                if task.isCanceled():
+                    break
 
                 polygon_file.write('!BEGIN\n')
                 polygon_file.write('{a} {b} {c} {d} {e}\n'.format
                  (a=str(id), b=len(points)-1, c=str(name), d=str(sector), e=str(enduser)))
 
                 # iterate over points in polygon
-                for point in points[:len(points)-1]:
+                for x, y in points[:len(points)-1]:
 
-                    polygon_file.write('{x} {y}\n'.format(x=point.x(), y=point.y()))
+                    polygon_file.write('{x} {y}\n'.format(x=x, y=y))
 
                 polygon_file.write('!END\n\n')
 
-                index += 1
-                progress.setValue(index)
-
-                if self.cancel:
-                    break
-
-        progress.close()
-
-        #if not self.cancel:
-        self.iface.messageBar().pushInfo(
-            'Polygon Export',
-            'Export finished successfully!'
-           )
-
-        self.quitDialog()
+                task.report()
@@ -9,6 +9,7 @@ from qgis.PyQt import uic
 
 # promaides modules
 from .interpolate import RasterInterpolator
+from .tasks import ExportTask, output_file, push_outcome
 from .environment import get_ui_path
 
 #general
@@ -170,7 +171,6 @@ class CoastlineExport(object):
     def __init__(self, iface):
         self.iface = iface
         self.dialog = None
-        self.cancel = False
         self.act = QAction('Coastline Export', iface.mainWindow())
         self.act.triggered.connect(self.execDialog)
 
@@ -198,13 +198,9 @@ class CoastlineExport(object):
         self.dialog.label_field_box.setFilters(QgsFieldProxyModel.String)
         self.dialog.show()
 
-    def scheduleAbort(self):
-        self.cancel = True
-
     def quitDialog(self):
         self.dialog = None
         self.act.setEnabled(True)
-        self.cancel = False
 
     def execTool(self):
 
@@ -253,7 +249,8 @@ class CoastlineExport(object):
             raster_band = self.dialog.raster_band_box.value()
             method = self.dialog.method_box.currentText()
             nan = self.dialog.nan_box.value()
-            interpolator = RasterInterpolator(raster_layer, raster_band, 10, 10, method, nan)
+            interpolator = RasterInterpolator(raster_layer, raster_band, 10, 10, method, nan, clone_provider=True,
+                                              cache_tiles=True)
             z_values = None
         else:
             interpolator = None
@@ -266,28 +263,63 @@ class CoastlineExport(object):
                 self.quitDialog()
                 return
 
-        progress = QProgressDialog('Exporting coastline ...', 'Abort', 0, feature_count, self.iface.mainWindow())
-        progress.setWindowTitle('Coastline Export')
-        progress.canceled.connect(self.scheduleAbort)
-        progress.show()
-
-        def signed_area(ring):
-            """Returns the signed area of a polygon ring."""
-            area = 0
-            for i, p in enumerate(ring):
-                x1 = p.x()
-                y1 = p.y()
-                if p is ring[-1]:
-                    x2 = ring[0].x()
-                    y2 = ring[0].y()
-                else:
-                    x2 = ring[i + 1].x()
-                    y2 = ring[i + 1].y()
-                area += (x1 * y2 - x2 * y1)
-            return area / 2
+        # polygon has more than one ring
+        if feature_count != 1:
+            self.iface.messageBar().pushCritical(
+                'Error during coastline export',
+                'More than one polygon available in layer! Please just select one! Aborting...')
+            self.quitDialog()
+            return
+
+        feature, label = next(iter(zip(features, labels)))
+
+        # label is None or empty
+        if not label:
+            self.iface.messageBar().pushCritical(
+                'Error during coastline export',
+                'Invalid coastline label found in field "{}"! Aborting...'
+                .format(self.dialog.label_field_box.expression())
+            )
+            self.quitDialog()
+            return
+
+        job = {
+            'filename': filename,
+            'source_name': input_layer.sourceName(),
+            'raster_name': raster_layer.name() if interpolate_z else None,
+            # implicitly convert label to string, erase whitespace before
+            'label': str(label).replace(' ', '_'),
+            # don't include the first point which is identical to the last
+            'points': [(p.x(), p.y()) for p in feature.geometry().vertices()][:-1],
+            'z_value': None if interpolate_z else z_values[0],
+            'interpolator': interpolator,
+            'nan': nan if interpolate_z else None,
+            'base_elevation': base_elevations,
+            'break_flag': break_flags,
+            'abrupt_break_flag': abrupt_break_flags,
+            'abrupt_opening': abrupt_openings,
+            'resistance': resistances,
+            'overflow_flag': overflow_flags,
+            'poleni_factor': poleni_factors
+        }
+
+        # the export runs in the background, the dialog is not needed anymore
+        ExportTask('Coastline Export', self.exportCoastline, job, 1,
+                   lambda task: push_outcome(self.iface, 'Coastline Export', task)).start()
+        self.quitDialog()
+
+    def exportCoastline(self, job, task):
+        """Writes the coastline file of job on the worker thread of task."""
+        be = job['base_elevation']
+        bf = job['break_flag']
+        abf = job['abrupt_break_flag']
+        ao = job['abrupt_opening']
+        res = job['resistance']
+        of = job['overflow_flag']
+        pf = job['poleni_factor']
+        points, interpolator = job['points'], job['interpolator']
 
-        # iterate over polyline features
-        with open(filename, 'w') as coastline_file:
+        with output_file(job['filename'], task) as coastline_file:
 
             index = 0
             coastline_file.write('########################################################################\n')
@@ -297,9 +329,9 @@ class CoastlineExport(object):
             now = datetime.now()
             dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
             coastline_file.write('# Generated at {dt_string_1} '.format(dt_string_1=dt_string))
-            coastline_file.write('from layer {filename_1} \n'.format(filename_1=input_layer.sourceName()))
-            if interpolate_z:
-                coastline_file.write('#  based on height raster (DEM) {}  \n'.format(raster_layer.name()))
+            coastline_file.write('from layer {filename_1} \n'.format(filename_1=job['source_name']))
+            if interpolator is not None:
+                coastline_file.write('#  based on height raster (DEM) {}  \n'.format(job['raster_name']))
             coastline_file.write('# Comments are marked with #\n')
             coastline_file.write('#\n')
             coastline_file.write('# Explanation of data:\n')
@@ -321,123 +353,43 @@ class CoastlineExport(object):
             coastline_file.write('#  !$ENDCOASTMODEL  \n')
             coastline_file.write('########################################################################\n\n')
 
-            for f, label in zip(features, labels):
+            coastline_file.write('!BEGIN\n')
+            coastline_file.write('{0:d} {1} {2:d}\n'.format(index, job['label'], len(points)))
 
-                be = base_elevations
-                bf = break_flags
-                abf = abrupt_break_flags
-                ao = abrupt_openings
-                res = resistances
-                of = overflow_flags
-                pf = poleni_factors
+            # iterate over points in polygon in CCW direction
+            # if signed_distance < 0, polygon is CW
+            # points = polygon[0][1:] if signed_area(polygon[0]) > 0 else reversed(polygon[0][1:])
 
+            if interpolator is not None:
+                z_ring = interpolator.sample([x for x, y in points], [y for x, y in points]).tolist()
 
+            for i, (x, y) in enumerate(points):
 
-                if input_layer.selectedFeatureCount():
-                    only_selected = True
-                    features = input_layer.selectedFeatures()
-                    feature_count = input_layer.selectedFeatureCount()
+                if interpolator is not None:
+                    z = z_ring[i]
                 else:
-                    only_selected = False
-                    features = input_layer.getFeatures()
-                    feature_count = input_layer.featureCount()
-
-
-                # polygon has more than one ring
-                if feature_count != 1:
-                    self.iface.messageBar().pushCritical(
-                        'Error during coastline export',
-                        'More than one polygon available in layer! Please just select one! Aborting...')
-                    coastline_file.write('Error during coastline export\n '
-                                         'More than one polygon available in '
-                                         'layer! Please just select one! Aborting...\n')
-
-                    self.quitDialog()
-                    return
-
-                # label is None or empty
-                if not label:
-                    self.iface.messageBar().pushCritical(
-                        'Error during coastline export',
-                        'Invalid coastline label found in field "{}"! Aborting...'
-                        .format(self.dialog.label_field_box.expression())
-                    )
-                    self.quitDialog()
-                    return
-
-                # implicitly convert label to string
-                label = str(label)
-
-                # erase whitespace before
-                label = label.replace(' ', '_')
-                # label contains whitespaces
-                if len(label.split(' ')) > 1:
-                    self.iface.messageBar().pushCritical(
-                        'Error during coastline export',
-                        'Labels must not contain whitespaces! Aborting ...'
-                        .format(self.dialog.label_field_box.expression())
-                    )
-                    self.quitDialog()
-                    return
-
-                if self.cancel:
-                    break
-
-                coastline_file.write('!BEGIN\n')
-                points = []
-                for feature, label1 in zip(features, labels):
-                    buff = feature.geometry()
-
-                for p in buff.vertices():
-                    points.append(p)
-
-                coastline_file.write('{0:d} {1} {2:d}\n'.format(index, label, len(points)-1))
-
-                # iterate over points in polygon in CCW direction
-                # if signed_distance < 0, polygon is CW
-                # points = polygon[0][1:] if signed_area(polygon[0]) > 0 else reversed(polygon[0][1:])
-                # don't include the first point which is identical to the last
-
-                for i in range(len(points)-1):
-
-                    if interpolate_z:
-                        z = interpolator(QgsPointXY(points[i]))
-                    else:
-                        z = z_values[index]
-                    print(z)
-                    print(nan)
-                    if z is nan:
-                        bf_buff = 'False'
-                        abf_buff = 'False'
-                        of_buff = 'False'
-                    else:
-                        bf_buff = bf
-                        abf_buff = abf
-                        of_buff = of
-
-
-                    if abf:
-                        coastline_file.write('{x} {y} {z} {zb} {bf} {ab} {op} {ov} {po}\n'
-                                             .format(x=points[i].x(), y=points[i].y(), z=z, zb=be,
-                                                     bf=str(bf_buff).lower(), ab=str(abf_buff).lower(),
-                                                     op=ao, ov=str(of_buff).lower(), po=pf))
-                    else:
-                        coastline_file.write('{x} {y} {z} {zb} {bf} {ab} {res} {ov} {po}\n'
-                                             .format(x=points[i].x(), y=points[i].y(), z=z, zb=be,
-                                                     bf=str(bf_buff).lower(), ab=str(abf_buff).lower(),
-                                                     res=res, ov=str(of_buff).lower(), po=pf))
-
-                coastline_file.write('!END\n\n')
-
-                index += 1
-                progress.setValue(index)
+                    z = job['z_value']
+                if z == job['nan']:
+                    bf_buff = 'False'
+                    abf_buff = 'False'
+                    of_buff = 'False'
+                else:
+                    bf_buff = bf
+                    abf_buff = abf
+                    of_buff = of
 
-                if self.cancel:
-                    break
 
-        progress.close()
+                if abf:
+                    coastline_file.write('{x} {y} {z} {zb} {bf} {ab} {op} {ov} {po}\n'
+                                         .format(x=x, y=y, z=z, zb=be,
+                                                 bf=str(bf_buff).lower(), ab=str(abf_buff).lower(),
+                                                 op=ao, ov=str(of_buff).lower(), po=pf))
+                else:
+                    coastline_file.write('{x} {y} {z} {zb} {bf} {ab} {res} {ov} {po}\n'
+                                         .format(x=x, y=y, z=z, zb=be,
+                                                 bf=str(bf_buff).lower(), ab=str(abf_buff).lower(),
+                                                 res=res, ov=str(of_buff).lower(), po=pf))
 
-        #if not self.cancel:
-        self.iface.messageBar().pushInfo('Coastline Export', 'Export finished successfully!')
+            coastline_file.write('!END\n\n')
 
-        self.quitDialog()
+        task.report()
@@ -8,6 +8,9 @@ from datetime import datetime
 import tempfile
 import webbrowser
 
+# 3rd party modules
+import numpy as np
+
 # QGIS modules
 from qgis.core import *
 from qgis.gui import *
@@ -20,6 +23,8 @@ from qgis.PyQt import uic
 # promaides modules
 from .interpolate import RasterInterpolator
 from .raster import SimpleRasterWriter
+from .transform import CoordinateTransformCache
+from .tasks import ExportTask, push_outcome
 from .environment import get_ui_path
 from .version import *
 from .utils import *
@@ -53,6 +58,14 @@ class PluginDialog(QDialog):
         self.popLayerBox.setFilters(QgsMapLayerProxyModel.RasterLayer)
         self.AreaLayerBox.setFilters(QgsMapLayerProxyModel.PolygonLayer)
 
+        # the land-use ids are categories, which must not be blended
+        self.ecnInterpolationBox.addItem('nearest neighbor (downscaling/upscaling)')
+        self.ecnInterpolationBox.addItem('majority (upscaling)')
+        self.ecnInterpolationBox.addItem('dominant area (upscaling)')
+        # the population density is resampled conserving the number of people
+        self.popInterpolationBox.addItem('nearest neighbor (downscaling/upscaling)')
+        self.popInterpolationBox.addItem('area weighted (mass conserving)')
+
         # The module consists of two input options ecn/ pop. The lines below set the default that none of them are chosen in the beginning.
         # The user has to choose one of them. The two bottom functions will make sure that only one of the options can be chosen.
 
@@ -90,6 +103,8 @@ class PluginDialog(QDialog):
         self.popTypeBox.setEnabled(False)
         self.popUnitTransBox.setEnabled(False)
         self.popLayerBox.setEnabled(False)
+        self.popInterpolationBox.setEnabled(False)
+        self.label_popInterpolation.setEnabled(False)
         self.label_20.setEnabled(False)
         self.label.setEnabled(False)
         self.label_12.setEnabled(False)
@@ -124,6 +139,8 @@ class PluginDialog(QDialog):
         self.popTypeBox.setEnabled(True)
         self.popUnitTransBox.setEnabled(True)
         self.popLayerBox.setEnabled(True)
+        self.popInterpolationBox.setEnabled(True)
+        self.label_popInterpolation.setEnabled(True)
         self.label_20.setEnabled(True)
         self.label.setEnabled(True)
         self.label_12.setEnabled(True)
@@ -152,6 +169,9 @@ class PluginDialog(QDialog):
         # This will define the number in the nanBox in theQGIS GUI as ecnNaN
         return self.ecnNaNBox.value()
 
+    def ecnInterpolationMode(self):
+        return self.ecnInterpolationBox.currentText()
+
     def ecnDelta(self):
         # This defines the number in the deltaMobImmobBox as the difference between values for mobile and immobile
         return self.ecndeltaBox.value()
@@ -164,6 +184,9 @@ class PluginDialog(QDialog):
         # This will define the number in the nanBox in theQGIS GUI as popnNaN (*) maybe useless, question asked to root
         return self.popNaNBox.value()
 
+    def popInterpolationMode(self):
+        return self.popInterpolationBox.currentText()
+
     def popType(self):
         # This will define the number in the nanBox in theQGIS GUI as popnNaN (*) maybe useless, question asked to root
         return self.popTypeBox.value()
@@ -230,6 +253,7 @@ class PluginDialog(QDialog):
         self.popNaNBox.setEnabled(True)
         self.popTypeBox.setEnabled(True)
         self.popUnitTransBox.setEnabled(True)
+        self.popInterpolationBox.setEnabled(True)
         #############################################
 
 
@@ -272,10 +296,12 @@ class PluginDialog(QDialog):
 
 class DAMRasterExport(object):
 
+    # number of cells written at once by export_raster
+    STRIP_CELLS = 1 << 16
+
     def __init__(self, iface):
         self.iface = iface
         self.dialog = None
-        self.cancel = False
         self.previewLayer = None
         self.act = QAction('DAM Raster Export', iface.mainWindow())
         self.act.triggered.connect(self.execDialog)
@@ -343,8 +369,6 @@ class DAMRasterExport(object):
         self.act.setEnabled(False)
         self.dialog.show()
 
-    def scheduleAbort(self):
-        self.cancel = True
     ImportFromPolygon = False
 
     def ImportAreaFromPolygon(self):
@@ -559,7 +583,6 @@ class DAMRasterExport(object):
             QgsProject.instance().removeMapLayer(self.previewLayer)
         self.previewLayer = None
         self.act.setEnabled(True)
-        self.cancel = False
         self.dialog.close()
 
     def execTool(self):
@@ -567,167 +590,184 @@ class DAMRasterExport(object):
         input_layers = {
             'ecn': {
                 'layer': self.dialog.ecnLayer(),
-                'interpol_mode': "nearest neighbor (downscaling/upscaling)",  #  Previously dialog box lucInterpolationMode
+                'interpol_mode': self.dialog.ecnInterpolationMode(),
                 'nan': self.dialog.ecnNaN(),
-                'deltaecn': self.dialog.ecnDelta()
+                'deltaecn': self.dialog.ecnDelta(),
+                'export': self.dialog.mGroupBox_ecn.isChecked()
                 },
             'pop': {
                 'layer': self.dialog.popLayer(),
-                'interpol_mode': "nearest neighbor (downscaling/upscaling)",  # Previously dialog box lucInterpolationMode
+                'interpol_mode': self.dialog.popInterpolationMode(),
                 'nan': self.dialog.popNaN(),
                 'pop_dam_category': self.dialog.popType(),
-                'pop_unittrans': self.dialog.popUnitTrans()
+                'pop_unittrans': self.dialog.popUnitTrans(),
+                'export': self.dialog.mGroupBox_pop.isChecked()
                 }
         }
 
         rasters = self.rasters()  # list of tuples (raster, filename)
         num_cells = sum([r.num_cells() for r, f in rasters])
 
-        if num_cells == 0:
+        # the sampled cells are written once per exported raster type
+        passes = 0
+        if input_layers['ecn']['export']:
+            passes += 2 if input_layers['ecn']['deltaecn'] > 0 else 1
+        if input_layers['pop']['export']:
+            passes += 2
+
+        if num_cells == 0 or passes == 0:
             self.quitDialog()
             return
 
-        if len(rasters) > 1:
-            text = 'Interpolating and exporting %d rasters ...' % len(rasters)
-        else:
-            text = 'Interpolating and exporting raster ...'
-
-        progress = QProgressDialog(text, 'Abort', 0, num_cells, self.iface.mainWindow())
-        progress.setWindowTitle('DAM Exposure Raster Export')
-        progress.canceled.connect(self.scheduleAbort)
-        progress.show()
-
-        for raster, filename in rasters:
-            try:
-                self.export_raster(input_layers, raster, filename, progress)
-            except IOError:
-                QMessageBox.critical(self.iface.mainWindow(), 'I/O Error', 'An I/O error occured during\nraster export to file\n\n%s' % filename)
-                progress.close()
-                self.quitDialog()
-                return
-
-            if self.cancel:
-                progress.close()
-                self.quitDialog()
-                return
+        transforms = CoordinateTransformCache()
+        pop = input_layers['pop']
+        if pop['export'] and pop['layer'] and 'area weighted' in pop['interpol_mode'] \
+                and not transforms.get(self.previewLayer.crs(), pop['layer'].crs()).identity:
+            # cell areas are not preserved by the transformation, neither would be the number of people
+            self.iface.messageBar().pushCritical(
+                'DAM raster Export',
+                'Area weighted resampling needs the population layer in the CRS of the rasters!'
+            )
+            return
+        jobs = [self.exportJob(input_layers, raster, filename, transforms) for raster, filename in rasters]
 
-        progress.close()
+        # the export runs in the background, the dialog is not needed anymore
+        ExportTask('DAM Exposure Raster Export', self.exportRasters, jobs, passes * num_cells,
+                   self.exportFinished).start()
         self.quitDialog()
-        return
 
-    def export_raster(self, input_layers, out_raster, filename, progress=None):
-        trans, interpol, mob_values, pop_type_values, corrected_values = dict(), dict(), dict(), dict(), dict()
+    def exportJob(self, input_layers, out_raster, filename, transforms):
+        """Collects everything needed to export out_raster, so that export_raster touches neither layers nor dialog.
+        The interpolators work on their own data provider clones, as jobs are exported off the GUI thread."""
+        trans, interpol = dict(), dict()
+        # centre of the raster
+        xc = out_raster.xll + 0.5 * out_raster.nc * out_raster.drc
+        yc = out_raster.yll + 0.5 * out_raster.nr * out_raster.drc
         for data_name, items in list(input_layers.items()):
+            dx, dy, angle = out_raster.drc, out_raster.drc, 0.0
             if items['layer']:
-                trans[data_name] = QgsCoordinateTransform(self.previewLayer.crs(), items['layer'].crs(), QgsProject.instance()).transform
+                trans[data_name] = transforms.get(self.previewLayer.crs(), items['layer'].crs())
+                # the cells reduced by upscaling are measured in the CRS of the layer
+                dx, dy, angle = trans[data_name].footprint(xc, yc, dx, dy)
             else:
-                trans[data_name] = lambda p: p
-            interpol[data_name] = RasterInterpolator(items['layer'], 1, 10, 10, items['interpol_mode'],
-                                                     items['nan']).interpolate
-
-
-            # if the dataayer is named ecn and the tick box in the user interface is checked the ecn export will be done.
-            if data_name == 'ecn' and self.dialog.mGroupBox_ecn.isChecked():
-                rastertype_0 = 'ecn'
-                rastertype_1 = 'ecn_immob'
-                rastertype_2 = 'ecn_mob'
-                # Writing the standard raster file for economic immobile damages
-                out_raster.open(filename, input_layers, rastertype_1)
-                counter = 0
-                multiplier = 0
-                for i in range(int(out_raster.num_cells())):
-                    if i == multiplier*out_raster.nc:
-                        multiplier = multiplier + 1
-                        counter = out_raster.num_cells()- multiplier*out_raster.nc
-                    point = out_raster.cell_center(counter)
-
-                    values = {data_name: interpol[data_name](trans[data_name](QgsPointXY(point)))}
-                    out_raster.write_cell(values, rastertype_0)
-                    counter = counter + 1
-                    if progress:
-                        progress.setValue(progress.value() + 1)
-                out_raster.close()
-
-                # writing a raster file as input for the mobile economic impacts.
-                # for that a user-chosen number is added to the land use id - by default this is 1000
-                if self.dialog.ecnDelta() > 0:
-                    # ecn > 0 is a simple solution to create not mobile damage raster. The user just indicates a
-                    # negative number or 0 for the delta and does turn off the generation of a mobile damage raster
-                    out_raster.open(filename, input_layers, rastertype_2)
-                    counter = 0
-                    multiplier = 0
-                    for i in range(int(out_raster.num_cells())):
-                        if i == multiplier * out_raster.nc :
-
-                            multiplier = multiplier + 1
-                            counter = out_raster.num_cells()-multiplier * out_raster.nc
-
-                        point = out_raster.cell_center(counter)
-
-                        values = {data_name: interpol[data_name](trans[data_name](QgsPointXY(point)))}
-
-                        if(values[rastertype_0] != self.dialog.ecnNaNBox.value()):
-                            mob_values[rastertype_0] = values[rastertype_0] + input_layers[rastertype_0]['deltaecn']  # adding the user chosen value to initial immob value
-
-                        out_raster.write_cell(mob_values, rastertype_0)
-                        counter = counter + 1
-                        if progress:
-                            progress.setValue(progress.value() + 1)
-                    out_raster.close()
-
-            elif data_name == 'pop' and self.dialog.mGroupBox_pop.isChecked():
-                rastertype_0 = 'pop'
-                rastertype_1 = 'pop_density'
-                rastertype_2 = 'pop_dam_category'
-                # Writing the standard raster file for population density damages; pop dens
-                out_raster.open(filename, input_layers, rastertype_1)
-                counter = 0
-                multiplier = 0
-                for i in range(int(out_raster.num_cells())):
-                    if i == multiplier * out_raster.nc:
-                        multiplier = multiplier + 1
-                        counter = out_raster.num_cells()-multiplier * out_raster.nc
-                    point = out_raster.cell_center(counter)
-                    values = {data_name: interpol[data_name](trans[data_name](QgsPointXY(point)))}
-                    # values multiplied with correction value entered from user. With this factor the input values are supposed to be transformed to people/m²
-
-                    if values[rastertype_0] == self.dialog.popNaN():
-                        corrected_values[rastertype_0] = values[rastertype_0]
-                    else:
-                        corrected_values[rastertype_0] = values[rastertype_0] * input_layers[rastertype_0]['pop_unittrans']
-
-                    out_raster.write_cell_float(corrected_values, rastertype_0)
-                    counter = counter + 1
-                    if progress:
-                        progress.setValue(progress.value() + 1)
-                out_raster.close()
-
-                # Writing the standard raster file for population density damages; pop category
-                # for that a user-chosen number is added to the land use id - by default this is 1000
-                out_raster.open(filename, input_layers, rastertype_2)
-                counter = 0
-                multiplier = 0
-                for i in range(int(out_raster.num_cells())):
-                    if i == multiplier * out_raster.nc:
-                        multiplier = multiplier + 1
-                        counter = out_raster.num_cells()-multiplier * out_raster.nc
-                    point = out_raster.cell_center(counter)
-                    values = {data_name: interpol[data_name](trans[data_name](QgsPointXY(point)))}
-
-                    if values[rastertype_0] == 0:
-                        pop_type_values[rastertype_0] = 0
+                trans[data_name] = None
+            interpol[data_name] = RasterInterpolator(items['layer'], 1, dx, dy, items['interpol_mode'], items['nan'],
+                                                     clone_provider=True, angle=angle)
+        return {
+            'raster': out_raster,
+            'filename': filename,
+            'input_layers': input_layers,
+            'layer_names': dict((data_name, items['layer'].name() if items['layer'] else None)
+                                for data_name, items in input_layers.items()),
+            'trans': trans,
+            'interpol': interpol
+        }
+
+    def exportRasters(self, jobs, task):
+        """Exports the jobs one after another on the worker thread of task; returns the first job that failed with
+        an I/O error or None."""
+        for job in jobs:
+            try:
+                self.export_raster(job, task.report, task.isCanceled)
+            except IOError:
+                return job
+            if task.isCanceled():
+                break
+        return None
+
+    def exportFinished(self, task):
+        """Reports the outcome of an export task on the GUI thread."""
+        if task.result is not None:
+            QMessageBox.critical(self.iface.mainWindow(), 'I/O Error', 'An I/O error occured during\nraster export to file\n\n%s' % task.result['filename'])
+        else:
+            push_outcome(self.iface, 'DAM Exposure Raster Export', task)
+            if task.exception is None and not task.isCanceled():
+                for job in task.job:
+                    if 'population' not in job:
+                        continue
+                    source, exported = job['population']
+                    if source is None:
+                        msg = 'Population of {}: {:.1f} exported'.format(os.path.basename(job['filename']), exported)
                     else:
-                        pop_type_values[rastertype_0] = input_layers[rastertype_0][rastertype_2]
+                        msg = 'Population of {}: {:.1f} in the source layer, {:.1f} exported'.format(
+                            os.path.basename(job['filename']), source, exported)
+                    self.iface.messageBar().pushInfo('DAM Exposure Raster Export', msg)
+
+    def export_raster(self, job, progress=None, canceled=None):
+        """Writes the raster files of job. Every exported input layer is sampled once, the rasters derived from it
+        are computed from the sampled array (see derived_rasters) and written one after another in strips of rows.
+        progress is called with the number of cells of every written strip, the export stops after the current strip
+        as soon as canceled returns True."""
+        out_raster, filename, input_layers = job['raster'], job['filename'], job['input_layers']
+        trans, interpol = job['trans'], job['interpol']
+        nr, nc = int(out_raster.nr), int(out_raster.nc)
+        strip_rows = max(1, self.STRIP_CELLS // max(1, nc))
 
-                    out_raster.write_cell(pop_type_values, rastertype_0)
-                    counter = counter + 1
-                    if progress:
-                        progress.setValue(progress.value() + 1)
-                out_raster.close()
-            else:
+        for data_name, items in list(input_layers.items()):
+            if not items['export']:
                 continue
 
-        #######################################################################
+            sampled = self.sample_cells(interpol[data_name], trans[data_name], out_raster)
+            if data_name == 'pop':
+                job['population'] = self.population_totals(interpol[data_name], trans[data_name], out_raster, items,
+                                                           sampled)
+            for raster_type, values, write_float in self.derived_rasters(data_name, items, sampled):
+                if canceled and canceled():
+                    return
+                out_raster.open(filename, job['layer_names'], raster_type)
+                complete = False
+                try:
+                    # the file starts with the top row
+                    for stop in range(nr, 0, -strip_rows):
+                        start = max(0, stop - strip_rows)
+                        out_raster.write_array(values[start:stop], data_name, '%f' if write_float else '%.0f')
+                        if progress:
+                            progress((stop - start) * nc)
+                        if canceled is not None and canceled():
+                            break
+                    complete = canceled is None or not canceled()
+                finally:
+                    # a cancelled or failed export leaves no truncated raster file behind
+                    out_raster.close(complete)
+
+    def derived_rasters(self, data_name, items, sampled):
+        """Returns the rasters exported from the values sampled from the input layer data_name as list of tuples
+        (raster type, values, True if written as float).
+
+        ecn: the immobile land use IDs and, if deltaecn > 0, the mobile IDs (immobile ID + deltaecn)
+        pop: the population density converted by pop_unittrans (e.g. to people/m²) and the damage category of the
+        populated cells
+        """
+        nodata = sampled == items['nan']
+        if data_name == 'ecn':
+            rasters = [('ecn_immob', sampled, False)]
+            # a delta <= 0 turns off the generation of the mobile damage raster
+            if items['deltaecn'] > 0:
+                rasters.append(('ecn_mob', np.where(nodata, sampled, sampled + items['deltaecn']), False))
+            return rasters
+        if data_name == 'pop':
+            density = np.where(nodata, sampled, sampled * items['pop_unittrans'])
+            category = np.where(sampled == 0, 0, items['pop_dam_category'])
+            return [('pop_density', density, True), ('pop_dam_category', category, False)]
+        return []
+
+    def population_totals(self, interpolator, transform, out_raster, items, sampled):
+        """Returns the number of people within out_raster according to the population layer and according to the
+        exported densities, as check of the resampling. The first one is None if the layer is in another CRS."""
+        valid = sampled != items['nan']
+        exported = float(sampled[valid].sum()) * items['pop_unittrans'] * out_raster.drc ** 2
+        if transform is None or not transform.identity:
+            return None, exported
+        source = interpolator.integral(out_raster.xll, out_raster.yll, out_raster.xll + out_raster.nc * out_raster.drc,
+                                       out_raster.yll + out_raster.nr * out_raster.drc)
+        return source * items['pop_unittrans'], exported
+
+    def sample_cells(self, interpolator, transform, out_raster):
+        """Interpolates all cell centres of out_raster; returns an array of shape (nr, nc), lowest row first."""
+        xs, ys = out_raster.cell_centers()
+        if transform is not None:
+            xs, ys = transform(xs, ys)
+        return interpolator.sample(xs, ys)
 
     def addRasterBounds(self, id, polygon):
         if type(self.previewLayer) != type(None):
@@ -6,7 +6,11 @@ import os
 import math
 from datetime import datetime
 import tempfile
+import queue
+import threading
 import webbrowser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # QGIS modules
 from qgis.core import *
@@ -16,10 +20,16 @@ from qgis.PyQt.QtGui import *
 from qgis.PyQt.QtWidgets import *
 from qgis.PyQt import uic
 
+# 3rd party modules
+import numpy as np
 
 # promaides modules
-from .interpolate import RasterInterpolator
-from .raster import RasterWriter
+from .bounding import fit_raster, min_area_raster
+from .interpolate import RasterInterpolator, sample_shared
+from .raster import RasterWriter, PolygonRasterizer
+from .sample_cache import SampledGridCache, sample_key
+from .transform import CoordinateTransformCache
+from .tasks import ExportTask, push_outcome
 from .environment import get_ui_path
 from .version import *
 from .utils import *
@@ -63,6 +73,9 @@ class PluginDialog(QDialog):
         self.interpolationBox.addItem('average (upscaling)')
         self.interpolationBox.addItem('max (upscaling)')
         self.interpolationBox.addItem('min (upscaling)')
+        self.interpolationBox.addItem('median (upscaling)')
+        self.interpolationBox.addItem('10th percentile (upscaling)')
+        self.interpolationBox.addItem('90th percentile (upscaling)')
 
         self.stationarytype_box.setExpression('true')
         self.boundaryvalue_box.setExpression('0')
@@ -79,6 +92,7 @@ class PluginDialog(QDialog):
         self.ilmBox.setEnabled(False)
         self.groupBox.setEnabled(False)
         self.ImportButton.setEnabled(False)
+        self.FitButton.setEnabled(False)
         self.roughnessLayerBox.setLayer(None)
         self.initLayerBox.setLayer(None)
         self.BCLayerBox.setLayer(None)
@@ -132,8 +146,10 @@ class PluginDialog(QDialog):
     def UpdateImportButtons(self):
         if self.AreaLayerBox.currentLayer():
             self.ImportButton.setEnabled(True)
+            self.FitButton.setEnabled(True)
         else:
             self.ImportButton.setEnabled(False)
+            self.FitButton.setEnabled(False)
 
 
 
@@ -164,6 +180,15 @@ class PluginDialog(QDialog):
     def demNaN(self):
         return self.demNaNBox.value()
 
+    def demOverviews(self):
+        return self.overviewBox.isChecked()
+
+    def reuseSampledValues(self):
+        return self.cacheBox.isChecked()
+
+    def workers(self):
+        return self.workersBox.value()
+
     def roughnessLayer(self):
         if self.mGroupBox.isChecked():
             return self.roughnessLayerBox.currentLayer()
@@ -296,11 +321,15 @@ class PluginDialog(QDialog):
 class DEMExport(object):
 
     ILM_TMPL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ilm_template.txt')
+    # number of cells processed at once by export_raster
+    STRIP_CELLS = 1 << 20
+    # default number of worker threads shared by the exported rasters and their strips (see the threads box),
+    # 1 exports everything one after another on the main thread
+    WORKERS = os.cpu_count() or 1
 
     def __init__(self, iface):
         self.iface = iface
         self.dialog = None
-        self.cancel = False
         self.previewLayer = None
         self.act = QAction('2D-Floodplain Export', iface.mainWindow())
         self.act.triggered.connect(self.execDialog)
@@ -329,10 +358,13 @@ class DEMExport(object):
         self.dialog.rasterUpdated.connect(self.updateRasterBounds)
         self.dialog.rasterRemoved.connect(self.removeRasterBounds)
         self.dialog.setModal(False)
+        self.dialog.workersBox.setValue(self.WORKERS)
         self.dialog.ExportButton.clicked.connect(self.SaveasPolygon)
         self.dialog.addButton.clicked.connect(self.addNewRasterItem)
         self.dialog.addButton.setAutoDefault(False)
         self.dialog.ImportButton.clicked.connect(self.ImportAreaFromPolygon)
+        self.dialog.FitButton.clicked.connect(self.FitAreaToPolygon)
+        self.dialog.FitButton.setAutoDefault(False)
 
         self.dialog.zoomButton.clicked.connect(self.zoomToRaster)
         self.dialog.zoomButton.setAutoDefault(False)
@@ -370,9 +402,6 @@ class DEMExport(object):
         self.act.setEnabled(False)
         self.dialog.show()
 
-    def scheduleAbort(self):
-        self.cancel = True
-
     ImportFromPolygon = False
 
     def ImportAreaFromPolygon(self):
@@ -380,6 +409,66 @@ class DEMExport(object):
         self.addNewRasterItem()
 
 
+    def FitAreaToPolygon(self):
+        """Adds a raster item per polygon of the area layer, rotated and sized to cover the polygon with the fewest
+        cells of the current column and row size, and reports the share of no data cells saved."""
+        layer = self.dialog.AreaLayerBox.currentLayer()
+        dc, dr = self.dialog.dcBox.value(), self.dialog.drBox.value()
+        if not layer or dc <= 0.0 or dr <= 0.0:
+            self.iface.messageBar().pushCritical('2D-Floodplain Export', 'Column and row size must be positive !')
+            return
+
+        transform = QgsCoordinateTransform(layer.crs(), self.previewLayer.crs(), QgsProject.instance())
+        reports = []
+        for feature in layer.getFeatures():
+            geometry = QgsGeometry(feature.geometry())
+            if geometry.isEmpty():
+                continue
+            geometry.transform(transform)
+            # the rectangle only depends on the convex hull, which GEOS computes quickly for any number of vertices
+            hull = [(p.x(), p.y()) for p in geometry.convexHull().vertices()]
+            xs, ys = np.array(hull).T
+            fit = min_area_raster(xs, ys, dc, dr)
+            box = fit_raster(xs, ys, dc, dr, [0.0])
+
+            angle = math.degrees(fit['angle'])
+            item = self.addRasterItem(fit['xll'], fit['yll'], fit['nr'], fit['nc'], dr, dc, angle)
+            area = geometry.area()
+            reports.append('{}: {:d} x {:d} cells at {:.2f}°, {:.1f} % no data instead of {:.1f} % in the axis-aligned '
+                           'box'.format(item.text(), fit['nc'], fit['nr'], angle,
+                                        100.0 * max(0.0, 1.0 - area / (fit['nc'] * fit['nr'] * dc * dr)),
+                                        100.0 * max(0.0, 1.0 - area / (box['nc'] * box['nr'] * dc * dr))))
+        if reports:
+            self.iface.messageBar().pushInfo('2D-Floodplain Export', '; '.join(reports))
+
+    def addRasterItem(self, xll, yll, nr, nc, dr, dc, angle):
+        """Adds and selects a raster item with the given properties; returns it."""
+        num = self.dialog.listWidget.count() + 1
+        item = QListWidgetItem('raster_{:d}'.format(num))
+        item.setData(PluginDialog.xllRole, xll)
+        item.setData(PluginDialog.yllRole, yll)
+        item.setData(PluginDialog.nrRole, nr)
+        item.setData(PluginDialog.ncRole, nc)
+        item.setData(PluginDialog.drRole, dr)
+        item.setData(PluginDialog.dcRole, dc)
+        item.setData(PluginDialog.angleRole, angle)
+        item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEditable | Qt.ItemIsEnabled)
+
+        self.dialog.removeButton.setEnabled(True)
+        self.dialog.ExportButton.setEnabled(True)
+        self.dialog.zoomButton.setEnabled(True)
+        self.dialog.groupBox.setEnabled(True)
+        for widget in (self.dialog.xllBox, self.dialog.yllBox, self.dialog.pickButton, self.dialog.drBox,
+                       self.dialog.dcBox, self.dialog.nrBox, self.dialog.ncBox, self.dialog.angleBox):
+            widget.setEnabled(True)
+        self.dialog.ilmBox.setEnabled(True)
+
+        self.dialog.rasterAdded.emit(int(num), self.polygon(0.0, 0.0, 100.0, 100.0, 0.0))
+        self.dialog.listWidget.addItem(item)
+        self.dialog.listWidget.setCurrentItem(item)
+        self.saveRasterProperties()
+        return item
+
     def zoomToRaster(self):
 
         item = self.dialog.listWidget.currentItem()
@@ -404,42 +493,8 @@ class DEMExport(object):
                 layer = self.dialog.AreaLayerBox.currentLayer()
                 features = layer.getFeatures()
                 for i, f in enumerate(features):
-                    num = self.dialog.listWidget.count() + 1
-                    item = QListWidgetItem('raster_{:d}'.format(num))
-                    item.setData(PluginDialog.xllRole, f.attribute("xll"))
-                    item.setData(PluginDialog.yllRole, f.attribute("yll"))
-                    item.setData(PluginDialog.nrRole, f.attribute("nr"))
-                    item.setData(PluginDialog.ncRole, f.attribute("nc"))
-                    item.setData(PluginDialog.drRole, f.attribute("dy"))
-                    item.setData(PluginDialog.dcRole, f.attribute("dx"))
-                    item.setData(PluginDialog.angleRole, f.attribute("angle"))
-
-                    item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEditable | Qt.ItemIsEnabled)
-
-                    self.dialog.removeButton.setEnabled(True)
-                    self.dialog.ExportButton.setEnabled(True)
-                    self.dialog.zoomButton.setEnabled(True)
-                    self.dialog.groupBox.setEnabled(True)
-                    ############################################
-                    # raster settings
-                    self.dialog.xllBox.setEnabled(True)
-                    self.dialog.yllBox.setEnabled(True)
-                    self.dialog.pickButton.setEnabled(True)
-                    self.dialog.drBox.setEnabled(True)
-                    self.dialog.dcBox.setEnabled(True)
-                    self.dialog.nrBox.setEnabled(True)
-                    self.dialog.ncBox.setEnabled(True)
-                    self.dialog.ExportButton.setEnabled(True)
-                    self.dialog.angleBox.setEnabled(True)
-                    #############################################
-                    self.dialog.ilmBox.setEnabled(True)
-
-                    polygon = self.polygon(0.0, 0.0, 100.0, 100.0, 0.0)
-                    self.dialog.rasterAdded.emit(int(self.dialog.listWidget.count() + 1), polygon)
-
-                    self.dialog.listWidget.addItem(item)
-                    self.dialog.listWidget.setCurrentItem(item)
-                    self.saveRasterProperties()
+                    self.addRasterItem(f.attribute("xll"), f.attribute("yll"), f.attribute("nr"), f.attribute("nc"),
+                                       f.attribute("dy"), f.attribute("dx"), f.attribute("angle"))
                     if i == layer.featureCount() - 1:
                         self.ImportFromPolygon = False
                         return
@@ -451,45 +506,7 @@ class DEMExport(object):
                 self.ImportFromPolygon = False
                 return
 
-        num = self.dialog.listWidget.count() + 1
-        item = QListWidgetItem('raster_{:d}'.format(num))
-        item.setData(PluginDialog.xllRole, 0.0)
-        item.setData(PluginDialog.yllRole, 0.0)
-        item.setData(PluginDialog.nrRole, 100)
-        item.setData(PluginDialog.ncRole, 100)
-        item.setData(PluginDialog.drRole, 10.0)
-        item.setData(PluginDialog.dcRole, 20.0)
-        item.setData(PluginDialog.angleRole, 0.0)
-
-
-        item.setFlags(Qt.ItemIsSelectable | Qt.ItemIsEditable | Qt.ItemIsEnabled)
-
-        self.dialog.removeButton.setEnabled(True)
-        self.dialog.ExportButton.setEnabled(True)
-        self.dialog.zoomButton.setEnabled(True)
-        self.dialog.groupBox.setEnabled(True)
-        ############################################
-        # raster settings
-        self.dialog.xllBox.setEnabled(True)
-        self.dialog.yllBox.setEnabled(True)
-        self.dialog.pickButton.setEnabled(True)
-        self.dialog.drBox.setEnabled(True)
-        self.dialog.dcBox.setEnabled(True)
-        self.dialog.nrBox.setEnabled(True)
-        self.dialog.ncBox.setEnabled(True)
-        self.dialog.ExportButton.setEnabled(True)
-        self.dialog.angleBox.setEnabled(True)
-        #############################################
-        self.dialog.ilmBox.setEnabled(True)
-
-        polygon = self.polygon(0.0, 0.0, 100.0, 100.0, 0.0)
-        self.dialog.rasterAdded.emit(int(self.dialog.listWidget.count() + 1), polygon)
-
-        self.dialog.listWidget.addItem(item)
-        self.dialog.listWidget.setCurrentItem(item)
-
-        self.saveRasterProperties()
-
+        self.addRasterItem(0.0, 0.0, 100, 100, 10.0, 20.0, 0.0)
 
     def polygon(self, xll, yll, dx, dy, angle):
         poly = [QgsPointXY(xll, yll), QgsPointXY(xll + dx * math.cos(angle), yll + dx * math.sin(angle)),
@@ -607,7 +624,6 @@ class DEMExport(object):
             QgsProject.instance().removeMapLayer(self.previewLayer)
         self.previewLayer = None
         self.act.setEnabled(True)
-        self.cancel = False
         self.dialog.close()
 
     def execTool(self):
@@ -617,7 +633,8 @@ class DEMExport(object):
                 'layer': self.dialog.demLayer(),
                 'band': self.dialog.demBand(),
                 'interpol_mode': self.dialog.demInterpolationMode(),
-                'nan': self.dialog.demNaN()
+                'nan': self.dialog.demNaN(),
+                'overviews': self.dialog.demOverviews()
             },
             'roughn': {
                 'layer': self.dialog.roughnessLayer(),
@@ -640,189 +657,312 @@ class DEMExport(object):
             self.quitDialog()
             return
 
-        if len(rasters) > 1:
-            text = 'Interpolating and exporting %d rasters ...' % len(rasters)
-        else:
-            text = 'Interpolating and exporting raster ...'
+        # invalid boundary conditions are reported before the export starts
+        try:
+            bc = self.boundaryConditions()
+        except ValueError as e:
+            self.iface.messageBar().pushCritical('2D-Floodplain Export', str(e))
+            self.quitDialog()
+            return
 
-        progress = QProgressDialog(text, 'Abort', 0, num_cells, self.iface.mainWindow())
-        progress.setWindowTitle('2D-Floodplain Export')
-        progress.canceled.connect(self.scheduleAbort)
-        progress.show()
+        # the workers are shared out between the rasters and the strips of each raster
+        threads = self.dialog.workers()
+        workers = max(1, min(threads, len(rasters)))
+        strip_workers = max(1, threads // workers)
+        transforms = CoordinateTransformCache()
+        cache = self.dialog.reuseSampledValues()
+        export = {
+            'jobs': [self.exportJob(input_layers, raster, filename, bc, transforms, workers > 1, strip_workers, cache)
+                     for raster, filename in rasters],
+            'workers': workers,
+            'rasters': rasters,
+            'ilm_file': None,
+            'nan': self.dialog.demNaN()
+        }
+        if self.dialog.createIlmFile():
+            export['ilm_file'] = os.path.join(self.dialog.outFolder(), 'project.ilm')
 
-        for raster, filename in rasters:
-            try:
-                self.export_raster(input_layers, raster, filename, progress)
-            except IOError:
-                QMessageBox.critical(self.iface.mainWindow(), 'I/O Error', 'An I/O error occured during\nraster export to file\n\n%s' % filename)
-                progress.close()
-                self.quitDialog()
-                return
+        # the export runs in the background, the dialog is not needed anymore
+        ExportTask('2D-Floodplain Export', self.exportRasters, export, num_cells, self.exportFinished).start()
+        self.quitDialog()
 
-            if self.cancel:
-                progress.close()
-                self.quitDialog()
-                return
+    def exportRasters(self, export, task):
+        """Exports all rasters of export on the worker thread of task; returns the first job that failed with an
+        I/O error or None."""
+        if export['workers'] > 1:
+            failed = self.export_parallel(export['jobs'], export['workers'], task)
+        else:
+            failed = None
+            for job in export['jobs']:
+                try:
+                    self.export_raster(job, task.report, task.isCanceled)
+                except IOError:
+                    failed = job
+                if failed or task.isCanceled():
+                    break
+
+        if failed is None and not task.isCanceled() and export['ilm_file']:
+            self.writeIlmFile(export['ilm_file'], export['rasters'], export['nan'])
+        return failed
+
+    def exportFinished(self, task):
+        """Reports the outcome of an export task on the GUI thread."""
+        if task.result is not None:
+            QMessageBox.critical(self.iface.mainWindow(), 'I/O Error', 'An I/O error occured during\nraster export to file\n\n%s' % task.result['filename'])
+        else:
+            push_outcome(self.iface, '2D-Floodplain Export', task)
 
-        if self.dialog.createIlmFile():
-            path = os.path.join(self.dialog.outFolder(), 'project.ilm')
-            self.writeIlmFile(path, rasters, self.dialog.demNaN())
+    def boundaryConditions(self):
+        """Reads and validates the boundary conditions once per export.
 
-        progress.close()
-        self.quitDialog()
-        return
-
-    def export_raster(self, input_layers, out_raster, filename, progress=None):
-        trans, interpol = dict(), dict()
-        for data_name, items in list(input_layers.items()):
-            if items['layer']:
-                trans[data_name] = QgsCoordinateTransform(self.previewLayer.crs(), items['layer'].crs(), QgsProject.instance()).transform
-            else:
-                trans[data_name] = lambda p: p
-            interpol[data_name] = RasterInterpolator(items['layer'], items['band'], self.dialog.dcBox.value(), self.dialog.drBox.value(), items['interpol_mode'], items['nan']).interpolate
-
-        out_raster.open(filename, input_layers)
-
-        ########################################################################
-        #reading boundary polygon data
-        if self.dialog.mGroupBox_4.isChecked():
-            polygonlayer = self.dialog.BCLayerBox.currentLayer()
-            if polygonlayer:
-                boundarystationary, ok = QgsVectorLayerUtils.getValues(polygonlayer, self.dialog.stationarytype_box.expression(), False)
-                if not ok:
-                    self.iface.messageBar().pushCritical(
-                        '2D-Floodplain Export',
-                        'Invalid expression for stationary boundary condition !'
-                    )
-                    return
-                ##################################################################
-                #getting the id of each attribute field
-                fields = polygonlayer.dataProvider().fields()
-                for f in fields:
-                    if str(f.name())==self.dialog.boundaryvalue_box.currentText():
-                        boundaryvaluefieldid=fields.indexFromName(f.name())
-                    if str(f.name())==self.dialog.stationarytype_box.currentText():
-                        stationarytypefieldid=fields.indexFromName(f.name())
-                    if str(f.name())==self.dialog.boundarytype_box.currentText():
-                        boundarytypefieldid=fields.indexFromName(f.name())
-                #################################################################
-
-                boundaryvalue, ok = QgsVectorLayerUtils.getValues(polygonlayer, self.dialog.boundaryvalue_box.expression(), False)
-                if not ok:
-                    self.iface.messageBar().pushCritical(
-                        '2D-Floodplain Export',
-                        'Invalid expression for boundary condition value !'
-                    )
-                    return
-                boundarytype, ok = QgsVectorLayerUtils.getValues(polygonlayer, self.dialog.boundarytype_box.expression(), False)
-                if not ok:
-                    self.iface.messageBar().pushCritical(
-                        '2D-Floodplain Export',
-                        'Invalid expression for boundary type !'
-                    )
-                    return
-        #######################################################################
-        defaultcellproperties=["false", "false", "0", "point"]
-
-
-        # write cell values
-        for i in range(int(out_raster.num_cells())):
-            point = out_raster.cell_center(i)
-            if self.dialog.mGroupBox_4.isChecked():
-                if polygonlayer:
-                    features_main = polygonlayer.getFeatures()
-                    for poly in features_main:
-                        geom_pol = poly.geometry()
-                        if geom_pol.contains(QgsPointXY(point)) == True:
-
-                            ##########################################################################
-                            #value check
-                            try:
-                                boundarystationarystatus = str(boundarystationary[poly.id()]).lower()
-                            except:
-                                boundarystationarystatus = str(boundarystationary[poly.id()-1]).lower()
-                            if check_true_false(boundarystationarystatus) == 0:
-                                self.iface.messageBar().pushCritical(
-                                    '2D-Floodplain Export',
-                                    'Invalid expression for stationary boundary condition !'
-                                )
-                                self.quitDialog()
-                                return
-
-                            try:
-                                cellboundarytypestatus=str(boundarytype[poly.id()])
-                            except:
-                                cellboundarytypestatus = str(boundarytype[poly.id()-1])
-                            if check_cell_boundary_type(cellboundarytypestatus) == 0:
-                                self.iface.messageBar().pushCritical(
-                                    '2D-Floodplain Export',
-                                    'Invalid expression for boundary type !'
-                                )
-                                self.quitDialog()
-                                return
-                            ##############################################################################
-
-                            boundaryenabledforcell="true"
-                            #############################################################################
-                            #boundary stationary
-                            if fields.indexFromName(self.dialog.stationarytype_box.currentText())==-1:
-                                try:
-                                    cellstationary=str(boundarystationary[poly.id()])
-                                except:
-                                    cellstationary = str(boundarystationary[poly.id()-1])
-                            else:
-                                cellstationary=poly.attributes()[stationarytypefieldid]
-                            #############################################################################
-                            #boundary value
-                            if fields.indexFromName(self.dialog.boundaryvalue_box.currentText())==-1:
-                                try:
-                                    cellboundaryvalue=str(boundaryvalue[poly.id()])
-                                except:
-                                    cellboundaryvalue = str(boundaryvalue[poly.id()-1])
-                            else:
-                                cellboundaryvalue=poly.attributes()[boundaryvaluefieldid]
-                            ###########################################################################
-                            #boundary type
-                            if fields.indexFromName(self.dialog.boundarytype_box.currentText())==-1:
-                                try:
-                                    cellboundarytype=str(boundarytype[poly.id()])
-                                except:
-                                    cellboundarytype = str(boundarytype[poly.id()-1])
-                            else:
-                                cellboundarytype=poly.attributes()[boundarytypefieldid]
-                            ###########################################################################
-                            cellproperties=[boundaryenabledforcell,cellstationary,cellboundaryvalue,cellboundarytype]
-                            break
-                        else:
-                            cellproperties = defaultcellproperties
+        Returns None if no boundary conditions are applied, otherwise a dict with the BC polygon 'geometries', their
+        'crs' and a 'table' holding the formatted cell properties [enabled, stationary, value, type] per polygon.
+        'geometries' is None if the boundary condition of the dialog applies to all cells.
+        Raises a ValueError describing invalid input.
+        """
+        if not self.dialog.mGroupBox_4.isChecked():
+            return None
+
+        polygonlayer = self.dialog.BCLayerBox.currentLayer()
+        if not polygonlayer:
+            cellstationary = self.dialog.stationarytype_box.currentText().strip('\'')
+            if check_true_false(cellstationary) == 0:
+                raise ValueError('Invalid expression for stationary boundary condition !')
+            cellboundaryvalue = self.dialog.boundaryvalue_box.currentText().strip('\'')
+            cellboundarytype = self.dialog.boundarytype_box.currentText().strip('\'')
+            if check_cell_boundary_type(cellboundarytype) == 0:
+                raise ValueError('Invalid expression for boundary type !')
+            return {'geometries': None, 'crs': None,
+                    'table': [["true", cellstationary, cellboundaryvalue, cellboundarytype]]}
+
+        # the values are in the order of the features
+        features = list(polygonlayer.getFeatures())
+        boundarystationary, ok = QgsVectorLayerUtils.getValues(polygonlayer, self.dialog.stationarytype_box.expression(), False)
+        if not ok:
+            raise ValueError('Invalid expression for stationary boundary condition !')
+        boundaryvalue, ok = QgsVectorLayerUtils.getValues(polygonlayer, self.dialog.boundaryvalue_box.expression(), False)
+        if not ok:
+            raise ValueError('Invalid expression for boundary condition value !')
+        boundarytype, ok = QgsVectorLayerUtils.getValues(polygonlayer, self.dialog.boundarytype_box.expression(), False)
+        if not ok:
+            raise ValueError('Invalid expression for boundary type !')
+
+        table, invalid_stationary, invalid_type = [], [], []
+        for poly, stationary, value, bc_type in zip(features, boundarystationary, boundaryvalue, boundarytype):
+            if check_true_false(str(stationary)) == 0:
+                invalid_stationary.append(str(poly.id()))
+            if check_cell_boundary_type(str(bc_type)) == 0:
+                invalid_type.append(str(poly.id()))
+            table.append(["true", str(stationary), str(value), str(bc_type)])
+
+        if invalid_stationary:
+            raise ValueError('Invalid stationary boundary condition in polygon(s) {} !'
+                             .format(', '.join(invalid_stationary[:10]) + (' ...' if len(invalid_stationary) > 10 else '')))
+        if invalid_type:
+            raise ValueError('Invalid boundary type in polygon(s) {} !'
+                             .format(', '.join(invalid_type[:10]) + (' ...' if len(invalid_type) > 10 else '')))
+
+        return {'geometries': [poly.geometry() for poly in features], 'crs': polygonlayer.crs(), 'table': table}
+
+    def exportJob(self, input_layers, out_raster, filename, bc, transforms, parallel=False, strip_workers=1,
+                  cache=False):
+        """Collects everything needed to export out_raster, so that export_raster touches neither layers nor dialog.
+
+        A job holds one sampler (interpolators and coordinate transforms) per strip worker. As jobs are exported off
+        the GUI thread, the interpolators work on their own data provider clones; samplers of parallel exports also
+        get their own coordinate transforms. Input rasters whose pixels the cells of out_raster coincide with are
+        copied instead of interpolated (see RasterInterpolator.aligned_grid). The other inputs are grouped by
+        coordinate transform and source grid; a group, e.g. several bands of one file, is sampled in one pass over
+        shared window reads (see sample_shared). With cache the interpolated values are kept next to the raster
+        file and reused by the next export of the same grid (see SampledGridCache).
+        """
+        crs = self.previewLayer.crs()
+        # centre of the raster
+        half_width, half_height = 0.5 * out_raster.nc * out_raster.dc, 0.5 * out_raster.nr * out_raster.dr
+        xc = out_raster.xll + half_width * out_raster.cosa - half_height * out_raster.sina
+        yc = out_raster.yll + half_height * out_raster.cosa + half_width * out_raster.sina
+
+        samplers = []
+        for i in range(strip_workers):
+            if parallel or strip_workers > 1:
+                transforms = CoordinateTransformCache()
+            trans, interpol, grids = dict(), dict(), dict()
+            for data_name, items in list(input_layers.items()):
+                dx, dy, angle = out_raster.dc, out_raster.dr, out_raster.angle
+                if items['layer']:
+                    trans[data_name] = transforms.get(crs, items['layer'].crs())
+                    # the cells reduced by upscaling are measured in the CRS of the layer
+                    dx, dy, angle = trans[data_name].footprint(xc, yc, dx, dy, angle)
                 else:
-                    boundaryenabledforcell = "true"
-                    cellstationary = self.dialog.stationarytype_box.currentText().strip('\'')
-                    if check_true_false(cellstationary) == 0:
-                        self.iface.messageBar().pushCritical(
-                            '2D-Floodplain Export',
-                            'Invalid expression for stationary boundary condition !'
-                        )
-                        self.quitDialog()
-                        return
-                    cellboundaryvalue = self.dialog.boundaryvalue_box.currentText().strip('\'')
-                    cellboundarytype = self.dialog.boundarytype_box.currentText().strip('\'')
-                    if check_cell_boundary_type(cellboundarytype) == 0:
-                        self.iface.messageBar().pushCritical(
-                            '2D-Floodplain Export',
-                            'Invalid expression for boundary type !'
-                        )
-                        self.quitDialog()
-                        return
-                    cellproperties = [boundaryenabledforcell, cellstationary, cellboundaryvalue, cellboundarytype]
-            else:
-                cellproperties = defaultcellproperties
+                    trans[data_name] = None
+                interpol[data_name] = RasterInterpolator(items['layer'], items['band'], dx, dy,
+                                                         items['interpol_mode'], items['nan'], clone_provider=True,
+                                                         angle=angle, overviews=items.get('overviews', False))
+                if trans[data_name] is not None and trans[data_name].identity:
+                    grids[data_name] = interpol[data_name].aligned_grid(out_raster.xll, out_raster.yll, out_raster.dc,
+                                                                        out_raster.dr, out_raster.angle,
+                                                                        out_raster.nr, out_raster.nc)
+            groups = dict()
+            for data_name in interpol:
+                if grids.get(data_name) is None:
+                    key = (trans[data_name], interpol[data_name].grid_key())
+                    groups.setdefault(key, []).append(data_name)
+            samplers.append({'trans': trans, 'interpol': interpol, 'grids': grids, 'groups': list(groups.values())})
+
+        if bc is not None and bc['geometries'] is not None:
+            rasterizer = PolygonRasterizer(out_raster, bc['geometries'], transforms.get(bc['crs'], crs))
+        else:
+            rasterizer = None
+
+        if cache:
+            # copying aligned pixels is as cheap as reading the cache
+            keys = dict((data_name, sample_key(items['layer'], items, crs, out_raster))
+                        for data_name, items in input_layers.items()
+                        if items['layer'] and samplers[0]['grids'].get(data_name) is None)
+            cache = SampledGridCache(filename, keys, (int(out_raster.nr), int(out_raster.nc)))
+        else:
+            cache = None
+
+        return {
+            'raster': out_raster,
+            'filename': filename,
+            'input_layers': input_layers,
+            'layer_names': dict((data_name, items['layer'].name() if items['layer'] else None)
+                                for data_name, items in input_layers.items()),
+            'samplers': samplers,
+            'rasterizer': rasterizer,
+            'bc': bc,
+            'cache': cache
+        }
+
+    def export_parallel(self, jobs, workers, task):
+        """Exports the jobs of task concurrently in a thread pool.
 
-            values = {data_name: interpol[data_name](trans[data_name](point)) for data_name in list(input_layers.keys())}
-            out_raster.write_cell(values,cellproperties)
+        Cancelling the task stops all workers after their current strip, so does the first failing job. Returns the
+        first job that failed with an I/O error or None.
+        """
+        stop = threading.Event()
+
+        def canceled():
+            return stop.is_set() or task.isCanceled()
+
+        failed = None
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(self.export_raster, job, task.report, canceled): job for job in jobs}
+            for future in as_completed(futures):
+                if future.exception() is not None and failed is None:
+                    failed = futures[future]
+                    stop.set()  # stop the other workers
+                    if not isinstance(future.exception(), IOError):
+                        raise future.exception()
+        return failed
+
+    def export_raster(self, job, progress=None, canceled=None, strip_rows=None):
+        """Exports the raster of job strip by strip; each strip of rows is sampled, labelled, formatted, written
+        and discarded.
+
+        With more than one sampler in job the strips are processed by a thread pool and written in order, with at
+        most one strip per worker waiting to be written. progress is called with the number of cells of every
+        written strip, the export stops as soon as canceled returns True. strip_rows defaults to as many rows as
+        share STRIP_CELLS cells between the workers, which bounds the peak memory independent of the raster size.
+        """
+        out_raster, samplers = job['raster'], job['samplers']
+        nr, nc = int(out_raster.nr), int(out_raster.nc)
+        if strip_rows is None:
+            strip_rows = max(1, self.STRIP_CELLS // (max(1, nc) * len(samplers)))
+        strips = [slice(row, min(row + strip_rows, nr)) for row in range(0, nr, strip_rows)]
+
+        out_raster.open(job['filename'], job['layer_names'])
+        complete = False
+
+        def write(strip):
+            num, chunks = strip
+            out_raster.write_formatted(chunks, num)
             if progress:
-                progress.setValue(progress.value() + 1)
-        out_raster.close()
+                progress(num)
+
+        try:
+            if job['cache'] is not None:
+                job['cache'].open()
+            self.export_strips(job, strips, write, canceled)
+            complete = canceled is None or not canceled()
+        finally:
+            # a cancelled or failed export leaves neither a truncated raster file nor cache files behind
+            if job['cache'] is not None:
+                job['cache'].close(complete)
+            out_raster.close(complete)
+
+    def export_strips(self, job, strips, write, canceled):
+        """Exports the strips of job in order with the samplers of job."""
+        samplers = job['samplers']
+        if len(samplers) == 1:
+            for rows in strips:
+                write(self.export_strip(job, samplers[0], rows))
+                if canceled is not None and canceled():
+                    break
+        else:
+            idle = queue.Queue()
+            for sampler in samplers:
+                idle.put(sampler)
+
+            def export_strip(rows):
+                sampler = idle.get()
+                try:
+                    return self.export_strip(job, sampler, rows)
+                finally:
+                    idle.put(sampler)
+
+            with ThreadPoolExecutor(max_workers=len(samplers)) as pool:
+                pending = deque()
+                for rows in strips:
+                    if canceled is not None and canceled():
+                        break
+                    pending.append(pool.submit(export_strip, rows))
+                    if len(pending) > len(samplers):
+                        write(pending.popleft().result())
+                while pending:
+                    write(pending.popleft().result())
+
+    def export_strip(self, job, sampler, rows):
+        """Samples and formats the cells of a strip of rows; returns the number of cells and the text chunks."""
+        out_raster, trans, interpol, bc = job['raster'], sampler['trans'], sampler['interpol'], job['bc']
+
+        # boundary condition label of the cells
+        xs, ys = out_raster.cell_centers(rows)
+        xs, ys = xs.ravel(), ys.ravel()
+        if job['rasterizer'] is not None:
+            bc_labels = job['rasterizer'].labels(rows).ravel()
+        else:
+            bc_labels = np.full(xs.size, -1 if bc is None else 0)
+
+        # interpolate the values of all cell centres of the strip at once
+        cell_values, coords, cache = {'bc': bc_labels}, {None: (xs, ys)}, job['cache']
+        if cache is not None:
+            for data_name in interpol:
+                values = cache.get(data_name, rows)
+                if values is not None:
+                    cell_values[data_name] = values
+        for data_name, grid in list(sampler['grids'].items()):
+            if grid is not None:
+                # the cells coincide with the source pixels
+                cell_values[data_name] = interpol[data_name].sample_grid(grid, rows).ravel()
+        for data_names in sampler['groups']:
+            data_names = [data_name for data_name in data_names if data_name not in cell_values]
+            if not data_names:
+                continue
+            # layers sharing a CRS share the transformed coordinates, layers sharing a source grid the window reads
+            t = trans[data_names[0]]
+            if t not in coords:
+                coords[t] = t(xs, ys)
+            values = sample_shared([interpol[data_name] for data_name in data_names], *coords[t])
+            cell_values.update(zip(data_names, values))
+            if cache is not None:
+                for data_name, sampled in zip(data_names, values):
+                    cache.put(data_name, rows, sampled)
+
+        # the element numbers continue the rows above
+        index = rows.start * int(out_raster.nc)
+        return xs.size, out_raster.format_block(cell_values, None if bc is None else bc['table'], index)
 
     def addRasterBounds(self, id, polygon):
         if type(self.previewLayer) != type(None):
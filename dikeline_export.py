@@ -9,6 +9,7 @@ from qgis.PyQt import uic
 
 # promaides modules
 from .interpolate import RasterInterpolator
+from .tasks import ExportTask, output_file, push_outcome
 from .environment import get_ui_path
 
 UI_PATH = get_ui_path('ui_dikeline_export.ui')
@@ -137,7 +138,6 @@ class DikelineExport(object):
     def __init__(self, iface):
         self.iface = iface
         self.dialog = None
-        self.cancel = False
         self.act = QAction('Dikeline Export', iface.mainWindow())
         self.act.triggered.connect(self.execDialog)
 
@@ -166,13 +166,9 @@ class DikelineExport(object):
         self.dialog.label_field_box.setFilters(QgsFieldProxyModel.String)
         self.dialog.show()
 
-    def scheduleAbort(self):
-        self.cancel = True
-
     def quitDialog(self):
         self.dialog = None
         self.act.setEnabled(True)
-        self.cancel = False
 
     def execTool(self):
         filename = self.dialog.filename_edit.text()
@@ -210,7 +206,8 @@ class DikelineExport(object):
             raster_band = self.dialog.raster_band_box.value()
             method = self.dialog.method_box.currentText()
             nan = self.dialog.nan_box.value()
-            interpolator = RasterInterpolator(raster_layer, raster_band, 10, 10,  method, nan)
+            interpolator = RasterInterpolator(raster_layer, raster_band, 10, 10,  method, nan, clone_provider=True,
+                                              cache_tiles=True)
             z_values = None
         else:
             interpolator = None
@@ -223,15 +220,38 @@ class DikelineExport(object):
                 self.quitDialog()
                 return
 
-        progress = QProgressDialog('Exporting dikeline ...', 'Abort', 0, feature_count, self.iface.mainWindow())
-        progress.setWindowTitle('Dikeline Export')
-        progress.canceled.connect(self.scheduleAbort)
-        progress.show()
+        # the labels are checked before anything is written
+        for label in labels:
+            if not label:
+                self.iface.messageBar().pushCritical(
+                    'Dikeline Export',
+                    'Empty label found! Aborting ...')
+                self.quitDialog()
+                return
+
+        job = {
+            'filename': filename,
+            'source_name': line_layer.sourceName(),
+            'raster_name': raster_layer.name() if interpolate_z else None,
+            'lines': [[(p.x(), p.y()) for p in feature.geometry().vertices()] for feature in features],
+            # erase whitespace before
+            'labels': [label.replace(' ', '_') for label in labels],
+            'z_values': z_values,
+            'interpolator': interpolator
+        }
+
+        # the export runs in the background, the dialog is not needed anymore
+        ExportTask('Dikeline Export', self.exportLines, job, feature_count,
+                   lambda task: push_outcome(self.iface, 'Dikeline Export', task)).start()
+        self.quitDialog()
+
+    def exportLines(self, job, task):
+        """Writes the dikeline file of job on the worker thread of task."""
+        interpolator = job['interpolator']
 
-        # iterate over polyline features
-        with open(filename, 'w') as dikeline_file:
+        # iterate over polylines
+        with output_file(job['filename'], task) as dikeline_file:
 
-            index = 0
             dikeline_file.write('########################################################################\n')
             dikeline_file.write('# This file was automatically generated by ProMaiDes Dikeline '
                                'Export-QGIS-Plugin Version {version_1} \n'.format(version_1=VERSION))
@@ -239,11 +259,11 @@ class DikelineExport(object):
             now = datetime.now()
             dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
             dikeline_file.write('# Generated at {dt_string_1} '.format(dt_string_1=dt_string))
-            dikeline_file.write('from layer {filename_1} \n'.format(filename_1=line_layer.sourceName()))
-            if interpolate_z:
-                dikeline_file.write('#  based on height raster (DEM) {}  \n'.format(raster_layer.name()))
+            dikeline_file.write('from layer {filename_1} \n'.format(filename_1=job['source_name']))
+            if interpolator is not None:
+                dikeline_file.write('#  based on height raster (DEM) {}  \n'.format(job['raster_name']))
             dikeline_file.write('# Comments are marked with #\n')
-            dikeline_file.write('# Number of lines in file: {}  \n'.format(feature_count))
+            dikeline_file.write('# Number of lines in file: {}  \n'.format(len(job['lines'])))
             dikeline_file.write('#\n')
             dikeline_file.write('# Explanation of data:\n')
             dikeline_file.write('#  Start the dikeline with !BEGIN and end it with !END per line; in between are: \n')
@@ -257,65 +277,27 @@ class DikelineExport(object):
             dikeline_file.write('#    $NO_POLYLINES = 2 #number of lines in file (see above)\n')
             dikeline_file.write('#  </SET>	\n')
             dikeline_file.write('########################################################################\n\n')
-            for feature, label in zip(features, labels):
-
-                line = []
-                buff = feature.geometry()
-                for p in buff.vertices():
-                    line.append(p)
-
-
-                if not label:
-                    self.iface.messageBar().pushCritical(
-                        'Dikeline Export',
-                        'Empty label found! Aborting ...')
-                    dikeline_file.write('Error during dikeline export\n '
-                                         'Empty label found! Aborting...\n')
-
-                    self.quitDialog()
-                    return
-
-                # erase whitespace before
-                label = label.replace(' ', '_')
-                # label contains whitespaces
-                if len(label.split(' ')) > 1:
-                    self.iface.messageBar().pushCritical(
-                        'Dikeline Export',
-                        'Labels must not contain whitespaces! Aborting ...'
-                    )
-                    self.quitDialog()
-                    return
-
-                if self.cancel:
+            for index, (line, label) in enumerate(zip(job['lines'], job['labels'])):
+
+                if task.isCanceled():
                     break
 
                 dikeline_file.write('!BEGIN\n')
                 dikeline_file.write('{0:d} {1} {2:d}\n'.format(index, str(label), len(line)))
 
+                if interpolator is not None:
+                    z_line = interpolator.sample([x for x, y in line], [y for x, y in line]).tolist()
+
                 # iterate over points in polyline
-                for point in line:
+                for j, (x, y) in enumerate(line):
 
-                    if interpolate_z:
-                        z = interpolator.interpolate(QgsPointXY(point))
+                    if interpolator is not None:
+                        z = z_line[j]
                     else:
-                        z = z_values[index]
+                        z = job['z_values'][index]
 
-                    dikeline_file.write('{x} {y} {z}\n'.format(x=point.x(), y=point.y(), z=z))
+                    dikeline_file.write('{x} {y} {z}\n'.format(x=x, y=y, z=z))
 
                 dikeline_file.write('!END\n\n')
 
-                index += 1
-                progress.setValue(index)
-
-                if self.cancel:
-                    break
-
-        progress.close()
-
-        #if not self.cancel:
-        self.iface.messageBar().pushInfo(
-            'Dikeline Export',
-            'Export finished successfully!'
-           )
-
-        self.quitDialog()
+                task.report()
@@ -2,25 +2,486 @@
 
 """
 import math
-from qgis.core import *
+import os
+import re
+import threading
+import warnings
+from collections import OrderedDict
+
+# 3rd party modules
+import numpy as np
 
-try:
-    from scipy import interpolate
-    ScipyAvailable = True
-except ImportError:
-    ScipyAvailable = False
+from qgis.core import *
 
 # QGIS modules
 from qgis.core import QgsRaster, QgsRectangle
 
 
-def isin(value, array2d):
-    return bool([x for x in array2d if value in x])
+# numpy equivalents of the QGIS raster data types
+_NUMPY_DTYPES = {
+    Qgis.Byte: np.uint8,
+    Qgis.UInt16: np.uint16,
+    Qgis.Int16: np.int16,
+    Qgis.UInt32: np.uint32,
+    Qgis.Int32: np.int32,
+    Qgis.Float32: np.float32,
+    Qgis.Float64: np.float64,
+}
+
+
+def block_to_array(block):
+    """Converts a QgsRasterBlock into a float array; no data cells are set to NaN."""
+    dtype = _NUMPY_DTYPES.get(block.dataType())
+    if dtype is None:
+        raise ValueError('unsupported raster data type {}'.format(block.dataType()))
+
+    values = np.frombuffer(bytes(block.data()), dtype=dtype)
+    values = values.reshape(block.height(), block.width()).astype(np.float64)
+    if block.hasNoDataValue():
+        values[values == block.noDataValue()] = np.nan
+    return values
+
+
+def _take(window, rows, cols):
+    """Fancy indexing into window; indices outside of the window yield NaN."""
+    valid = (rows >= 0) & (rows < window.shape[0]) & (cols >= 0) & (cols < window.shape[1])
+    values = np.full(rows.shape, np.nan)
+    values[valid] = window[rows[valid], cols[valid]]
+    return values
+
+
+def _cubic_weights(t):
+    """Weights of the cubic convolution kernel (Keys, a=-0.5) for the neighbours -1, 0, 1, 2."""
+    return ((-0.5 * t + 1.0) * t - 0.5) * t, \
+           (1.5 * t - 2.5) * t * t + 1.0, \
+           ((-1.5 * t + 2.0) * t + 0.5) * t, \
+           (0.5 * t - 0.5) * t * t
+
+
+def sample_nearest(window, u, v):
+    """Nearest neighbour sampling of window at the fractional pixel coordinates (u=column, v=row)."""
+    return _take(window, np.floor(v).astype(np.intp), np.floor(u).astype(np.intp))
+
+
+def sample_linear(window, u, v):
+    """Bi-linear sampling between the four surrounding pixel centres; NaN if one of them is no data."""
+    u = u - 0.5
+    v = v - 0.5
+    c = np.floor(u).astype(np.intp)
+    r = np.floor(v).astype(np.intp)
+    tx = u - c
+    ty = v - r
+    return ((1.0 - tx) * (1.0 - ty) * _take(window, r, c)
+            + tx * (1.0 - ty) * _take(window, r, c + 1)
+            + (1.0 - tx) * ty * _take(window, r + 1, c)
+            + tx * ty * _take(window, r + 1, c + 1))
+
+
+def sample_cubic(window, u, v):
+    """Bi-cubic (cubic convolution) sampling of the 4x4 surrounding pixel centres.
+
+    Points with no data among these neighbours, e.g. along the raster border, fall back to bi-linear and then to
+    nearest neighbour sampling.
+    """
+    uc = u - 0.5
+    vc = v - 0.5
+    c = np.floor(uc).astype(np.intp)
+    r = np.floor(vc).astype(np.intp)
+    wx = _cubic_weights(uc - c)
+    wy = _cubic_weights(vc - r)
+    values = np.zeros(u.shape)
+    for i in range(4):
+        row = np.zeros(u.shape)
+        for j in range(4):
+            row += wx[j] * _take(window, r + i - 1, c + j - 1)
+        values += wy[i] * row
+
+    for fallback in (sample_linear, sample_nearest):
+        missing = np.flatnonzero(np.isnan(values))
+        if missing.size == 0:
+            break
+        values[missing] = fallback(window, u[missing], v[missing])
+    return values
+
+
+# maximum size of the count tables of nanmode
+MAX_MODE_BINS = 1 << 24
+
+
+def nanmode(values, axis=-1, weights=None):
+    """Most frequent value along axis ignoring NaN, for categorical rasters such as land use IDs.
+
+    The occurrences are counted with one bincount over all rows; with weights (e.g. covered areas) the value with
+    the largest total weight wins. Ties go to the smallest value, rows without valid values are NaN.
+    """
+    values = np.moveaxis(np.asarray(values, dtype=np.float64), axis, -1)
+    shape = values.shape[:-1]
+    values = values.reshape(-1, values.shape[-1])
+    valid = ~np.isnan(values)
+    if weights is not None:
+        weights = np.moveaxis(np.asarray(weights, dtype=np.float64), axis, -1).reshape(values.shape)
+        valid &= weights > 0.0
+
+    modes = np.full(values.shape[0], np.nan)
+    rows, __ = np.nonzero(valid)
+    if rows.size == 0:
+        return modes.reshape(shape)
+    categories, codes = np.unique(values[valid], return_inverse=True)
+    if weights is not None:
+        weights = weights[valid]
+
+    # the counts of a chunk of rows are a (rows, categories) table
+    step = max(1, MAX_MODE_BINS // categories.size)
+    bounds = np.searchsorted(rows, np.arange(0, values.shape[0] + step, step))
+    for i, start in enumerate(range(0, values.shape[0], step)):
+        part = slice(bounds[i], bounds[i + 1])
+        num = min(step, values.shape[0] - start)
+        counts = np.bincount((rows[part] - start) * categories.size + codes[part],
+                             weights=None if weights is None else weights[part],
+                             minlength=num * categories.size).reshape(num, categories.size)
+        found = counts.max(axis=1) > 0
+        modes[start:start + num][found] = categories[counts.argmax(axis=1)[found]]
+    return modes.reshape(shape)
+
+# reductions of the source pixels covered by an output cell, no data pixels (NaN) are ignored
+REDUCTIONS = {
+    'average': np.nanmean,
+    'max': np.nanmax,
+    'min': np.nanmin,
+    'median': np.nanmedian,
+    'majority': nanmode,
+    'dominant area': nanmode,
+}
+
+# e.g. "90th percentile (upscaling)"
+PERCENTILE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(?:st|nd|rd|th)? percentile')
+
+
+def reduction_for(method):
+    """Returns the reduction function named in method or None.
+
+    The name is the method up to its parenthesized note, e.g. "min" of "min (upscaling)"; it has to match exactly,
+    as some names are contained in others ("dominant area" contains "min").
+    """
+    match = PERCENTILE_PATTERN.search(method)
+    if match:
+        q = float(match.group(1))
+        return lambda values, axis: np.nanpercentile(values, q, axis=axis)
+    return REDUCTIONS.get(method.split('(')[0].strip())
+
+
+class WindowReducer(object):
+
+    # maximum number of source pixels gathered at once
+    MAX_GATHER_CELLS = 1 << 22
+
+    def __init__(self, reduction, dx, dy, angle, xres, yres):
+        """Array kernel reducing the source pixels whose centres lie in the footprint of an output cell.
+
+        The footprint is a dx by dy rectangle around each point, rotated by angle. Pixels outside of the raster
+        and no data pixels are ignored; cells covering only such pixels are no data. Cells smaller than a pixel
+        fall back to the pixel containing their centre.
+
+        Parameters
+        ----------
+        reduction: callable
+            reduction(values, axis) ignoring NaN, e.g. numpy.nanmean
+        dx: float
+            width of the output cells along their columns
+        dy: float
+            height of the output cells along their rows
+        angle: float
+            counter-clockwise rotation of the output grid in radians
+        xres: float
+            source pixel width
+        yres: float
+            source pixel height
+        """
+        self.reduction = reduction
+        self.xres, self.yres = xres, yres
+        self.hdx, self.hdy = 0.5 * dx, 0.5 * dy
+        self.cosa, self.sina = math.cos(angle), math.sin(angle)
+
+        # half extents of the bounding box of a footprint in pixels
+        self.hu = (abs(self.cosa) * self.hdx + abs(self.sina) * self.hdy) / xres
+        self.hv = (abs(self.sina) * self.hdx + abs(self.cosa) * self.hdy) / yres
+        self.ncols = int(math.floor(2.0 * self.hu)) + 2
+        self.nrows = int(math.floor(2.0 * self.hv)) + 2
+        # neighbouring pixels needed around a point
+        self.margin = int(math.ceil(max(self.hu, self.hv))) + 1
+
+    def __call__(self, window, u, v):
+        values = np.empty(u.shape)
+        step = max(1, self.MAX_GATHER_CELLS // (self.nrows * self.ncols))
+        for start in range(0, u.size, step):
+            part = slice(start, start + step)
+            values[part] = self.reduce(window, u[part], v[part])
+        return values
+
+    def reduce(self, window, u, v):
+        # candidate pixels: the bounding box of each footprint, shape (points, nrows, ncols)
+        cols = np.floor(u - self.hu).astype(np.intp)[:, np.newaxis] + np.arange(self.ncols)
+        rows = np.floor(v - self.hv).astype(np.intp)[:, np.newaxis] + np.arange(self.nrows)
+        cols = np.broadcast_to(cols[:, np.newaxis, :], (u.size, self.nrows, self.ncols))
+        rows = np.broadcast_to(rows[:, :, np.newaxis], (u.size, self.nrows, self.ncols))
+
+        # pixel centres relative to the points in the axes of the output grid; the footprint is half-open,
+        # so that pixels on the border between two aligned cells are counted once
+        ex = (cols + 0.5 - u[:, np.newaxis, np.newaxis]) * self.xres
+        ey = (v[:, np.newaxis, np.newaxis] - rows - 0.5) * self.yres
+        a = ex * self.cosa + ey * self.sina
+        b = ey * self.cosa - ex * self.sina
+        inside = (a >= -self.hdx) & (a < self.hdx) & (b >= -self.hdy) & (b < self.hdy)
+
+        pixels = np.where(inside, _take(window, rows, cols), np.nan)
+        with warnings.catch_warnings():
+            # cells without valid pixels are no data
+            warnings.simplefilter('ignore', RuntimeWarning)
+            values = self.reduction(pixels.reshape(u.size, -1), axis=1)
+
+        small = ~inside.any(axis=(1, 2))
+        if small.any():
+            values[small] = sample_nearest(window, u[small], v[small])
+        return values
+
+
+class AreaAverager(object):
+
+    def __init__(self, dx, dy, xres, yres, conserve=False):
+        """Array kernel averaging the source raster over the axis-aligned dx by dy rectangle around each point.
+
+        Every pixel is weighted with the fraction of its area inside the rectangle, no data pixels and pixels
+        outside of the raster are left out. The integral images of the values and of the valid pixels are computed
+        once per window, after which each mean costs four lookups per image independent of the upscaling factor.
+
+        Parameters
+        ----------
+        dx: float
+        dy: float
+        xres: float
+            source pixel width
+        yres: float
+            source pixel height
+        conserve: bool
+            divide by the whole rectangle instead of its valid part, so that the means of densities (e.g. people/m²)
+            times the cell area add up to the integral of the source raster
+        """
+        self.hu = 0.5 * dx / xres
+        self.hv = 0.5 * dy / yres
+        self.conserve = conserve
+        # neighbouring pixels needed around a point
+        self.margin = int(math.ceil(max(self.hu, self.hv))) + 1
+
+    def __call__(self, window, u, v):
+        valid = ~np.isnan(window)
+        if not valid.any():
+            return np.full(u.shape, np.nan)
+
+        # the values are integrated relative to their mean, which keeps the sums small
+        offset = window[valid].mean()
+        values = summed_area_table(np.where(valid, window - offset, 0.0))
+        counts = summed_area_table(valid.astype(np.float64))
+
+        rows, cols = window.shape
+        u0, u1 = np.clip(u - self.hu, 0, cols), np.clip(u + self.hu, 0, cols)
+        v0, v1 = np.clip(v - self.hv, 0, rows), np.clip(v + self.hv, 0, rows)
+
+        def integral(table):
+            return (_integral_at(table, u1, v1) - _integral_at(table, u0, v1)
+                    - _integral_at(table, u1, v0) + _integral_at(table, u0, v0))
+
+        area = integral(counts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.conserve:
+                means = (integral(values) + offset * area) / (4.0 * self.hu * self.hv)
+            else:
+                means = integral(values) / area + offset
+        # cells without valid pixels are no data
+        means[area <= 1e-9] = np.nan
+        return means
+
+
+class DominantArea(object):
+
+    # maximum number of source pixels gathered at once
+    MAX_GATHER_CELLS = 1 << 22
+
+    def __init__(self, dx, dy, xres, yres):
+        """Array kernel selecting the category covering the largest area of the axis-aligned dx by dy rectangle
+        around each point.
+
+        Every pixel counts with the area of its overlap with the rectangle, which is the product of its overlaps
+        along the columns and the rows. No data pixels and pixels outside of the raster are left out.
+
+        Parameters
+        ----------
+        dx: float
+        dy: float
+        xres: float
+            source pixel width
+        yres: float
+            source pixel height
+        """
+        self.hu = 0.5 * dx / xres
+        self.hv = 0.5 * dy / yres
+        self.ncols = int(math.floor(2.0 * self.hu)) + 2
+        self.nrows = int(math.floor(2.0 * self.hv)) + 2
+        # neighbouring pixels needed around a point
+        self.margin = int(math.ceil(max(self.hu, self.hv))) + 1
+
+    def __call__(self, window, u, v):
+        values = np.empty(u.shape)
+        step = max(1, self.MAX_GATHER_CELLS // (self.nrows * self.ncols))
+        for start in range(0, u.size, step):
+            part = slice(start, start + step)
+            values[part] = self.reduce(window, u[part], v[part])
+        return values
+
+    def reduce(self, window, u, v):
+        # candidate pixels and their overlaps with the rectangles, per axis
+        cols = np.floor(u - self.hu).astype(np.intp)[:, np.newaxis] + np.arange(self.ncols)
+        rows = np.floor(v - self.hv).astype(np.intp)[:, np.newaxis] + np.arange(self.nrows)
+        wx = np.minimum(cols + 1, (u + self.hu)[:, np.newaxis]) - np.maximum(cols, (u - self.hu)[:, np.newaxis])
+        wy = np.minimum(rows + 1, (v + self.hv)[:, np.newaxis]) - np.maximum(rows, (v - self.hv)[:, np.newaxis])
+        weights = np.clip(wy, 0.0, None)[:, :, np.newaxis] * np.clip(wx, 0.0, None)[:, np.newaxis, :]
+
+        shape = (u.size, self.nrows, self.ncols)
+        pixels = _take(window, np.broadcast_to(rows[:, :, np.newaxis], shape),
+                       np.broadcast_to(cols[:, np.newaxis, :], shape))
+        return nanmode(pixels.reshape(u.size, -1), axis=1, weights=weights.reshape(u.size, -1))
+
+
+def summed_area_table(array):
+    """Integral image of array with a leading row and column of zeros, shape (rows + 1, cols + 1)."""
+    table = np.zeros((array.shape[0] + 1, array.shape[1] + 1))
+    np.cumsum(array, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def _integral_at(table, u, v):
+    """Integral from the window origin to the fractional pixel coordinates (u, v); as the raster is piecewise
+    constant, this is the bi-linear interpolation of its summed area table."""
+    c = np.minimum(np.floor(u).astype(np.intp), table.shape[1] - 2)
+    r = np.minimum(np.floor(v).astype(np.intp), table.shape[0] - 2)
+    tx = u - c
+    ty = v - r
+    return ((1.0 - tx) * (1.0 - ty) * table[r, c] + tx * (1.0 - ty) * table[r, c + 1]
+            + (1.0 - tx) * ty * table[r + 1, c] + tx * ty * table[r + 1, c + 1])
+
+
+class TileCache(object):
+
+    # edge length of the cached tiles in source pixels
+    TILE_SIZE = 256
+
+    def __init__(self, budget):
+        """Least recently used cache of source raster tiles, shared by the interpolators between threads and runs.
+
+        Parameters
+        ----------
+        budget: int
+            memory budget in bytes, the least recently used tiles are dropped beyond it
+        """
+        self.budget = budget
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, read):
+        """Returns the tile stored under key; on a miss it is read with read() and stored."""
+        with self.lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return tile
+            self.misses += 1
+
+        tile = read()
+        with self.lock:
+            if key not in self.tiles:
+                self.tiles[key] = tile
+                self.size += tile.nbytes
+                while self.size > self.budget and len(self.tiles) > 1:
+                    __, dropped = self.tiles.popitem(last=False)
+                    self.size -= dropped.nbytes
+        return tile
+
+    def stats(self):
+        """Returns the hits, misses, number of tiles and bytes of the cache."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'tiles': len(self.tiles), 'bytes': self.size}
+
+    def clear(self):
+        with self.lock:
+            self.tiles.clear()
+            self.size = 0
+            self.hits = 0
+            self.misses = 0
+
+
+# tiles of all interpolators created with cache_tiles=True
+TILE_CACHE = TileCache(256 * 1024 * 1024)
+
+
+def sample_shared(interpolators, xs, ys):
+    """Interpolates several rasters of the same source grid (equal grid_key(), e.g. bands of one file) at the same
+    points.
+
+    The windows around the points are computed once and read once per band, all kernels work on these reads.
+    Interpolators without a raster layer yield their no data value.
+
+    Returns
+    -------
+    list of numpy.ndarray
+        interpolated values per interpolator, see RasterInterpolator.sample
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    group = [interpolator for interpolator in interpolators if interpolator.dataProv is not None]
+    if len(group) > 1 and len(set(interpolator.grid_key() for interpolator in group)) > 1:
+        raise ValueError('interpolators of different source grids cannot share their reads')
+
+    values = [np.full(xs.size, np.nan) for interpolator in group]
+    if group:
+        lead = group[0]
+        u = (xs.ravel() - lead.myExtent.xMinimum()) / lead.xres
+        v = (lead.myExtent.yMaximum() - ys.ravel()) / lead.yres
+        finite = np.flatnonzero(np.isfinite(u) & np.isfinite(v))
+        if finite.size:
+            lead._sample_windows(group, u, v, finite, values)
+
+    results = []
+    for interpolator in interpolators:
+        if interpolator.dataProv is None:
+            results.append(np.full(xs.shape, np.nan if interpolator.noDataValue is None else interpolator.noDataValue))
+        else:
+            band_values = values[group.index(interpolator)]
+            band_values[np.isnan(band_values)] = interpolator.noDataValue
+            results.append(band_values.reshape(xs.shape))
+    return results
 
 
 class RasterInterpolator(object):
 
-    def __init__(self, raster_layer, band, requested_dx, requested_dy, method, nan=None):
+    # maximum number of source pixels read in one window by sample() and sample_grid()
+    MAX_WINDOW_CELLS = 4096 * 4096
+
+    # tolerance of the grid alignment check in source pixels
+    ALIGN_TOLERANCE = 1e-6
+
+    # array kernels and the number of neighbouring pixels they need around a point
+    KERNELS = {
+        'nearest': (sample_nearest, 0),
+        'linear': (sample_linear, 1),
+        'cubic': (sample_cubic, 2),
+    }
+
+    def __init__(self, raster_layer, band, requested_dx, requested_dy, method, nan=None, clone_provider=False,
+                 angle=0.0, cache_tiles=False, overviews=False):
         """
 
         Parameters
@@ -29,9 +490,23 @@ class RasterInterpolator(object):
         band: int
         method: str
         nan: float or None
+        clone_provider: bool
+            work on a clone of the data provider, so that the interpolator can be used in another thread
+        angle: float
+            counter-clockwise rotation of the output grid in radians, rotates the cells reduced by the upscaling
+            methods
+        cache_tiles: bool
+            read the source raster through TILE_CACHE, for tools sampling scattered points (e.g. along lines)
+            again and again
+        overviews: bool
+            read the coarsest existing overview of the source raster that is still finer than the requested cells,
+            for nearest neighbor and average upscaling only
         """
+        self.tile_cache = None
         if raster_layer:
             self.dataProv = raster_layer.dataProvider()
+            if clone_provider:
+                self.dataProv = self.dataProv.clone()
             self.interpolMethod = method
             self.outputdx = requested_dx
             self.outputdy = requested_dy
@@ -49,26 +524,286 @@ class RasterInterpolator(object):
             self.myExtent = self.dataProv.extent()
             self.theWidth = self.dataProv.xSize()
             self.theHeight = self.dataProv.ySize()
+            self.xres = self.myExtent.width() / self.theWidth
+            self.yres = self.myExtent.height() / self.theHeight
+            if overviews and ('nearest' in method or 'average' in method):
+                # blocks requested at the resolution of an overview are read from it by the provider
+                xdim, ydim = self.overview(requested_dx, requested_dy)
+                if xdim < self.theWidth:
+                    self.theWidth, self.theHeight = xdim, ydim
+                    self.xres = self.myExtent.width() / self.theWidth
+                    self.yres = self.myExtent.height() / self.theHeight
+            if cache_tiles:
+                # a modified source file must not be served from tiles of its former version
+                uri = self.dataProv.dataSourceUri()
+                path = uri.split('|')[0]
+                mtime = os.path.getmtime(path) if os.path.isfile(path) else None
+                self.tile_cache = TILE_CACHE
+                self.tile_key = (uri, mtime, band, self.theWidth)
+            self.kernel = None
+            self.reduction = reduction_for(method)
+            for name, kernel in self.KERNELS.items():
+                if name in method:
+                    self.kernel = kernel
             if 'nearest' in method:
                 self.interpolate = lambda point: self._nearest(point)
             elif "linear" in method:
                 self.interpolate = lambda point: self._linear(point)
             elif "cubic" in method:
-                self.interpolate = lambda point : self._bicubic(point)
-            elif "average" in method:
-                self.interpolate = lambda point : self._average(point)
-            elif "max" in method:
-                self.interpolate = lambda point : self._max(point)
-            elif "min" in method:
-                self.interpolate = lambda point : self._min(point)
+                self.interpolate = lambda point: self._sample_point(point)
+            elif 'area weighted' in method:
+                if abs(math.sin(2.0 * angle)) >= 1e-9:
+                    raise ValueError('area weighted resampling needs an axis-aligned output grid')
+                if abs(math.sin(angle)) > 0.5:
+                    requested_dx, requested_dy = requested_dy, requested_dx
+                reducer = AreaAverager(requested_dx, requested_dy, self.xres, self.yres, conserve=True)
+                self.kernel = (reducer, reducer.margin)
+                self.interpolate = lambda point: self._sample_point(point)
+            elif self.reduction is not None:
+                if ('average' in method or 'dominant area' in method) and abs(math.sin(2.0 * angle)) < 1e-9:
+                    # the cells are axis-aligned, right angles just swap their sides
+                    if abs(math.sin(angle)) > 0.5:
+                        requested_dx, requested_dy = requested_dy, requested_dx
+                    if 'average' in method:
+                        reducer = AreaAverager(requested_dx, requested_dy, self.xres, self.yres)
+                    else:
+                        reducer = DominantArea(requested_dx, requested_dy, self.xres, self.yres)
+                else:
+                    # rotated cells reduce the pixels whose centres they contain, the dominant area becomes the
+                    # majority of these pixels
+                    reducer = WindowReducer(self.reduction, requested_dx, requested_dy, angle,
+                                            self.xres, self.yres)
+                self.kernel = (reducer, reducer.margin)
+                self.interpolate = lambda point: self._sample_point(point)
             else:
-                raise ValueError('unsupported interpolation method "{}"'.format(methodhi))
+                raise ValueError('unsupported interpolation method "{}"'.format(method))
+            if self.tile_cache is not None:
+                # single points are served from the cached tiles as well
+                self.interpolate = lambda point: self._sample_point(point)
         else:
+            self.dataProv = None
+            self.noDataValue = nan
             self.interpolate = lambda p: nan
 
     def __call__(self, point):
         return self.interpolate(point)
 
+    def sample(self, xs, ys):
+        """Interpolates the raster at many points at once.
+
+        The source pixels around the points are read as few windows (at most MAX_WINDOW_CELLS each)
+        and interpolated with array index math instead of one provider request per point.
+
+        Parameters
+        ----------
+        xs: array_like
+            x coordinates in the CRS of the raster layer
+        ys: array_like
+            y coordinates in the CRS of the raster layer
+
+        Returns
+        -------
+        numpy.ndarray
+            interpolated values with the shape of xs; no data is set to the no data value
+        """
+        return sample_shared([self], xs, ys)[0]
+
+    def grid_key(self):
+        """Identifies the source and pixel grid read by the interpolator, None without a raster layer.
+
+        Interpolators with equal keys, e.g. of several bands of a file, can share their window reads (see
+        sample_shared).
+        """
+        if self.dataProv is None:
+            return None
+        return (self.dataProv.dataSourceUri(), self.myExtent.xMinimum(), self.myExtent.yMaximum(),
+                self.theWidth, self.theHeight)
+
+    def _sample_windows(self, group, u, v, idx, values):
+        # pixel window covering the points idx including the neighbours needed by the kernels of group
+        margin = max(interpolator.kernel[1] for interpolator in group)
+        c0 = max(int(math.floor(u[idx].min())) - margin, 0)
+        c1 = min(int(math.floor(u[idx].max())) + margin + 1, self.theWidth)
+        r0 = max(int(math.floor(v[idx].min())) - margin, 0)
+        r1 = min(int(math.floor(v[idx].max())) + margin + 1, self.theHeight)
+        if c1 <= c0 or r1 <= r0:
+            return  # all points are outside of the raster
+
+        if self.tile_cache is not None:
+            # compact windows around clusters of points touch few tiles
+            max_cells = 4 * TileCache.TILE_SIZE ** 2
+        else:
+            max_cells = self.MAX_WINDOW_CELLS
+        if (c1 - c0) * (r1 - r0) > max_cells and idx.size > 1:
+            # split the points along the longer side of the window and read two smaller windows
+            key = u[idx] if c1 - c0 >= r1 - r0 else v[idx]
+            order = np.argsort(key, kind='stable')
+            half = idx.size // 2
+            self._sample_windows(group, u, v, idx[order[:half]], values)
+            self._sample_windows(group, u, v, idx[order[half:]], values)
+            return
+
+        # each band is read once and shared by all kernels sampling it
+        windows = dict()
+        for interpolator, band_values in zip(group, values):
+            if interpolator.band not in windows:
+                windows[interpolator.band] = interpolator.read_window(c0, r0, c1 - c0, r1 - r0)
+            kernel = interpolator.kernel[0]
+            band_values[idx] = kernel(windows[interpolator.band], u[idx] - c0, v[idx] - r0)
+
+    def overview(self, requested_dx, requested_dy):
+        """Returns the pixel dimensions of the coarsest existing overview whose pixels are not larger than the
+        requested cells, or those of the raster itself."""
+        best = (self.theWidth, self.theHeight)
+        try:
+            pyramids = self.dataProv.buildPyramidList()
+        except Exception:
+            return best
+
+        for pyramid in pyramids:
+            # the attributes became getters in QGIS 3.20
+            if hasattr(pyramid, 'getExists'):
+                exists, xdim, ydim = pyramid.getExists(), pyramid.getXDim(), pyramid.getYDim()
+            else:
+                exists, xdim, ydim = pyramid.exists, pyramid.xDim, pyramid.yDim
+            if not exists or xdim <= 0 or ydim <= 0:
+                continue
+            if (self.myExtent.width() / xdim <= requested_dx and self.myExtent.height() / ydim <= requested_dy
+                    and xdim < best[0]):
+                best = (xdim, ydim)
+        return best
+
+    def aligned_grid(self, xll, yll, dx, dy, angle, nr, nc):
+        """Places an output grid on the source pixels if no interpolation is needed to sample it.
+
+        This is the case if the grid is not rotated, its corners lie on pixel edges and each cell covers one pixel,
+        or with the upscaling reductions a block of kx by ky pixels. The grid is given like a RasterWriter, with
+        rows counted upwards from the lower left corner; its coordinates must be in the CRS of the raster.
+
+        Returns
+        -------
+        dict or None
+            the placement for sample_grid() or None if the grid is not aligned
+        """
+        if self.dataProv is None or abs(math.sin(angle)) > self.ALIGN_TOLERANCE or math.cos(angle) < 0.0:
+            return None
+
+        def integer(value):
+            # value rounded to an integer if it is one within the tolerance
+            rounded = int(round(value))
+            return rounded if abs(value - rounded) <= self.ALIGN_TOLERANCE * max(1.0, abs(value)) else None
+
+        kx, ky = integer(dx / self.xres), integer(dy / self.yres)
+        col = integer((xll - self.myExtent.xMinimum()) / self.xres)
+        row = integer((self.myExtent.yMaximum() - yll - nr * dy) / self.yres)
+        if None in (kx, ky, col, row) or kx < 1 or ky < 1:
+            return None
+        if (kx, ky) != (1, 1) and self.reduction is None:
+            return None  # point methods would depend on the position within the block
+        return {'col': col, 'row': row, 'kx': kx, 'ky': ky, 'nr': int(nr), 'nc': int(nc)}
+
+    def sample_grid(self, grid, rows=None):
+        """Copies (or block-reduces) the source pixels of the output rows of an aligned grid.
+
+        Parameters
+        ----------
+        grid: dict
+            placement returned by aligned_grid()
+        rows: slice or None
+            output rows, all rows if None
+
+        Returns
+        -------
+        numpy.ndarray
+            values of shape (rows, nc) with the lowest row first; no data is set to the no data value
+        """
+        rows = slice(0, grid['nr']) if rows is None else rows
+        kx, ky, nc = grid['kx'], grid['ky'], grid['nc']
+        values = np.empty((rows.stop - rows.start, nc))
+
+        # output rows per window, the top one comes first in the source raster
+        step = max(1, self.MAX_WINDOW_CELLS // (nc * kx * ky))
+        for stop in range(rows.stop, rows.start, -step):
+            start = max(rows.start, stop - step)
+            row = grid['row'] + (grid['nr'] - stop) * ky
+            block = self.read_padded(grid['col'], row, nc * kx, (stop - start) * ky)
+            if (kx, ky) != (1, 1):
+                block = block.reshape(stop - start, ky, nc, kx).swapaxes(1, 2).reshape(stop - start, nc, -1)
+                with warnings.catch_warnings():
+                    # cells without valid pixels are no data
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    block = self.reduction(block, axis=2)
+            values[start - rows.start:stop - rows.start] = block[::-1]
+
+        values[np.isnan(values)] = self.noDataValue
+        return values
+
+    def integral(self, xmin, ymin, xmax, ymax):
+        """Integrates the source raster over an axis-aligned rectangle in its CRS, e.g. the population of a
+        density raster; no data pixels count as zero.
+
+        Every pixel is weighted with its area inside the rectangle, the product of its overlaps along the columns
+        and the rows.
+        """
+        if self.dataProv is None:
+            return 0.0
+        u0 = (xmin - self.myExtent.xMinimum()) / self.xres
+        u1 = (xmax - self.myExtent.xMinimum()) / self.xres
+        v0 = (self.myExtent.yMaximum() - ymax) / self.yres
+        v1 = (self.myExtent.yMaximum() - ymin) / self.yres
+        c0, c1 = max(int(math.floor(u0)), 0), min(int(math.ceil(u1)), self.theWidth)
+        r0, r1 = max(int(math.floor(v0)), 0), min(int(math.ceil(v1)), self.theHeight)
+        if c1 <= c0 or r1 <= r0:
+            return 0.0
+
+        cols = np.arange(c0, c1)
+        wx = np.clip(np.minimum(cols + 1, u1) - np.maximum(cols, u0), 0.0, None)
+        total = 0.0
+        step = max(1, self.MAX_WINDOW_CELLS // (c1 - c0))
+        for row in range(r0, r1, step):
+            rows = np.arange(row, min(row + step, r1))
+            wy = np.clip(np.minimum(rows + 1, v1) - np.maximum(rows, v0), 0.0, None)
+            window = self.read_window(c0, row, c1 - c0, rows.size)
+            total += wy.dot(np.where(np.isnan(window), 0.0, window)).dot(wx)
+        return total * self.xres * self.yres
+
+    def read_padded(self, col, row, ncols, nrows):
+        """Reads a pixel window that may extend beyond the source raster; pixels outside of it are NaN."""
+        values = np.full((nrows, ncols), np.nan)
+        c0, c1 = max(col, 0), min(col + ncols, self.theWidth)
+        r0, r1 = max(row, 0), min(row + nrows, self.theHeight)
+        if c0 < c1 and r0 < r1:
+            values[r0 - row:r1 - row, c0 - col:c1 - col] = self.read_window(c0, r0, c1 - c0, r1 - r0)
+        return values
+
+    def read_window(self, col, row, ncols, nrows):
+        """Reads a pixel window of the source raster as float array (no data is NaN)."""
+        if self.tile_cache is None:
+            return self.read_block(col, row, ncols, nrows)
+
+        # assemble the window from the cached tiles it overlaps
+        size = TileCache.TILE_SIZE
+        values = np.empty((nrows, ncols))
+        for tr in range(row // size, (row + nrows - 1) // size + 1):
+            for tc in range(col // size, (col + ncols - 1) // size + 1):
+                c, r = tc * size, tr * size
+                tile = self.tile_cache.get(self.tile_key + (tc, tr), lambda: self.read_block(
+                    c, r, min(size, self.theWidth - c), min(size, self.theHeight - r)))
+                c0, c1 = max(col, c), min(col + ncols, c + tile.shape[1])
+                r0, r1 = max(row, r), min(row + nrows, r + tile.shape[0])
+                values[r0 - row:r1 - row, c0 - col:c1 - col] = tile[r0 - r:r1 - r, c0 - c:c1 - c]
+        return values
+
+    def read_block(self, col, row, ncols, nrows):
+        """Reads a pixel window from the data provider."""
+        xMin = self.myExtent.xMinimum() + col * self.xres
+        yMax = self.myExtent.yMaximum() - row * self.yres
+        pixelExtent = QgsRectangle(xMin, yMax - nrows * self.yres, xMin + ncols * self.xres, yMax)
+        values = block_to_array(self.dataProv.block(self.band, pixelExtent, ncols, nrows))
+        if self.raster_nan is not None:
+            values[values == self.raster_nan] = np.nan
+        return values
+
     def _nearest(self, point):
         ident = self.dataProv.identify(point, QgsRaster.IdentifyFormatValue)
         value = None
@@ -112,123 +847,5 @@ class RasterInterpolator(object):
                )/((x2 - x1)*(y2 - y1))
         return value
 
-    def _bicubic(self, point):
-        # see the implementation of raster data provider, identify method
-        # https://github.com/qgis/Quantum-GIS/blob/master/src/core/raster/qgsrasterdataprovider.cpp#L268
-        x = point.x()
-        y = point.y()
-        xres = self.myExtent.width() / self.theWidth
-        yres = self.myExtent.height() / self.theHeight
-        col = round((x - self.myExtent.xMinimum()) / xres)
-        row = round((self.myExtent.yMaximum() - y) / yres)
-        xMin = self.myExtent.xMinimum() + (col-2) * xres
-        xMax = xMin + 4*xres
-        yMax = self.myExtent.yMaximum() - (row-2) * yres
-        yMin = yMax - 4*yres
-        pixelExtent = QgsRectangle(xMin, yMin, xMax, yMax)
-        myBlock = self.dataProv.block(self.band, pixelExtent, 4, 4)
-        # http://docs.scipy.org/doc/scipy/reference/generated/scipy.interpolate.interp2d.html
-        vx = [xMin+.5*xres, xMin+1.5*xres, xMin+2.5*xres, xMin+3.5*xres]
-        vy = [yMin+.5*yres, yMin+1.5*yres, yMin+2.5*yres, yMin+3.5*yres]
-        vz = [[myBlock.value(3, 0), myBlock.value(3, 1), myBlock.value(3, 2), myBlock.value(3, 3)],
-              [myBlock.value(2, 0), myBlock.value(2, 1), myBlock.value(2, 2), myBlock.value(2, 3)],
-              [myBlock.value(1, 0), myBlock.value(1, 1), myBlock.value(1, 2), myBlock.value(1, 3)],
-              [myBlock.value(0, 0), myBlock.value(0, 1), myBlock.value(0, 2), myBlock.value(0, 3)]]
-        if myBlock.hasNoDataValue()and isin(self.raster_nan, vz):
-            return self.noDataValue
-        fz = interpolate.interp2d(vx, vy, vz, kind='cubic')
-        value = fz(x, y)[0].item()
-        return value
-
-    def _average(self, point):
-        x = point.x()
-        y = point.y()
-        xres = self.myExtent.width() / self.theWidth
-        yres = self.myExtent.height() / self.theHeight
-        col = round((x - self.myExtent.xMinimum()) / xres)
-        row = round((self.myExtent.yMaximum() - y) / yres)
-        nx= math.ceil(self.outputdx/xres) #number of cells in the x direction
-        ny = math.ceil(self.outputdy/yres) #number of cells in the y direction
-        xMin = self.myExtent.xMinimum() + (col-(nx/2)) * xres
-        xMax = xMin + nx*xres
-        yMax = self.myExtent.yMaximum() - (row-(ny/2)) * yres
-        yMin = yMax - ny*yres
-        pixelExtent = QgsRectangle(xMin, yMin, xMax, yMax)
-
-        values = []
-        y = yMax
-        for i in range(ny):
-            x = xMin
-            for j in range(nx):
-                ident = self.dataProv.identify(QgsPointXY(x, y), QgsRaster.IdentifyFormatValue)
-                values.append(ident.results()[1])
-                x += xres
-            y -= yres
-        for v in values:
-            if v is None or v == self.noDataValue:
-                return self.noDataValue
-        total=0
-        for k in range(0, len(values)):
-            total = total + values[k]
-        value=total/len(values)
-        return value
-
-    def _max(self, point):
-        x = point.x()
-        y = point.y()
-        xres = self.myExtent.width() / self.theWidth
-        yres = self.myExtent.height() / self.theHeight
-        col = round((x - self.myExtent.xMinimum()) / xres)
-        row = round((self.myExtent.yMaximum() - y) / yres)
-        nx= math.ceil(self.outputdx/xres) #number of cells in the x direction
-        ny = math.ceil(self.outputdy/yres) #number of cells in the y direction
-        xMin = self.myExtent.xMinimum() + (col-(nx/2)) * xres
-        xMax = xMin + nx*xres
-        yMax = self.myExtent.yMaximum() - (row-(ny/2)) * yres
-        yMin = yMax - ny*yres
-        pixelExtent = QgsRectangle(xMin, yMin, xMax, yMax)
-
-        values = []
-        y = yMax
-        for i in range(ny):
-            x = xMin
-            for j in range(nx):
-                ident = self.dataProv.identify(QgsPointXY(x, y), QgsRaster.IdentifyFormatValue)
-                values.append(ident.results()[1])
-                x += xres
-            y -= yres
-        for v in values:
-            if v is None:
-                return self.noDataValue
-        value=max(values)
-        return value
-
-    def _min(self, point):
-        x = point.x()
-        y = point.y()
-        xres = self.myExtent.width() / self.theWidth
-        yres = self.myExtent.height() / self.theHeight
-        col = round((x - self.myExtent.xMinimum()) / xres)
-        row = round((self.myExtent.yMaximum() - y) / yres)
-        nx= math.ceil(self.outputdx/xres) #number of cells in the x direction
-        ny = math.ceil(self.outputdy/yres) #number of cells in the y direction
-        xMin = self.myExtent.xMinimum() + (col-(nx/2)) * xres
-        xMax = xMin + nx*xres
-        yMax = self.myExtent.yMaximum() - (row-(ny/2)) * yres
-        yMin = yMax - ny*yres
-        pixelExtent = QgsRectangle(xMin, yMin, xMax, yMax)
-
-        values = []
-        y = yMax
-        for i in range(ny):
-            x = xMin
-            for j in range(nx):
-                ident = self.dataProv.identify(QgsPointXY(x, y), QgsRaster.IdentifyFormatValue)
-                values.append(ident.results()[1])
-                x += xres
-            y -= yres
-        for v in values:
-            if v is None:
-                return self.noDataValue
-        value=min(values)
-        return value
+    def _sample_point(self, point):
+        return float(self.sample([point.x()], [point.y()])[0])
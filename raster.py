@@ -5,12 +5,13 @@ from __future__ import absolute_import
 
 # system modules
 import math
+import os
 
 # 3rd party modules
 import numpy as np
 
 # QGIS modules
-from qgis.core import QgsPointXY
+from qgis.core import QgsGeometry, QgsPointXY, QgsWkbTypes
 
 # promaides modules
 from .utils import deprecated
@@ -23,6 +24,14 @@ from datetime import datetime
 
 class RasterWriter(object):
 
+    # cell properties [bc, bc_stat, BCdata, bc type] of cells without boundary condition
+    DEFAULT_CELL_PROPERTIES = ("false", "false", "0", "point")
+    # number of cells formatted and written at once by write_block
+    BLOCK_LINES = 65536
+    # the number of decimals '%f' prints in BLOCK_FORMAT
+    FLOAT_DECIMALS = 6
+    BLOCK_FORMAT = '%d\t%f\t%d\t%f\t%s\n'
+
     def __init__(self, xll, yll, dc, dr, nc, nr, angle=0.0, nodata=None):
         self.xll = xll
         self.yll = yll
@@ -53,6 +62,19 @@ class RasterWriter(object):
         return QgsPointXY(self.xll + (dc * self.cosa - dr * self.sina),
                           self.yll + (dr * self.cosa + dc * self.sina))
 
+    def cell_centers(self, row_slice=None):
+        """Returns the x and y coordinates of the cell centres of all rows or of the rows in row_slice.
+
+        Both arrays have the shape (rows, nc), raveled they follow the cell indices.
+        """
+        rows = np.arange(self.nr)[row_slice if row_slice is not None else slice(None)]
+
+        dc = (0.5 + np.arange(self.nc))[np.newaxis, :] * self.dc
+        dr = (0.5 + rows)[:, np.newaxis] * self.dr
+
+        return (self.xll + (dc * self.cosa - dr * self.sina),
+                self.yll + (dr * self.cosa + dc * self.sina))
+
     def cell(self, idx):
 
         r_idx = int(math.floor(idx / self.nc))
@@ -68,7 +90,9 @@ class RasterWriter(object):
     def idx(self, cell):
         return cell[0] * self.nc + cell[1]
 
-    def open(self, filename, input_layers):
+    def open(self, filename, layer_names):
+        """Opens filename and writes the header; layer_names holds the names of the 'elev', 'roughn' and 'init'
+        layers (None if not used), as the layers themselves must not be touched off the GUI thread."""
         if self.prm is not None:
             raise OSError('raster file already open')
 
@@ -84,11 +108,11 @@ class RasterWriter(object):
         dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
         self.prm.write('# Generated at {dt_string_1} '.format(dt_string_1=dt_string))
         self.prm.write('from a temporary layer\n')
-        self.prm.write('#  based on height raster (DEM) {}  \n'.format(input_layers['elev']['layer'].name()))
-        if input_layers['roughn']['layer'] != None:
-            self.prm.write('#  based on roughness raster {}  \n'.format(input_layers['roughn']['layer'].name()))
-        if input_layers['init']['layer'] != None:
-            self.prm.write('#  based on initial condition raster {}  \n'.format(input_layers['init']['layer'].name()))
+        self.prm.write('#  based on height raster (DEM) {}  \n'.format(layer_names['elev']))
+        if layer_names['roughn'] is not None:
+            self.prm.write('#  based on roughness raster {}  \n'.format(layer_names['roughn']))
+        if layer_names['init'] is not None:
+            self.prm.write('#  based on initial condition raster {}  \n'.format(layer_names['init']))
 
 
         self.prm.write('# Comments are marked with #\n')
@@ -123,7 +147,8 @@ class RasterWriter(object):
         self.prm.write('#    !FLOODPLAINFILE = "./PATH2FILE/FILE_NAME.txt"\n')
         self.prm.write('#    !LIMITS = <SET>	\n')
         self.prm.write('#       $RTOL = 1e-9 '
-                           '#$RTOL = Defines relative tolerances [optional, standard value = 1.0e-6] (recommendation 1e-9)\n')
+                           '#$RTOL = Defines relative tolerances [optional, standard value = 1.0e-6] '
+                           '(recommendation 1e-9)\n')
         self.prm.write('#       $ATOL = 1e-5 # $ATOL = defines absolute tolerances '
                            '[optional, standard value = 1.0e-5\n')
         self.prm.write('#       $WET  = 0.001   #Water depth [m], when the element is defined as wet [optional, standard value = 1e-3]\n')
@@ -155,18 +180,275 @@ class RasterWriter(object):
 
         self.index += 1
 
-    def close(self):
+    def write_block(self, arrays, bc_table=None):
+        """Writes a run of consecutive cells at once.
+
+        Parameters
+        ----------
+        arrays: dict
+            1d arrays of equal length with the keys 'elev', 'roughn', 'init' and 'bc'; missing data is written as
+            no data value. 'bc' holds the row of bc_table of each cell, -1 for cells without boundary condition.
+        bc_table: list or None
+            cell properties [bc, bc_stat, BCdata, bc type] per boundary condition
+        """
+        num = max(len(a) for a in arrays.values()) if arrays else 0
+        self.write_formatted(self.format_block(arrays, bc_table, self.index), num)
+
+    def format_block(self, arrays, bc_table=None, index=0):
+        """Formats a run of consecutive cells starting with the element number index (see write_block).
+
+        Returns a list of text chunks of at most BLOCK_LINES lines each. Formatting does not touch the file, so
+        blocks can be formatted in parallel and written in order with write_formatted. The lines are put together
+        from digit arrays by numpy, which releases the GIL while working on the arrays; only the few values
+        _fixed_parts cannot round exactly like BLOCK_FORMAT are formatted by Python.
+        """
+        num = max(len(a) for a in arrays.values()) if arrays else 0
+        columns = [np.asarray(arrays[key]) if key in arrays else np.full(num, self.nodata[key])
+                   for key in ('elev', 'roughn', 'init')]
+        columns[0], columns[2] = columns[0].astype(np.float64), columns[2].astype(np.float64)
+        columns[1] = columns[1].astype(np.int64)
+
+        # the default properties are the last row, so that the label -1 selects them
+        properties = ['\t'.join(str(p) for p in row) for row in (bc_table or [])]
+        properties = properties + ['\t'.join(self.DEFAULT_CELL_PROPERTIES)]
+        property_chars = _text_chars([p.encode('utf-8') for p in properties])
+        labels = np.asarray(arrays['bc']) if 'bc' in arrays else np.full(num, -1)
+
+        chunks = []
+        for start in range(0, num, self.BLOCK_LINES):
+            stop = min(start + self.BLOCK_LINES, num)
+            elements = np.arange(index + start, index + stop)
+            roughn = columns[1][start:stop]
+            elev, init = _fixed_parts(columns[0][start:stop]), _fixed_parts(columns[2][start:stop])
+
+            # the fields are written into the columns of one character array, zeros are dropped afterwards
+            fields = [(elements, elements < 0, None), (elev[0], elev[1], elev[2]), (np.abs(roughn), roughn < 0, None),
+                      (init[0], init[1], init[2])]
+            widths = [_digit_width(magnitude, negative) + (0 if fraction is None else 1 + self.FLOAT_DECIMALS)
+                      for magnitude, negative, fraction in fields]
+            lines = np.zeros((stop - start, sum(widths) + len(widths) + property_chars.shape[1] + 1), dtype=np.uint8)
+            column = 0
+            for (magnitude, negative, fraction), width in zip(fields, widths):
+                if fraction is not None:
+                    width -= 1 + self.FLOAT_DECIMALS
+                _put_digits(magnitude, negative, lines[:, column:column + width])
+                column += width
+                if fraction is not None:
+                    lines[:, column] = ord('.')
+                    _put_digits(fraction, None, lines[:, column + 1:column + 1 + self.FLOAT_DECIMALS], leading=True)
+                    column += 1 + self.FLOAT_DECIMALS
+                lines[:, column] = ord('\t')
+                column += 1
+            lines[:, column:-1] = property_chars.take(labels[start:stop], axis=0)
+            lines[:, -1] = ord('\n')
+
+            # lines with values _fixed_parts cannot round like '%f' are formatted by Python
+            inexact = np.flatnonzero(~(elev[3] & init[3]))
+            parts, line = [], 0
+            for i in inexact.tolist() + [stop - start]:
+                block = lines[line:i]
+                parts.append(block[block != 0].tobytes().decode('utf-8'))
+                if i < stop - start:
+                    parts.append(self.BLOCK_FORMAT % (index + start + i, columns[0][start + i],
+                                                      columns[1][start + i], columns[2][start + i],
+                                                      properties[labels[start + i]]))
+                line = i + 1
+            chunks.append(''.join(parts))
+        return chunks
+
+    def write_formatted(self, chunks, num_cells):
+        """Writes num_cells cells formatted by format_block, which must start with the current element number."""
+        self.prm.writelines(chunks)
+        self.index += num_cells
+
+    def close(self, complete=True):
+        """Closes the raster file; an incomplete file, e.g. of a cancelled or failed export, is removed instead of
+        being terminated."""
         if self.prm is None:
             raise OSError('raster file not open')
 
-        self.prm.write('!END\n')
+        if complete:
+            self.prm.write('!END\n')
+        filename = self.prm.name
         self.prm.close()
         self.prm = None
         self.index = 0
+        if not complete:
+            os.remove(filename)
+
+
+def _text_chars(texts):
+    """Returns the byte strings texts as rows of a uint8 array, padded with zeros."""
+    width = max([len(text) for text in texts] + [1])
+    return np.array([list(text) + [0] * (width - len(text)) for text in texts], dtype=np.uint8).reshape(-1, width)
+
+
+# the characters of the numbers 0000 to 9999, looked up by _put_digits
+DIGIT_GROUPS = np.array([list(b'%04d' % i) for i in range(10000)], dtype=np.uint8)
+
+# largest magnitude handled by _fixed_parts; the integer part and the fraction stay exact below
+MAX_FIXED_VALUE = 2.0 ** 31
+
+
+def _digit_width(magnitude, negative):
+    """Returns the number of characters '%d' needs at most for the integers magnitude with the signs negative."""
+    return (len('%d' % magnitude.max()) if magnitude.size else 1) + int(negative.any())
+
+
+def _put_digits(magnitude, negative, chars, leading=False):
+    """Writes the integers magnitude with the signs negative like '%d' into the rows of chars, right-aligned and
+    padded with zeros in front, or with all leading zeros to the full width if leading is True (negative is not used
+    then)."""
+    width = chars.shape[1]
+    rest = magnitude
+    for stop in range(width, 0, -4):
+        rest, group = np.divmod(rest, 10000)
+        chars[:, max(stop - 4, 0):stop] = DIGIT_GROUPS.take(group, axis=0)[:, max(4 - stop, 0):]
+    if leading:
+        return
+
+    digits = 1 + np.searchsorted(10 ** np.arange(1, width, dtype=np.int64), magnitude, side='right')
+    keep = np.arange(width)[np.newaxis, :] >= width - np.arange(width + 1)[:, np.newaxis]
+    chars *= keep.take(digits, axis=0)
+    rows = np.flatnonzero(negative)
+    chars[rows, width - 1 - digits[rows]] = ord('-')
+
+
+def _fixed_parts(values, decimals=RasterWriter.FLOAT_DECIMALS):
+    """Splits the floats values into the integer parts, signs and fractions '%.<decimals>f' prints, and a mask of
+    the values split exactly.
+
+    The integer part is taken off before scaling, so the rounded fraction is exact unless it lies within 1e-9 of a
+    tie; these values as well as non-finite and huge ones are not exact and have to be formatted by Python.
+    """
+    magnitude = np.abs(values)
+    exact = np.isfinite(values) & (magnitude < MAX_FIXED_VALUE)
+    magnitude = np.where(exact, magnitude, 0.0)
+
+    integer = np.floor(magnitude)
+    scaled = (magnitude - integer) * 10.0 ** decimals
+    exact &= np.abs(scaled - np.floor(scaled) - 0.5) > 1e-9
+    fraction = np.floor(scaled + 0.5).astype(np.int64)
+    integer = integer.astype(np.int64)
+    # the fraction may round up to the next integer
+    carry = fraction == 10 ** decimals
+    integer[carry] += 1
+    fraction[carry] = 0
+    # '%f' keeps the sign of negative values rounding to zero
+    return integer, np.signbit(values) & exact, fraction, exact
+
+
+class PolygonRasterizer(object):
+
+    def __init__(self, raster, geometries, transform=None):
+        """Burns polygons into a label grid matching the (rotated) cells of a RasterWriter.
+
+        A cell gets the position of the first polygon in geometries containing its centre, or -1 if no
+        polygon contains it; overlapping polygons are thus resolved in favour of the polygon coming first.
+
+        Parameters
+        ----------
+        raster: RasterWriter
+        geometries: list of QgsGeometry
+        transform: callable or None
+            transforms x, y arrays from the CRS of the geometries into the CRS of the raster
+        """
+        self.raster = raster
+        self.edges = []
+        vmin, vmax = [], []
+        for geometry in geometries:
+            u, v = self._rings(geometry, transform)
+            if u is None:
+                self.edges.append(None)
+                vmin.append(np.inf)
+                vmax.append(-np.inf)
+                continue
+            self.edges.append((u[:-1], v[:-1], u[1:], v[1:]))
+            vmin.append(np.nanmin(v))
+            vmax.append(np.nanmax(v))
+        self.vmin = np.array(vmin, dtype=np.float64)
+        self.vmax = np.array(vmax, dtype=np.float64)
+
+    def _rings(self, geometry, transform):
+        # vertices of all rings in grid coordinates (u along the columns, v along the rows in cell units),
+        # consecutive rings are separated by NaN so that no edge connects them
+        if geometry is None or geometry.isEmpty():
+            return None, None
+        if QgsWkbTypes.isCurvedType(geometry.wkbType()):
+            geometry = QgsGeometry(geometry)
+            geometry.convertToStraightSegment()
+        polygons = geometry.asMultiPolygon() if geometry.isMultipart() else [geometry.asPolygon()]
+
+        rings = [ring for polygon in polygons for ring in polygon if ring]
+        if not rings:
+            return None, None
+        xs = np.array([p.x() for ring in rings for p in ring], dtype=np.float64)
+        ys = np.array([p.y() for ring in rings for p in ring], dtype=np.float64)
+        if transform is not None:
+            # all rings in one call; the separators are inserted afterwards, a transformation may fail on NaN
+            xs, ys = transform(xs, ys)
+        ends = np.cumsum([len(ring) for ring in rings])
+        xs = np.insert(xs, ends, np.nan)
+        ys = np.insert(ys, ends, np.nan)
+
+        dx = xs - self.raster.xll
+        dy = ys - self.raster.yll
+        return ((dx * self.raster.cosa + dy * self.raster.sina) / self.raster.dc,
+                (dy * self.raster.cosa - dx * self.raster.sina) / self.raster.dr)
+
+    def labels(self, row_slice=None):
+        """Returns the polygon labels of all rows or of the rows in row_slice as int array of shape (rows, nc)."""
+        rows = range(self.raster.nr)[row_slice if row_slice is not None else slice(None)]
+        r0, r1 = rows.start, rows.stop
+        nc = self.raster.nc
+        labels = np.full((len(rows), nc), -1, dtype=np.int32)
+
+        # polygons reaching at least one cell centre row of the slice
+        candidates = np.flatnonzero((np.ceil(self.vmin - 0.5) < r1) & (np.ceil(self.vmax - 0.5) > r0))
+        for label in candidates:
+            u1, v1, u2, v2 = self.edges[label]
+
+            # crossings of the edges with the centre lines of the rows (scanline, half-open in v)
+            lo = np.fmax(np.ceil(np.fmin(v1, v2) - 0.5), r0)
+            hi = np.fmin(np.ceil(np.fmax(v1, v2) - 0.5), r1)
+            n = np.nan_to_num(np.maximum(hi - lo, 0)).astype(np.intp)
+            total = n.sum()
+            if total == 0:
+                continue
+            edge = np.repeat(np.arange(n.size), n)
+            row = np.repeat(lo[n > 0].astype(np.intp), n[n > 0]) + (np.arange(total) - np.repeat(np.cumsum(n) - n, n))
+            u = u1[edge] + (row + 0.5 - v1[edge]) * (u2[edge] - u1[edge]) / (v2[edge] - v1[edge])
+
+            # pairs of consecutive crossings per row enclose the cells inside of the polygon (even-odd rule)
+            order = np.lexsort((u, row))
+            row, u = row[order], u[order]
+            row = row[0::2] - r0
+            c_start = np.clip(np.ceil(u[0::2] - 0.5), 0, nc).astype(np.intp)
+            c_end = np.clip(np.ceil(u[1::2] - 0.5), 0, nc).astype(np.intp)
+            spans = c_start < c_end
+            if not spans.any():
+                continue
+            row, c_start, c_end = row[spans], c_start[spans], c_end[spans]
+
+            # fill the spans within the bounding box of the polygon by a running sum
+            rmin, cmin, cmax = row.min(), c_start.min(), c_end.max()
+            diff = np.zeros((row.max() - rmin + 1, cmax - cmin + 1), dtype=np.int32)
+            np.add.at(diff, (row - rmin, c_start - cmin), 1)
+            np.add.at(diff, (row - rmin, c_end - cmin), -1)
+            inside = np.cumsum(diff, axis=1)[:, :-1] > 0
+
+            box = labels[rmin:row.max() + 1, cmin:cmax]
+            box[inside & (box < 0)] = label
+
+        return labels
+
 
 # simpleWriter was written for the export of raster files for the DAM module
 class SimpleRasterWriter(object):
 
+    # number of rows joined and written at once by write_array
+    BLOCK_ROWS = 256
+
     def __init__(self, xll, yll, nr, nc, drc, item, nodata=None):
         self.xll = xll
         self.yll = yll
@@ -237,6 +519,19 @@ class SimpleRasterWriter(object):
 
         return QgsPoint(self.xll + dx, self.yll + dy)
 
+    def cell_centers(self, row_slice=None):
+        """Returns the x and y coordinates of the cell centres of all rows or of the rows in row_slice.
+
+        Both arrays have the shape (rows, nc), raveled they follow the cell indices (first row is the lowest one).
+        """
+        rows = np.arange(self.nr)[row_slice if row_slice is not None else slice(None)]
+
+        dx = (0.5 + np.arange(self.nc))[np.newaxis, :] * self.drc
+        dy = (0.5 + rows)[:, np.newaxis] * self.drc
+
+        return np.broadcast_to(self.xll + dx, (rows.size, self.nc)).copy(), \
+               np.broadcast_to(self.yll + dy, (rows.size, self.nc)).copy()
+
     def cell(self, idx):
 
         r_idx = int(math.floor(idx / self.nc))
@@ -252,7 +547,9 @@ class SimpleRasterWriter(object):
     def idx(self, cell):
         return cell[0] * self.nc + cell[1]
 
-    def open(self, filename, input_layers, data_name):
+    def open(self, filename, layer_names, data_name):
+        """Opens the file of the raster type data_name and writes the header; layer_names holds the names of the
+        input layers, as the layers themselves must not be touched off the GUI thread."""
         if self.prm is not None:
             raise OSError('raster file already open')
 
@@ -267,7 +564,7 @@ class SimpleRasterWriter(object):
         dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
         self.prm.write('# Generated at {dt_string_1} '.format(dt_string_1=dt_string))
         self.prm.write('from a temporary layer\n')
-        self.prm.write('#  based on DAM Exposure data raster {}  \n'.format(input_layers[typeref_short]['layer'].name()))
+        self.prm.write('#  based on DAM Exposure data raster {}  \n'.format(layer_names[typeref_short]))
 
         self.prm.write(
             '# This file contains the data of an DAM-raster. The DAM-raster elements are always quadratic.\n')
@@ -376,14 +673,52 @@ class SimpleRasterWriter(object):
                     self.prm.write(('{' + raster_type + ':f}\t').format(**data))
         self.index += 1
 
-    def close(self):
+    def write_array(self, values, raster_type, fmt='%.0f', nodata=None):
+        """Writes a block of whole rows.
+
+        The rows of values follow the cell indices (first row is the lowest one), but the file starts with the top
+        row: a raster written in several blocks is written from its top block downwards.
+
+        Parameters
+        ----------
+        values: numpy.ndarray
+            values of shape (rows, nc)
+        raster_type: str
+            data name of the values ('ecn' or 'pop'), selects the default no data value
+        fmt: str
+            printf style format of a value, e.g. '%.0f' for IDs or '%f' for densities
+        nodata: float or None
+            written for NaN values, defaults to the no data value of raster_type
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if values.ndim != 2 or values.shape[1] != self.nc:
+            raise ValueError('expected an array of shape (rows, {}), got {}'.format(self.nc, values.shape))
+
+        if nodata is None:
+            nodata = self.nodata[raster_type]
+        if np.isnan(values).any():
+            values = np.where(np.isnan(values), nodata, values)
+
+        row_format = '\t'.join([fmt] * int(self.nc)) + '\n'
+        flipped = values[::-1]
+        for start in range(0, flipped.shape[0], self.BLOCK_ROWS):
+            self.prm.write(''.join(row_format % tuple(row) for row in flipped[start:start + self.BLOCK_ROWS].tolist()))
+        self.index += values.size
+
+    def close(self, complete=True):
+        """Closes the raster file; an incomplete file, e.g. of a cancelled or failed export, is removed instead of
+        being terminated."""
         if self.prm is None:
             raise OSError('raster file not open')
 
-        self.prm.write('!$END_CHARAC\n')
+        if complete:
+            self.prm.write('!$END_CHARAC\n')
+        filename = self.prm.name
         self.prm.close()
         self.prm = None
         self.index = 0
+        if not complete:
+            os.remove(filename)
 
 
 @deprecated('Use RasterWriter instead!')
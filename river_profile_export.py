@@ -17,6 +17,7 @@ from .interpolate import RasterInterpolator
 from .environment import get_ui_path
 from .version import *
 from .utils import *
+from .tasks import ExportTask, output_file, push_outcome
 
 try:
     from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as Canvas
@@ -279,7 +280,7 @@ class PluginDialog(QDialog):
         dem_band = self.raster_band_box.value()
         dem_method = self.method_box.currentText()
         dem_nan = self.nan_box.value()
-        dem_interpol = RasterInterpolator(dem_layer, dem_band, 10, 10, dem_method, dem_nan)
+        dem_interpol = RasterInterpolator(dem_layer, dem_band, 10, 10, dem_method, dem_nan, cache_tiles=True)
 
         base, left, right, h = [], [], [], []
 
@@ -296,7 +297,7 @@ class PluginDialog(QDialog):
             if flip_directions:
                 line = list(reversed(line))
 
-            z = [dem_interpol(QgsPointXY(p)) for p in line]
+            z = dem_interpol.sample([p.x() for p in line], [p.y() for p in line]).tolist()
 
             if adjust_elevation:
                 if z[0] <= z[1]:
@@ -342,7 +343,6 @@ class RiverProfileExport(object):
         self.iface = iface
         self.act = None
         self.dialog = None
-        self.cancel = False
         self.act = QAction('1D-River Profile Export', iface.mainWindow())
         self.act.triggered.connect(self.execDialog)
 
@@ -402,13 +402,9 @@ class RiverProfileExport(object):
 
         self.dialog.show()
 
-    def scheduleAbort(self):
-        self.cancel = True
-
     def quitDialog(self):
         self.dialog = None
         self.act.setEnabled(True)
-        self.cancel = False
 
     def execTool(self):
 
@@ -649,293 +645,270 @@ class RiverProfileExport(object):
             return
 
 
+        # the profiles are checked before anything is sampled or written
+        for i in range(feature_count):
+            #check inflow, outflow, standard
+            if check_river_prof_connection(str(conn_types[i]).lower()) == 0:
+                self.iface.messageBar().pushCritical(
+                    'Error during river profile export',
+                    'Invalid expression for river profile connection (standard/inflow/outflow) ({})! Aborting ...'
+                    .format(conn_types[i])
+                )
+                self.quitDialog()
+                return
+
+            #check river, weir, bridge
+            if check_river_prof_type(str(profile_types[i]).lower()) == 0:
+                self.iface.messageBar().pushCritical(
+                    'Error during river profile export',
+                    'Invalid expression for river profile type (river/bridge/weir) ({})! Aborting ...'
+                    .format(profile_types[i])
+                )
+                self.quitDialog()
+                return
+
+            #check true, false
+            for flags, description in [(point_bc_flags, 'point boundary condition flag'),
+                                       (point_bc_stationary_flags, 'point boundary stationary flag'),
+                                       (lateral_bc_flags, 'lateral boundary condition flag'),
+                                       (lateral_bc_stationary_flags, 'lateral boundary stationary flag'),
+                                       (overflow_left_flags, 'left overflow flag'),
+                                       (overflow_right_flags, 'right overflow flag')]:
+                if check_true_false(str(flags[i]).lower()) == 0:
+                    self.iface.messageBar().pushCritical(
+                        'Error during river profile export',
+                        'Invalid expression for {} (true/false) ({})! Aborting ...'.format(description, flags[i])
+                    )
+                    self.quitDialog()
+                    return
+
+            # label is None or empty
+            if not str(names[i]):
+                self.iface.messageBar().pushCritical(
+                    'Error during river profile export',
+                    'Invalid name label found in field "{}"! Aborting ...'
+                    .format(self.dialog.name_box.expression())
+                )
+                self.quitDialog()
+                return
+
         dem_layer = self.dialog.raster_layer
         dem_band = self.dialog.raster_band_box.value()
-        dem_name = self.dialog.raster_layer.name()
         dem_method = self.dialog.method_box.currentText()
         dem_nan = self.dialog.nan_box.value()
-        dem_interpol = RasterInterpolator(dem_layer, dem_band, 1, 1, dem_method, dem_nan)
-        dem_trans: object = QgsCoordinateTransform(input_layer.crs(), dem_layer.crs(), QgsProject.instance()).transform
+        dem_interpol = RasterInterpolator(dem_layer, dem_band, 1, 1, dem_method, dem_nan, clone_provider=True,
+                                          cache_tiles=True)
 
         roughness_layer = self.dialog.roughness_layer
         roughness_band = self.dialog.roughness_band_box.value()
         roughness_nan = self.dialog.default_roughness_box.value()
-        roughness_interpol = RasterInterpolator(roughness_layer, roughness_band, 10, 10, 'nearest neighbor (downscaling/upscaling)', roughness_nan)
+        roughness_interpol = RasterInterpolator(roughness_layer, roughness_band, 10, 10, 'nearest neighbor (downscaling/upscaling)', roughness_nan,
+                                                clone_provider=True, cache_tiles=True)
         if roughness_layer:
             roughness_trans = QgsCoordinateTransform(input_layer.crs(), roughness_layer.crs(), QgsProject.instance())\
                 .transform
         else:
             roughness_trans = lambda coord: coord
 
-        progress = QProgressDialog('Exporting river profiles ...', 'Abort', 0, 2 * feature_count,
-                                   self.iface.mainWindow())
-        progress.setWindowTitle('River Profile Export')
-        progress.canceled.connect(self.scheduleAbort)
-        progress.show()
+        # Main channel is used; just the first polygon is used as main channel
+        channel_layer = self.dialog.channel_info
+        channel_index = None
+        if channel_layer is not None:
+            if channel_layer.featureCount() != 1:
+                self.iface.messageBar().pushWarning('1-D River Profile Export',
+                                                    'More than one polygon in main'
+                                                    ' channel file; just the first one is used')
+            channel = next(channel_layer.getFeatures(), None)
+            channel_index = PolygonIndex([channel] if channel is not None else [])
 
-        text_blocks = {}
-################################################################################  
-        #autostation
+        lines = []
+        for f in features:
+            line = [(p.x(), p.y()) for p in f.geometry().vertices()]
+            if flip_directions:
+                line = list(reversed(line))
+            lines.append(line)
+
+        # autostation: the lines in the order of their profile ids
+        autostation_lines = None
         if autostation:
+            sortedindex = np.argsort(profileids)
+            #bug fix
+            feature = input_layer.getFeature(0)
+            layerinmemory = not feature.geometry()
+            autostation_lines = []
+            for j in sortedindex:
+                feature = input_layer.getFeature(int(j) + 1 if layerinmemory else int(j))
+                autostation_lines.append((int(j), [(p.x(), p.y()) for p in feature.geometry().vertices()]))
+
+        job = {
+            'filename': filename,
+            'abs_init': abs_init,
+            'addfullriver': addfullriver,
+            'adjust_elevation': adjust_elevation,
+            'source_name': input_layer.sourceName(),
+            'layer_name': input_layer.name(),
+            'dem_name': dem_layer.name(),
+            'channel_name': channel_layer.sourceName() if channel_layer is not None else None,
+            'roughness_name': roughness_layer.name() if roughness_layer else None,
+            'dem_interpol': dem_interpol,
+            'roughness_interpol': roughness_interpol,
+            'roughness_trans': roughness_trans,
+            'channel_index': channel_index,
+            'lines': lines,
+            'autostation_lines': autostation_lines,
+            'names': names,
+            'stations': stations,
+            'deltas': deltas,
+            'conn_types': conn_types,
+            'profile_types': profile_types,
+            'init_values': init_values,
+            'point_bc_flags': point_bc_flags,
+            'point_bc_stationary_flags': point_bc_stationary_flags,
+            'point_bc_values': point_bc_values,
+            'lateral_bc_flags': lateral_bc_flags,
+            'lateral_bc_stationary_flags': lateral_bc_stationary_flags,
+            'lateral_bc_values': lateral_bc_values,
+            'overflow_left_flags': overflow_left_flags,
+            'poleni_left_values': poleni_left_values,
+            'overflow_right_flags': overflow_right_flags,
+            'poleni_right_values': poleni_right_values,
+            'bridgebodyheights': bridgebodyheights,
+            'localbridgeheights': localbridgeheights
+        }
+
+        # the export runs in the background, the dialog is not needed anymore
+        ExportTask('River Profile Export', self.exportProfiles, job, 2 * feature_count, self.exportFinished).start()
+        self.quitDialog()
+
+    def exportFinished(self, task):
+        """Reports the outcome of the export task on the GUI thread."""
+        for station in task.result or []:
+            self.iface.messageBar().pushWarning(
+                'River Profile Export',
+                'Duplicate profile station "{}"! Overwriting previous profile definition.'.format(station)
+            )
+        push_outcome(self.iface, '1D-River Profile Export', task)
+
+    def exportProfiles(self, job, task):
+        """Writes the river profile file of job on the worker thread of task; returns the duplicate stations."""
+        dem_interpol = job['dem_interpol']
+        roughness_interpol = job['roughness_interpol']
+        roughness_trans = job['roughness_trans']
+        channel_index = job['channel_index']
+        addfullriver = job['addfullriver']
+        stations = job['stations']
+        profile_types = job['profile_types']
+        ################################################################################
+        #autostation
+        if job['autostation_lines'] is not None:
             # linepre is the previous line
             linepre = []
             stationsum = 0
-            autostations = list(range(0, len(profileids)))
-            sortedindex=np.argsort(profileids)
-            #bug fix
-            feature = input_layer.getFeature(0)
-            buff = feature.geometry()
-            if not buff:
-                layerinmemory=True
-            else:
-                layerinmemory = False
-            for i, j in enumerate(sortedindex):
-                if layerinmemory==True:
-                    feature = input_layer.getFeature(j+1)
-                else:
-                    feature=input_layer.getFeature(j)
-                line = []
-                buff = feature.geometry()
-                for p in buff.vertices():
-                    line.append(p)
-                #stationing starts with 0   
+            stations = list(range(0, len(job['autostation_lines'])))
+            for i, (j, line) in enumerate(job['autostation_lines']):
+                #stationing starts with 0
                 if i == 0:
                     autocalculatedstation = 0
                 else:
                     #calculating the lowest hieght in the previous line
-                    zpre = [dem_interpol(QgsPointXY(p)) for p in linepre]
+                    zpre = dem_interpol.sample([x for x, y in linepre], [y for x, y in linepre])
                     #the location of the point with the lowest height
                     point_minpre = np.argmin(zpre)
-                    znew = [dem_interpol(QgsPointXY(p)) for p in line]
+                    znew = dem_interpol.sample([x for x, y in line], [y for x, y in line])
                     point_minnew = np.argmin(znew)
-                    difference = linepre[point_minpre].distance(line[point_minnew])
+                    difference = np.hypot(linepre[point_minpre][0] - line[point_minnew][0],
+                                          linepre[point_minpre][1] - line[point_minnew][1])
                     stationsum = difference + stationsum
                     autocalculatedstation = -stationsum
                 linepre = line
-                autostations[j]=autocalculatedstation
-
-##################################################################################
+                stations[j] = autocalculatedstation
+        ##################################################################################
 
+        text_blocks = {}
+        duplicates = []
         # iterate over profiles and extract attributes and points
-        for i, f in enumerate(features):
-            line = []
-            buff = f.geometry()
-
-            for p in buff.vertices():
-                line.append(p) 
-                
-            if flip_directions:
-                line = list(reversed(line))
-                
-            if autostation:
-                stations=autostations
-
+        for i, line in enumerate(job['lines']):
 
+            if task.isCanceled():
+                return duplicates
 
-            name = str(names[i])
+            # erase whitespace before
+            name = str(job['names'][i]).replace(' ', '_')
             station = float(stations[i])
             # no check required
-            delta_x = float(deltas[i])
-            #check inflow, outflow, standard
-            conn_type = str(conn_types[i]).lower()
-            if check_river_prof_connection(conn_type) == 0:
-                self.iface.messageBar().pushCritical(
-                    'Error during river profile export',
-                    'Invalid expression for river profile connection (standard/inflow/outflow) ({})! Aborting ...'
-                    .format(conn_types[i])
-                )
-                self.quitDialog()
-                return
-
-            #check river, weir, bridge
+            delta_x = float(job['deltas'][i])
+            conn_type = str(job['conn_types'][i]).lower()
             profile_type = str(profile_types[i]).lower()
-            if check_river_prof_type(profile_type) == 0:
-                self.iface.messageBar().pushCritical(
-                    'Error during river profile export',
-                    'Invalid expression for river profile type (river/bridge/weir) ({})! Aborting ...'
-                    .format(profile_types[i])
-                )
-                self.quitDialog()
-                return
-
             # no check required
-            init_value = float(init_values[i])
-            #check true, false
-            point_bc = str(point_bc_flags[i]).lower()
-            if check_true_false(point_bc) == 0:
-                self.iface.messageBar().pushCritical(
-                    'Error during river profile export',
-                    'Invalid expression for point boundary condition flag (true/false) ({})! Aborting ...'
-                    .format(point_bc_flags[i])
-                )
-                self.quitDialog()
-                return
-            # check true, false
-            point_bc_stat = str(point_bc_stationary_flags[i]).lower()
-            if check_true_false(point_bc_stat) ==0:
-                self.iface.messageBar().pushCritical(
-                    'Error during river profile export',
-                    'Invalid expression for point boundary stationary flag (true/false) ({})! Aborting ...'
-                    .format(point_bc_stationary_flags[i])
-                )
-                self.quitDialog()
-                return
+            init_value = float(job['init_values'][i])
+            point_bc = str(job['point_bc_flags'][i]).lower()
+            point_bc_stat = str(job['point_bc_stationary_flags'][i]).lower()
             # no check required
-            point_bc_v = point_bc_values[i]
-            # check true, false
-            lat_bc = str(lateral_bc_flags[i]).lower()
-            if check_true_false(lat_bc) == 0:
-                self.iface.messageBar().pushCritical(
-                    'Error during river profile export',
-                    'Invalid expression for lateral boundary condition flag (true/false) ({})! Aborting ...'
-                    .format(lateral_bc_flags[i])
-                )
-                self.quitDialog()
-                return
-            # check true, false
-            lat_bc_stat = str(lateral_bc_stationary_flags[i]).lower()
-            if check_true_false(lat_bc_stat) == 0:
-                self.iface.messageBar().pushCritical(
-                    'Error during river profile export',
-                    'Invalid expression for lateral boundary stationary flag (true/false) ({})! Aborting ...'
-                    .format(lateral_bc_stationary_flags[i])
-                )
-                self.quitDialog()
-                return
+            point_bc_v = job['point_bc_values'][i]
+            lat_bc = str(job['lateral_bc_flags'][i]).lower()
+            lat_bc_stat = str(job['lateral_bc_stationary_flags'][i]).lower()
             # no check required
-            lat_bc_v = lateral_bc_values[i]
-            # check true, false
-            overflow_left = str(overflow_left_flags[i]).lower()
-            if check_true_false(overflow_left) == 0:
-                self.iface.messageBar().pushCritical(
-                    'Error during river profile export',
-                    'Invalid expression for left overflow flag (true/false) ({})! Aborting ...'
-                    .format(overflow_left_flags[i])
-                )
-                self.quitDialog()
-                return
+            lat_bc_v = job['lateral_bc_values'][i]
+            overflow_left = str(job['overflow_left_flags'][i]).lower()
             # no check required
-            poleni_left = float(poleni_left_values[i])
-            # check true, false
-            overflow_right = str(overflow_right_flags[i]).lower()
-            if check_true_false(overflow_right) == 0:
-                self.iface.messageBar().pushCritical(
-                    'Error during river profile export',
-                    'Invalid expression for right overflow flag (true/false) ({})! Aborting ...'
-                    .format(overflow_right_flags[i])
-                )
-                self.quitDialog()
-                return
+            poleni_left = float(job['poleni_left_values'][i])
+            overflow_right = str(job['overflow_right_flags'][i]).lower()
             # no check required
-            poleni_right = float(poleni_right_values[i])
+            poleni_right = float(job['poleni_right_values'][i])
 
             # bridge value no check required; this are the individual values
-            bridgebodyheight = float(bridgebodyheights[i])
-            localbridgeheight = float(localbridgeheights[i])
-
-            # label is None or empty
-            if not name:
-                self.iface.messageBar().pushCritical(
-                    'Error during river profile export',
-                    'Invalid name label found in field "{}"! Aborting ...'
-                    .format(self.dialog.label_field_box.expression())
-                )
-                self.quitDialog()
-                return
-
-            # implicitly convert label to string
-            name = str(name)
-            # erase whitespace before
-            name = name.replace(' ', '_')
-            # label contains whitespaces
-            if len(name.split(' ')) > 1:
-                self.iface.messageBar().pushCritical(
-                    'Error during river profile export',
-                    'Labels must not contain whitespaces! Aborting ...'
-                    .format(self.dialog.label_field_box.expression())
-                )
-                self.quitDialog()
-                return
-
-            if self.cancel:
-                break
+            bridgebodyheight = float(job['bridgebodyheights'][i])
+            localbridgeheight = float(job['localbridgeheights'][i])
 
             # collect point data
-            first = line[0]
-            last = line[-1]
-
-            x = [p.x() for p in line]
-            y = [p.y() for p in line]
-            z = [dem_interpol(QgsPointXY(p)) for p in line]
-            mat = [int(roughness_interpol(roughness_trans(QgsPointXY(p)))) for p in line]
+            x = [xj for xj, yj in line]
+            y = [yj for xj, yj in line]
+            z = dem_interpol.sample(x, y).tolist()
+            mat = [int(roughness_interpol(roughness_trans(QgsPointXY(xj, yj)))) for xj, yj in line]
 
-
-            if adjust_elevation:
+            if job['adjust_elevation']:
                 if z[0] <= z[1]:
                     z[0] = z[1] + 0.01
                 if z[-1] <= z[-2]:
                     z[-1] = z[-2] + 0.01
-            
+
             dist, ident = [], []
             # set channel type
             flag = False
             sumd=0
 
-            #Main channel is used
-
-            if self.dialog.channel_info == None:
-                mainchannel_flag = False
-            else:
-                mainchannel_flag = True
-
-                if self.dialog.channel_info.featureCount() != 1:
-                    self.iface.messageBar().pushWarning('1-D River Profile Export',
-                                                    'More than one polygon in main'
-                                                    ' channel file; just the first one is used')
+            if channel_index is not None:
+                in_channel = channel_index.locate(x, y)
 
             for j, point in enumerate(line):
                 if j==0:
                     d = 0
                 else:
-                    d = line[j-1].distance(point)
+                    d = np.hypot(point[0] - line[j-1][0], point[1] - line[j-1][1])
                 sumd=d+sumd
                 dist.append(sumd)
 
-
-                if point == first:
+                if point == line[0]:
                     ident.append(1)
                 else:
                     # get main channel polygons
-                    if mainchannel_flag == False:
+                    if channel_index is None:
                         ident.append(2)
 
                     else:
-                        features_main = self.dialog.channel_info.getFeatures()
-                        counter_p = 0
-                        for poly in features_main:
-                            counter_p = counter_p+1
-                            if counter_p == 1:
-                                geom_pol = poly.geometry()
-                                if geom_pol.contains(QgsPointXY(point)) == True:
-                                    ident.append(2)
-                                    flag = True
-                                elif flag == True:
-                                    ident.append(3)
-                                elif flag == False:
-                                    ident.append(1)
-
-
-
-                # elif point == last:
-                #     ident.append(3)
-                # else:
-                #     ident.append(2)
-                
+                        if in_channel[j] >= 0:
+                            ident.append(2)
+                            flag = True
+                        elif flag == True:
+                            ident.append(3)
+                        elif flag == False:
+                            ident.append(1)
+
             i_min = np.argmin(z)
             # minimum profile elevation
             z_min = z[int(i_min)]
             # init values are absolute values
-            if abs_init:
+            if job['abs_init']:
                 init_value -= z_min
             # write profile attributes
             block = ""
@@ -1003,24 +976,16 @@ class RiverProfileExport(object):
             block += '\n'
 
             if station in text_blocks:
-                self.iface.messageBar().pushWarning(
-                    'River Profile Export',
-                    'Duplicate profile station "{}"! Overwriting previous profile definition.'.format(station)
-                )
+                duplicates.append(station)
 
             text_blocks[station] = block
-            progress.setValue(i + 1)
+            task.report()
 
-            if self.cancel:
-                break
-
-        if self.cancel:
-            progress.close()
-            self.quitDialog()
-            return
+        if task.isCanceled():
+            return duplicates
 
         # write (station-wise sorted) profiles and profile points to file
-        with open(filename, 'w') as profile_file:
+        with output_file(job['filename'], task) as profile_file:
             profile_file.write('########################################################################\n')
             profile_file.write('# This file was automatically generated by ProMaiDes 1D-River Profile Export'
                                  '-QGIS-Plugin Version {version_1} \n'.format(version_1=VERSION))
@@ -1028,14 +993,14 @@ class RiverProfileExport(object):
             now = datetime.now()
             dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
             profile_file.write('# Generated at {dt_string_1} '.format(dt_string_1=dt_string))
-            profile_file.write('from layer {filename_1} \n'.format(filename_1=input_layer.sourceName()))
-            profile_file.write('#  based on height raster (DEM) {}  \n'.format(dem_name))
-            if self.dialog.channel_info is not None:
+            profile_file.write('from layer {filename_1} \n'.format(filename_1=job['source_name']))
+            profile_file.write('#  based on height raster (DEM) {}  \n'.format(job['dem_name']))
+            if job['channel_name'] is not None:
                 profile_file.write('#  based on main channel polygon {}  \n'.
-                                   format(self.dialog.channel_info.sourceName()))
-            if roughness_layer:
+                                   format(job['channel_name']))
+            if job['roughness_name'] is not None:
                 profile_file.write('#  based on roughness raster {}  \n'.
-                                   format(roughness_layer.name()))
+                                   format(job['roughness_name']))
 
             profile_file.write('# Comments are marked with #\n')
             profile_file.write('#\n')
@@ -1083,18 +1048,14 @@ class RiverProfileExport(object):
             profile_file.write('########################################################################\n\n')
 
 
-            profile_file.write('TITLE = "{}"\n'.format(input_layer.name()))
+            profile_file.write('TITLE = "{}"\n'.format(job['layer_name']))
             profile_file.write('VARIABLES = "X", "Y", "Z", "MathType", "Distance", "Ident"\n')
             profile_file.write('DATASETAUXDATA NumOfProf = "{:d}"\n\n'.format(len(text_blocks)))
 
             # write profiles in reverse sorted order, i.e. decreasing station values
             for i, station in enumerate(reversed(sorted(text_blocks.keys()))):
                 profile_file.write(text_blocks[station])
-                progress.setValue(feature_count + i + 1)
+                task.report()
 
-        progress.close()
+        return duplicates
 
-        #if not self.cancel:
-        self.iface.messageBar().pushInfo('1D-River Profile Export', 'Export finished successfully!')
-
-        self.quitDialog()
@@ -0,0 +1,113 @@
+"""
+On-disk cache of the values sampled for the cells of an exported raster.
+
+A re-export of a raster, e.g. after editing the boundary condition polygons, reads the values sampled from an input
+layer by the previous export instead of sampling the layer again, as long as neither the layer file nor the raster
+grid changed.
+"""
+# system modules
+import glob
+import hashlib
+import os
+
+# 3rd party modules
+import numpy as np
+
+
+def sample_key(layer, items, crs, raster):
+    """Returns the cache key of the values sampled from layer for the cells of raster.
+
+    The key covers the layer file and its modification time, the band, interpolation mode and no data value in
+    items, the CRS of the raster and of the layer and the grid definition of the raster. Returns None for layers
+    without a local file, whose modification cannot be checked.
+
+    Parameters
+    ----------
+    layer: QgsRasterLayer
+    items: dict
+        the input settings of the layer ('band', 'interpol_mode', 'nan' and optionally 'overviews')
+    crs: QgsCoordinateReferenceSystem
+        CRS of raster
+    raster: RasterWriter
+    """
+    uri = layer.dataProvider().dataSourceUri()
+    path = uri.split('|')[0]
+    if not os.path.isfile(path):
+        return None
+    parts = [uri, os.path.getmtime(path), os.path.getsize(path), items['band'], items['interpol_mode'], items['nan'],
+             items.get('overviews', False), crs.toWkt(), layer.crs().toWkt(),
+             raster.xll, raster.yll, raster.dc, raster.dr, raster.nc, raster.nr, raster.angle]
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+class SampledGridCache(object):
+
+    def __init__(self, filename, keys, shape):
+        """Cache of the values sampled for the raster exported to filename.
+
+        The values of an input are stored next to the raster file as memory-mapped <filename>.<data name>.<key>.npy,
+        only the version of the latest complete export is kept.
+
+        Parameters
+        ----------
+        filename: str
+            path of the exported raster file
+        keys: dict
+            cache key per data name (see sample_key); data names whose key is None are not cached
+        shape: tuple
+            (nr, nc) of the raster, the rows follow the cell indices
+        """
+        self.filename = filename
+        self.keys = dict((data_name, key) for data_name, key in keys.items() if key is not None)
+        self.shape = shape
+        self.cached = dict()
+        self.pending = dict()
+
+    def path(self, data_name, key):
+        return '{}.{}.{}.npy'.format(self.filename, data_name, key)
+
+    def open(self):
+        """Maps the valid cache files; the inputs without one get a new file, which is filled by put()."""
+        for data_name, key in self.keys.items():
+            path = self.path(data_name, key)
+            if os.path.isfile(path):
+                try:
+                    values = np.load(path, mmap_mode='r')
+                except (IOError, ValueError):
+                    values = None
+                if values is not None and values.shape == self.shape:
+                    self.cached[data_name] = values
+                    continue
+            self.pending[data_name] = np.lib.format.open_memmap(path + '.part', mode='w+', dtype=np.float64,
+                                                                shape=self.shape)
+
+    def get(self, data_name, rows):
+        """Returns the cached values of the rows as flat array or None if data_name has to be sampled."""
+        values = self.cached.get(data_name)
+        if values is None:
+            return None
+        return np.array(values[rows]).ravel()
+
+    def put(self, data_name, rows, values):
+        """Stores the values sampled for the rows, if data_name is cached."""
+        if data_name in self.pending:
+            self.pending[data_name][rows] = np.reshape(values, (-1, self.shape[1]))
+
+    def close(self, complete):
+        """Unmaps the files; the new ones replace the former versions if the export is complete, otherwise they are
+        removed."""
+        for values in self.pending.values():
+            values.flush()
+        data_names = list(self.pending)
+        # the files have to be unmapped before they can be renamed or removed on Windows
+        self.pending.clear()
+        self.cached.clear()
+
+        for data_name in data_names:
+            path = self.path(data_name, self.keys[data_name])
+            if complete:
+                for former in glob.glob(glob.escape('{}.{}.'.format(self.filename, data_name)) + '*.npy'):
+                    os.remove(former)
+                os.replace(path + '.part', path)
+            else:
+                os.remove(path + '.part')
@@ -0,0 +1,122 @@
+"""
+Common task layer of the exporters.
+
+An exporter collects the settings of its dialog into a plain job on the GUI thread and hands the job to an
+ExportTask together with the function doing the actual work. The QGIS task manager runs the function on a worker
+thread, shows its progress and lets the user cancel it; the outcome is reported back on the GUI thread.
+"""
+# system modules
+import contextlib
+import os
+import threading
+import time
+import traceback
+
+# QGIS modules
+from qgis.core import Qgis, QgsApplication, QgsMessageLog, QgsTask
+
+
+class ExportError(Exception):
+    """Invalid input found by an export function; the message is shown to the user."""
+
+
+class ExportTask(QgsTask):
+
+    # minimum time in seconds between two progress updates
+    PROGRESS_INTERVAL = 0.25
+
+    # python references to the running tasks, which are owned by the task manager on the C++ side only
+    running = set()
+
+    def __init__(self, description, function, job, total, on_finished=None):
+        """Runs function(job, task) on a worker thread of the QGIS task manager.
+
+        function must neither touch widgets nor the map layers of the project. It reports finished work units with
+        task.report(num) and polls task.isCanceled() between them. on_finished(task) is called on the GUI thread
+        once function returned, raised or was cancelled; the return value of function is then found in task.result
+        and an exception raised by it in task.exception.
+
+        Parameters
+        ----------
+        description: str
+        function: callable
+        job: dict
+            settings of the export, collected on the GUI thread
+        total: int
+            number of work units (e.g. cells or features) of the job
+        on_finished: callable or None
+        """
+        QgsTask.__init__(self, description, QgsTask.CanCancel)
+        self.function = function
+        self.job = job
+        self.total = max(1, total)
+        self.on_finished = on_finished
+        self.result = None
+        self.exception = None
+        self.done = 0
+        self.last_update = 0.0
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Adds the task to the task manager of QGIS."""
+        ExportTask.running.add(self)
+        QgsApplication.taskManager().addTask(self)
+
+    def report(self, num=1):
+        """Adds num finished work units; the progress is passed on at most every PROGRESS_INTERVAL seconds.
+
+        May be called from several threads at once.
+        """
+        with self.lock:
+            self.done += num
+            now = time.monotonic()
+            if now - self.last_update < self.PROGRESS_INTERVAL and self.done < self.total:
+                return
+            self.last_update = now
+            self.setProgress(100.0 * min(self.done, self.total) / self.total)
+
+    def run(self):
+        try:
+            self.result = self.function(self.job, self)
+        except Exception as e:
+            self.exception = e
+            if not isinstance(e, (ExportError, IOError)):
+                QgsMessageLog.logMessage(traceback.format_exc(), self.description(), Qgis.Critical)
+            return False
+        return not self.isCanceled()
+
+    def finished(self, result):
+        ExportTask.running.discard(self)
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+
+@contextlib.contextmanager
+def output_file(filename, task):
+    """Opens <filename>.part for writing by the export function of task.
+
+    The file replaces filename when the with block is left normally and the task was not cancelled, otherwise it is
+    removed: a cancelled or failed export leaves no truncated file behind and keeps a former version of filename.
+    """
+    part = filename + '.part'
+    complete = False
+    stream = open(part, 'w')
+    try:
+        yield stream
+        complete = not task.isCanceled()
+    finally:
+        stream.close()
+        if complete:
+            os.replace(part, filename)
+        else:
+            os.remove(part)
+
+
+def push_outcome(iface, title, task):
+    """Shows the outcome of a finished export task in the message bar of iface."""
+    if task.exception is not None:
+        iface.messageBar().pushCritical(title, str(task.exception))
+    elif task.isCanceled():
+        iface.messageBar().pushInfo(title, 'Export cancelled.')
+    else:
+        iface.messageBar().pushInfo(title, 'Export finished successfully!')
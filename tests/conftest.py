@@ -0,0 +1,17 @@
+"""
+Makes the plugin importable as the package promaides_gis_tools, the directory name QGIS installs it under, so that
+the relative imports of its modules resolve. Modules importing qgis are only tested where PyQGIS is available.
+"""
+# system modules
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'promaides_gis_tools' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('promaides_gis_tools', os.path.join(ROOT, '__init__.py'),
+                                                  submodule_search_locations=[ROOT])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = package
+    spec.loader.exec_module(package)
@@ -0,0 +1,93 @@
+# system modules
+import math
+
+# 3rd party modules
+import numpy as np
+import pytest
+
+from promaides_gis_tools.bounding import fit_raster, min_area_raster
+
+
+def convex_hull(points):
+    # monotone chain, counter-clockwise without repeated vertices
+    points = sorted(map(tuple, points))
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    lower, upper = [], []
+    for p in points:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+    for p in reversed(points):
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+    hull = np.array(lower[:-1] + upper[:-1])
+    return hull[:, 0], hull[:, 1]
+
+
+def covers(raster, xs, ys, dc, dr):
+    cosa, sina = math.cos(raster['angle']), math.sin(raster['angle'])
+    dx, dy = xs - raster['xll'], ys - raster['yll']
+    u = dx * cosa + dy * sina
+    v = dy * cosa - dx * sina
+    return (u >= -1e-6).all() and (u <= raster['nc'] * dc + 1e-6).all() \
+        and (v >= -1e-6).all() and (v <= raster['nr'] * dr + 1e-6).all()
+
+
+def rectangle(width, height, angle, x0=5e5, y0=5.7e6):
+    u = np.array([0.0, width, width, 0.0, 0.0])
+    v = np.array([0.0, 0.0, height, height, 0.0])
+    cosa, sina = math.cos(angle), math.sin(angle)
+    return x0 + u * cosa - v * sina, y0 + u * sina + v * cosa
+
+
+def test_min_area_raster_fits_a_rotated_rectangle_exactly():
+    xs, ys = rectangle(300.0, 100.0, math.radians(30.0))
+    raster = min_area_raster(xs, ys, 10.0, 10.0)
+    assert raster['nc'] * raster['nr'] == 300
+    assert math.degrees(raster['angle']) % 90.0 == pytest.approx(30.0)
+    assert covers(raster, xs, ys, 10.0, 10.0)
+    # the closing vertex and the orientation do not matter
+    assert min_area_raster(xs[:-1][::-1], ys[:-1][::-1], 10.0, 10.0) == pytest.approx(raster)
+
+
+def test_min_area_raster_prefers_the_axis_aligned_raster_on_ties():
+    xs, ys = rectangle(40.0, 40.0, 0.0)
+    raster = min_area_raster(xs, ys, 10.0, 10.0)
+    assert raster['angle'] == 0.0
+    assert (raster['nc'], raster['nr']) == (4, 4)
+
+
+def test_min_area_raster_orients_unequal_cells():
+    # a long and narrow domain along y fits tall cells best when turned by a quarter
+    xs, ys = rectangle(10.0, 1000.0, 0.0)
+    raster = min_area_raster(xs, ys, 100.0, 1.0)
+    assert raster['nc'] * raster['nr'] == 100
+    assert covers(raster, xs, ys, 100.0, 1.0)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_min_area_raster_matches_a_search_over_the_edges(seed):
+    rng = np.random.default_rng(seed)
+    xs, ys = convex_hull(rng.normal(size=(200, 2)) * [400.0, 120.0] + [3.2e5, 5.8e6])
+    dc, dr = 7.0, 13.0
+    raster = min_area_raster(xs, ys, dc, dr)
+    assert covers(raster, xs, ys, dc, dr)
+    assert -0.5 * math.pi < raster['angle'] <= 0.5 * math.pi
+
+    edges = np.arctan2(np.roll(ys, -1) - ys, np.roll(xs, -1) - xs)
+    search = fit_raster(xs, ys, dc, dr, np.concatenate([[0.0, 0.5 * math.pi], edges, edges + 0.5 * math.pi]))
+    assert raster['nc'] * raster['nr'] == search['nc'] * search['nr']
+
+    # angles between the edges gain at most the rounding to whole cells
+    search = fit_raster(xs, ys, dc, dr, np.linspace(-0.5 * math.pi, 0.5 * math.pi, 3601))
+    assert raster['nc'] * raster['nr'] <= search['nc'] * search['nr'] + raster['nc'] + raster['nr']
+
+
+def test_min_area_raster_of_a_single_point_is_one_cell():
+    raster = min_area_raster([10.0], [20.0], 5.0, 5.0)
+    assert (raster['nc'], raster['nr'], raster['angle']) == (1, 1, 0.0)
+    assert (raster['xll'], raster['yll']) == (7.5, 17.5)
@@ -0,0 +1,117 @@
+# 3rd party modules
+import numpy as np
+import pytest
+
+pytest.importorskip('qgis.core')
+
+from promaides_gis_tools import interpolate
+from promaides_gis_tools.interpolate import (AreaAverager, nanmode, sample_cubic, sample_linear, sample_nearest,
+                                             summed_area_table)
+
+WINDOW = np.arange(12, dtype=np.float64).reshape(3, 4)
+
+
+def test_sample_nearest_takes_the_pixel_containing_the_point():
+    u = np.array([0.0, 0.99, 3.5, 1.5])
+    v = np.array([0.0, 0.5, 2.99, 1.0])
+    np.testing.assert_array_equal(sample_nearest(WINDOW, u, v), [0.0, 0.0, 11.0, 5.0])
+
+
+def test_sample_nearest_outside_of_the_window_is_nan():
+    values = sample_nearest(WINDOW, np.array([-0.5, 4.0, 1.0]), np.array([1.0, 1.0, 3.0]))
+    assert np.isnan(values).all()
+
+
+def test_sample_linear_reproduces_a_plane():
+    # the window values are 4 * row + column at the pixel centres
+    u = np.array([0.5, 1.25, 2.5, 3.0])
+    v = np.array([0.5, 1.75, 1.5, 2.25])
+    np.testing.assert_allclose(sample_linear(WINDOW, u, v), 4.0 * (v - 0.5) + (u - 0.5))
+
+
+def test_sample_linear_is_nan_next_to_no_data():
+    window = WINDOW.copy()
+    window[1, 1] = np.nan
+    values = sample_linear(window, np.array([1.0, 3.0]), np.array([1.0, 1.0]))
+    assert np.isnan(values[0])
+    assert values[1] == pytest.approx(4.0 * 0.5 + 2.5)
+
+
+def test_sample_cubic_reproduces_a_quadratic():
+    # cubic convolution with a=-0.5 is exact up to second order polynomials
+    rows, cols = np.mgrid[0:8, 0:8] + 0.5
+    window = 0.5 * cols ** 2 - cols * rows + 2.0 * rows ** 2 + 3.0 * cols - 1.0
+    rng = np.random.default_rng(5)
+    u, v = rng.uniform(2.5, 5.5, 50), rng.uniform(2.5, 5.5, 50)
+    np.testing.assert_allclose(sample_cubic(window, u, v), 0.5 * u ** 2 - u * v + 2.0 * v ** 2 + 3.0 * u - 1.0)
+
+
+def test_sample_cubic_falls_back_along_the_border():
+    # the first row lacks the neighbours of the cubic kernel, the border pixels those of the bi-linear one
+    values = sample_cubic(WINDOW, np.array([1.0, 0.2, 3.9]), np.array([0.8, 1.5, 2.9]))
+    np.testing.assert_allclose(values, [4.0 * 0.3 + 0.5, 4.0, 11.0])
+
+
+def test_nanmode_ignores_nan_and_breaks_ties_to_the_smallest_value():
+    values = np.array([[3.0, 1.0, 3.0, np.nan, 1.0, 2.0],
+                       [np.nan, 7.0, np.nan, 7.0, 5.0, 5.0],
+                       [np.nan] * 6,
+                       [4.0, 4.0, 4.0, 2.0, 2.0, np.nan]])
+    np.testing.assert_array_equal(nanmode(values), [1.0, 5.0, np.nan, 4.0])
+    np.testing.assert_array_equal(nanmode(values.T, axis=0), [1.0, 5.0, np.nan, 4.0])
+
+
+def test_nanmode_with_weights_picks_the_largest_total_weight():
+    values = np.array([[1.0, 2.0, 2.0, 3.0], [1.0, 2.0, 2.0, np.nan]])
+    weights = np.array([[0.5, 0.2, 0.2, 0.1], [0.0, 0.0, 0.0, 1.0]])
+    # rows without positive weights on valid values are no data
+    np.testing.assert_array_equal(nanmode(values, weights=weights), [1.0, np.nan])
+
+
+def test_nanmode_counts_in_chunks_of_rows(monkeypatch):
+    values = np.random.default_rng(11).integers(0, 5, size=(200, 9)).astype(np.float64)
+    values[::7, ::2] = np.nan
+    expected = nanmode(values)
+    monkeypatch.setattr(interpolate, 'MAX_MODE_BINS', 16)
+    np.testing.assert_array_equal(nanmode(values), expected)
+    for row, mode in zip(values, expected):
+        counts = np.bincount(row[~np.isnan(row)].astype(np.intp), minlength=5)
+        assert mode == counts.argmax()
+
+
+def test_summed_area_table_sums_the_pixels_above_and_left():
+    window = np.random.default_rng(3).normal(size=(5, 7))
+    table = summed_area_table(window)
+    assert table.shape == (6, 8)
+    for r in range(6):
+        for c in range(8):
+            assert table[r, c] == pytest.approx(window[:r, :c].sum(), abs=1e-12)
+
+
+def test_area_averager_weights_partial_pixels_and_skips_no_data():
+    window = np.arange(16, dtype=np.float64).reshape(4, 4)
+    window[0, 0] = np.nan
+    # 2 x 2 pixels around the pixel corners, and 1.5 x 1.5 pixels around the centre of pixel (2, 2)
+    means = AreaAverager(2.0, 2.0, 1.0, 1.0)(window, np.array([1.0, 3.0]), np.array([1.0, 3.0]))
+    np.testing.assert_allclose(means, [(1.0 + 4.0 + 5.0) / 3.0, (10.0 + 11.0 + 14.0 + 15.0) / 4.0])
+
+    means = AreaAverager(1.5, 1.5, 1.0, 1.0)(window, np.array([2.5]), np.array([2.5]))
+    weights = np.outer([0.25, 1.0, 0.25], [0.25, 1.0, 0.25])
+    assert means[0] == pytest.approx((weights * window[1:4, 1:4]).sum() / weights.sum())
+
+
+def test_area_averager_conserve_keeps_the_total():
+    window = np.random.default_rng(13).uniform(0.0, 50.0, size=(6, 8))
+    window[2, 3:6] = np.nan
+    # 2 x 2 pixel cells shifted by a pixel cover the window and reach one pixel beyond it
+    u, v = np.meshgrid(np.arange(0.0, 9.0, 2.0), np.arange(0.0, 7.0, 2.0))
+    means = AreaAverager(2.0, 2.0, 1.0, 1.0, conserve=True)(window, u.ravel(), v.ravel())
+    assert np.nansum(means * 4.0) == pytest.approx(np.nansum(window))
+
+    averages = AreaAverager(2.0, 2.0, 1.0, 1.0)(window, u.ravel(), v.ravel())
+    assert np.nansum(averages * 4.0) > np.nansum(window)
+
+
+def test_area_averager_without_valid_pixels_is_nan():
+    window = np.full((3, 3), np.nan)
+    assert np.isnan(AreaAverager(2.0, 2.0, 1.0, 1.0)(window, np.array([1.5]), np.array([1.5]))).all()
@@ -0,0 +1,92 @@
+# system modules
+import io
+import math
+
+# 3rd party modules
+import numpy as np
+import pytest
+
+pytest.importorskip('qgis.core')
+
+from qgis.core import QgsGeometry, QgsPointXY
+
+from promaides_gis_tools.raster import PolygonRasterizer, RasterWriter
+
+
+def polygon(*rings):
+    return QgsGeometry.fromPolygonXY([[QgsPointXY(x, y) for x, y in ring] for ring in rings])
+
+
+def box(x0, y0, x1, y1):
+    return [(x0, y0), (x1, y0), (x1, y1), (x0, y1), (x0, y0)]
+
+
+def test_polygon_rasterizer_first_polygon_wins():
+    raster = RasterWriter(0.0, 0.0, 1.0, 1.0, 4, 4)
+    labels = PolygonRasterizer(raster, [polygon(box(0, 0, 2, 4)), polygon(box(1, 0, 4, 4))]).labels()
+    np.testing.assert_array_equal(labels, np.tile([0, 0, 1, 1], (4, 1)))
+
+
+def test_polygon_rasterizer_leaves_holes_and_uncovered_cells_unlabelled():
+    raster = RasterWriter(0.0, 0.0, 1.0, 1.0, 5, 5)
+    geometries = [polygon(box(0, 0, 3, 3), box(1, 1, 2, 2)), None]
+    labels = PolygonRasterizer(raster, geometries).labels()
+
+    expected = np.full((5, 5), -1)
+    expected[:3, :3] = 0
+    expected[1, 1] = -1
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_polygon_rasterizer_rotated_rows_match_the_cell_centres():
+    raster = RasterWriter(10.0, 20.0, 2.0, 3.0, 7, 6, angle=math.radians(30.0))
+    triangle = [(11.0, 21.0), (22.0, 25.0), (8.0, 35.0), (11.0, 21.0)]
+    rasterizer = PolygonRasterizer(raster, [polygon(triangle)])
+
+    # even-odd rule at the cell centres
+    xs, ys = raster.cell_centers()
+    inside = np.zeros(xs.shape, dtype=bool)
+    for (x1, y1), (x2, y2) in zip(triangle[:-1], triangle[1:]):
+        crosses = (y1 > ys) != (y2 > ys)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inside ^= crosses & (xs < x1 + (ys - y1) * (x2 - x1) / (y2 - y1))
+
+    np.testing.assert_array_equal(rasterizer.labels(), np.where(inside, 0, -1))
+    np.testing.assert_array_equal(rasterizer.labels(slice(2, 5)), np.where(inside, 0, -1)[2:5])
+
+
+def write_cells(arrays, bc_table, index):
+    # reference output of the cell-wise writer
+    raster = RasterWriter(0.0, 0.0, 1.0, 1.0, len(arrays['elev']), 1)
+    raster.prm = io.StringIO()
+    raster.index = index
+    for i in range(len(arrays['elev'])):
+        label = arrays['bc'][i]
+        raster.write_cell({'elev': arrays['elev'][i], 'roughn': arrays['roughn'][i], 'init': arrays['init'][i]},
+                          RasterWriter.DEFAULT_CELL_PROPERTIES if label < 0 else bc_table[label])
+    return raster.prm.getvalue()
+
+
+def test_format_block_matches_write_cell():
+    rng = np.random.default_rng(7)
+    num = 5000
+    elev = rng.normal(size=num) * np.array([1e-7, 1e-2, 1.0, 1e3, 1e6])[rng.integers(0, 5, num)]
+    # ties and carries of the sixth decimal, signed zeros and values formatted by Python
+    elev[:12] = [0.0000005, 2.0000015, -0.0000004, -0.0, 0.9999996, 12.5, np.nan, -np.inf, 3e10, -2.0 ** 31,
+                 2.0 ** 31 - 0.25, 1e-300]
+    arrays = {'elev': elev, 'roughn': rng.integers(-3, 2000, num), 'init': np.round(rng.normal(size=num), 3),
+              'bc': rng.integers(-1, 2, num)}
+    bc_table = [['true', 'false', '1.5', 'point'], ['true', 'true', 'q_in', 'area']]
+
+    raster = RasterWriter(0.0, 0.0, 1.0, 1.0, num, 1)
+    raster.BLOCK_LINES = 1024
+    chunks = raster.format_block(arrays, bc_table, index=99)
+    assert len(chunks) == 5
+    assert ''.join(chunks) == write_cells(arrays, bc_table, 99)
+
+
+def test_format_block_fills_missing_arrays_with_no_data():
+    raster = RasterWriter(0.0, 0.0, 1.0, 1.0, 3, 1)
+    chunks = raster.format_block({'elev': np.array([1.5, -2.25, 0.0])})
+    assert ''.join(chunks) == write_cells({'elev': [1.5, -2.25, 0.0], 'roughn': [1] * 3, 'init': [0.0] * 3,
+                                           'bc': [-1] * 3}, [], 0)
@@ -0,0 +1,103 @@
+# system modules
+import os
+from types import SimpleNamespace
+
+# 3rd party modules
+import numpy as np
+
+from promaides_gis_tools.sample_cache import SampledGridCache, sample_key
+
+
+class Crs(object):
+
+    def __init__(self, wkt):
+        self.wkt = wkt
+
+    def toWkt(self):
+        return self.wkt
+
+
+class Layer(object):
+    # the parts of a QgsRasterLayer read by sample_key
+
+    def __init__(self, uri, wkt='EPSG:25832'):
+        self.uri = uri
+        self.layer_crs = Crs(wkt)
+
+    def dataProvider(self):
+        return SimpleNamespace(dataSourceUri=lambda: self.uri)
+
+    def crs(self):
+        return self.layer_crs
+
+
+ITEMS = {'band': 1, 'interpol_mode': 'bi-linear', 'nan': -9999.0}
+
+
+def grid(**changes):
+    raster = dict(xll=0.0, yll=0.0, dc=10.0, dr=10.0, nc=4, nr=3, angle=0.0)
+    raster.update(changes)
+    return SimpleNamespace(**raster)
+
+
+def test_sample_key_follows_the_layer_file_settings_and_grid(tmp_path):
+    path = tmp_path / 'dem.tif'
+    path.write_bytes(b'dem')
+    layer, crs = Layer(str(path)), Crs('EPSG:25832')
+    key = sample_key(layer, ITEMS, crs, grid())
+
+    assert sample_key(Layer(str(path)), dict(ITEMS), Crs('EPSG:25832'), grid()) == key
+    assert sample_key(layer, dict(ITEMS, band=2), crs, grid()) != key
+    assert sample_key(layer, ITEMS, Crs('EPSG:4326'), grid()) != key
+    assert sample_key(layer, ITEMS, crs, grid(angle=0.1)) != key
+    assert sample_key(layer, ITEMS, crs, grid(nc=5)) != key
+
+    stat = os.stat(str(path))
+    os.utime(str(path), (stat.st_atime, stat.st_mtime + 10.0))
+    assert sample_key(layer, ITEMS, crs, grid()) != key
+
+
+def test_sample_key_of_layers_without_a_local_file_is_none(tmp_path):
+    assert sample_key(Layer('https://example.org/wcs?coverage=dem'), ITEMS, Crs(''), grid()) is None
+    assert sample_key(Layer(str(tmp_path / 'missing.tif')), ITEMS, Crs(''), grid()) is None
+
+
+def export(filename, keys, values, complete=True):
+    # fills the cache like export_raster, one row per strip, and returns the values read from it
+    cache = SampledGridCache(filename, keys, values.shape)
+    cache.open()
+    read = {}
+    for data_name in keys:
+        rows = [cache.get(data_name, slice(r, r + 1)) for r in range(values.shape[0])]
+        if rows[0] is not None:
+            read[data_name] = np.concatenate(rows)
+        for r in range(values.shape[0]):
+            cache.put(data_name, slice(r, r + 1), values[r])
+    cache.close(complete)
+    return read
+
+
+def test_sampled_grid_cache_reuses_complete_exports_only(tmp_path):
+    filename = str(tmp_path / 'floodplain.txt')
+    values = np.arange(12, dtype=np.float64).reshape(3, 4)
+
+    assert export(filename, {'elev': 'a', 'roughn': None}, values) == {}
+    assert sorted(os.listdir(str(tmp_path))) == ['floodplain.txt.elev.a.npy']
+    read = export(filename, {'elev': 'a'}, values + 1.0)
+    np.testing.assert_array_equal(read['elev'], values.ravel())
+
+    # an incomplete export leaves the former version in place
+    assert export(filename, {'elev': 'b'}, values + 2.0, complete=False) == {}
+    assert sorted(os.listdir(str(tmp_path))) == ['floodplain.txt.elev.a.npy']
+
+    # a complete export with a new key replaces it
+    assert export(filename, {'elev': 'b'}, values + 3.0) == {}
+    assert sorted(os.listdir(str(tmp_path))) == ['floodplain.txt.elev.b.npy']
+    np.testing.assert_array_equal(export(filename, {'elev': 'b'}, values)['elev'], values.ravel() + 3.0)
+
+
+def test_sampled_grid_cache_ignores_files_of_another_shape(tmp_path):
+    filename = str(tmp_path / 'floodplain.txt')
+    export(filename, {'elev': 'a'}, np.zeros((3, 4)))
+    assert export(filename, {'elev': 'a'}, np.ones((2, 4))) == {}
+    np.testing.assert_array_equal(export(filename, {'elev': 'a'}, np.zeros((2, 4)))['elev'], np.ones(8))
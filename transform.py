@@ -0,0 +1,73 @@
+"""
+
+"""
+# system modules
+import math
+
+# 3rd party modules
+import numpy as np
+
+# QGIS modules
+from qgis.core import QgsCoordinateTransform, QgsLineString, QgsProject
+
+
+class CoordinateTransformer(object):
+
+    def __init__(self, src_crs, dst_crs):
+        """Transforms whole coordinate arrays from src_crs to dst_crs in one call.
+
+        Parameters
+        ----------
+        src_crs: QgsCoordinateReferenceSystem
+        dst_crs: QgsCoordinateReferenceSystem
+        """
+        self.transform = QgsCoordinateTransform(src_crs, dst_crs, QgsProject.instance())
+        self.identity = src_crs == dst_crs or self.transform.isShortCircuited()
+
+    def __call__(self, xs, ys):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        if self.identity or xs.size == 0:
+            return xs, ys
+
+        # the vertices of a line string are transformed in one call on the C++ side
+        line = QgsLineString(xs.ravel().tolist(), ys.ravel().tolist())
+        line.transform(self.transform)
+        if hasattr(line, 'xVector'):
+            tx = np.array(line.xVector(), dtype=np.float64)
+            ty = np.array(line.yVector(), dtype=np.float64)
+        else:
+            tx = np.array([line.xAt(i) for i in range(xs.size)], dtype=np.float64)
+            ty = np.array([line.yAt(i) for i in range(xs.size)], dtype=np.float64)
+        return tx.reshape(xs.shape), ty.reshape(ys.shape)
+
+    def footprint(self, x, y, dx, dy, angle=0.0):
+        """Returns width, height and counter-clockwise rotation (radians) of the dx by dy cell centred on x, y and
+        rotated by angle once transformed, e.g. the footprint of an output cell in the CRS of a source raster.
+
+        The transformed cell is approximated by the parallelogram spanned by its transformed half axes, i.e. by the
+        midpoints of its sides; the cells of a geographic CRS thus get their size in degrees at x, y.
+        """
+        if self.identity:
+            return dx, dy, angle
+        cosa, sina = math.cos(angle), math.sin(angle)
+        tx, ty = self([x, x + 0.5 * dx * cosa, x - 0.5 * dy * sina], [y, y + 0.5 * dx * sina, y + 0.5 * dy * cosa])
+        ux, uy = tx[1] - tx[0], ty[1] - ty[0]
+        vx, vy = tx[2] - tx[0], ty[2] - ty[0]
+        return 2.0 * math.hypot(ux, uy), 2.0 * math.hypot(vx, vy), math.atan2(uy, ux)
+
+
+class CoordinateTransformCache(object):
+
+    def __init__(self):
+        """Keeps one CoordinateTransformer per (source CRS, destination CRS) pair, e.g. for one export run."""
+        self.transformers = dict()
+
+    def get(self, src_crs, dst_crs):
+        key = (src_crs.toWkt(), dst_crs.toWkt())
+        if key not in self.transformers:
+            self.transformers[key] = CoordinateTransformer(src_crs, dst_crs)
+        return self.transformers[key]
+
+    def clear(self):
+        self.transformers.clear()
@@ -2,6 +2,9 @@ import functools
 import inspect
 import warnings
 
+# QGIS modules
+from qgis.core import QgsFeature, QgsGeometry, QgsPoint, QgsRectangle, QgsSpatialIndex
+
 string_types = (type(b''), type(u''))
 
 # use this function to eliminate whitespace in string, e.g. names
@@ -37,6 +40,53 @@ def check_cell_boundary_type(mystr):
     else:
         return 0
 
+class PolygonIndex(object):
+
+    def __init__(self, features):
+        """Spatial index over polygon features with prepared geometries for point-in-polygon queries.
+
+        Features are referred to by their position in features.
+
+        Parameters
+        ----------
+        features: iterable of QgsFeature
+        """
+        self.index = QgsSpatialIndex()
+        self.geometries = []
+        self.engines = []
+        for position, feature in enumerate(features):
+            geometry = QgsGeometry(feature.geometry())
+            self.geometries.append(geometry)  # the engine refers to the geometry, keep it alive
+            if geometry.isEmpty():
+                self.engines.append(None)
+                continue
+            engine = QgsGeometry.createGeometryEngine(geometry.constGet())
+            engine.prepareGeometry()
+            self.engines.append(engine)
+
+            bounds = QgsFeature(position)
+            bounds.setGeometry(QgsGeometry.fromRect(geometry.boundingBox()))
+            self.index.addFeature(bounds)
+
+    def containing(self, geometry):
+        """Returns the positions of all polygons containing the given QgsGeometry in ascending order."""
+        candidates = sorted(self.index.intersects(geometry.boundingBox()))
+        return [position for position in candidates if self.engines[position].contains(geometry.constGet())]
+
+    def locate(self, xs, ys):
+        """Returns for each point the position of the first polygon containing it, -1 if no polygon does."""
+        positions = []
+        for x, y in zip(xs, ys):
+            point = QgsPoint(x, y)
+            position = -1
+            for candidate in sorted(self.index.intersects(QgsRectangle(x, y, x, y))):
+                if self.engines[candidate].contains(point):
+                    position = candidate
+                    break
+            positions.append(position)
+        return positions
+
+
 def deprecated(reason):
     """
     This is a decorator which can be used to mark functions